@@ -0,0 +1,246 @@
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import queries
+from fake_api import Fault, FakeBotApi, FakeProviders
+
+logger = logging.getLogger(__name__)
+
+# «/команда» отправляется сообщением, остальное — нажатие кнопки с таким
+# текстом в последнем сообщении бота; «#» — кнопка-счётчик, меняющая фото.
+SCRIPTS = {
+    'start': ('/start',),
+    'groups': ('/groups', '→', '→', '→', '←', 'Записки', '→'),
+    'notes': ('/notes', '→', '→', '→', '←'),
+    'photos': ('/newanimal', '/notes', '#', '#', '#'),
+}
+SCRIPTS['mixed'] = sum(SCRIPTS.values(), ())
+WORDS = ('купить', 'молоко', 'хлеб', 'позвонить', 'маме', 'встреча',
+         'отчёт', 'врач', 'спорт', 'книга', 'подарок', 'оплатить', 'счёт',
+         'кошка', 'собака', 'завтра', 'вечером', 'проект', 'дедлайн')
+FIRST_CHAT = 1000
+
+
+def text(rng, words=5):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def generate(db, users, groups, members, notes, group_notes, seed=0):
+    rng = random.Random(seed)
+    with db.transaction() as conn:
+        conn.executemany(queries.INSERT_USER, [
+            (FIRST_CHAT + index, f'user{FIRST_CHAT + index}', 'Bench', None)
+            for index in range(users)])
+        owners = [rng.randint(1, users) for _ in range(groups)]
+        conn.executemany(queries.INSERT_GROUP, [
+            (f'group{index}', owner) for index, owner in enumerate(owners)])
+        for group_id, owner in enumerate(owners, 1):
+            conn.execute(queries.INSERT_OWNER_MEMBER, (owner, group_id))
+            others = rng.sample(range(1, users + 1), min(members, users))
+            group_members = [user for user in others if user != owner]
+            conn.executemany(queries.INSERT_MEMBER, [
+                (user, group_id) for user in group_members])
+            conn.executemany(queries.INSERT_NOTE, [
+                (rng.choice(group_members or [owner]), group_id, text(rng),
+                 None) for _ in range(group_notes)])
+        conn.executemany(queries.INSERT_NOTE, [
+            (user, None, text(rng), None)
+            for user in range(1, users + 1) for _ in range(notes)])
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def report(api, providers, registry):
+    # metrics читает настройки при импорте, поэтому импортируем его после
+    # того, как main() подменил окружение.
+    from metrics import percentile as histogram_percentile
+
+    updates = api.emitted
+    elapsed = (api.finished_at or time.monotonic()) - api.started_at
+    latencies = [latency for session in api.sessions.values()
+                 for latency in session.latencies]
+    handled = registry.histogram('update', 'total').snapshot()[0]
+    calls = {method: count for method, count in sorted(api.calls.items())
+             if method not in ('getUpdates', 'setWebhook')}
+    sessions = api.sessions.values()
+    result = {
+        'mode': 'webhook' if api.webhook else 'polling',
+        'updates': updates,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(updates / max(elapsed, 1e-9), 1),
+        'response_p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'response_p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'handler_p50_ms': round(
+            histogram_percentile(handled, 0.5) * 1000, 1),
+        'handler_p99_ms': round(
+            histogram_percentile(handled, 0.99) * 1000, 1),
+        'api_calls_per_update': round(
+            sum(calls.values()) / max(updates, 1), 2),
+        'api_calls': calls,
+        'api_errors': dict(api.errors),
+        'get_updates_calls': api.calls['getUpdates'],
+        'provider_calls': dict(providers.calls),
+        'timeouts': sum(session.timeouts for session in sessions),
+        'skipped': sum(session.skipped for session in sessions),
+        'handlers': registry.describe(
+            limit=20, kinds=('handler', 'callback', 'step')),
+        'gauges': registry.gauges(),
+    }
+    if api.webhook:
+        result['webhook_rejected'] = api.rejected
+        result['webhook_leaked'] = api.leaked
+        result['webhook_redelivered'] = api.redelivered
+    return result
+
+
+def print_report(result):
+    print(f'Обновлений: {result["updates"]} за {result["seconds"]} с — '
+          f'{result["updates_per_second"]} в секунду')
+    print(f'Ответ пользователю: p50 {result["response_p50_ms"]} мс, '
+          f'p99 {result["response_p99_ms"]} мс')
+    print(f'Обработка обновления: p50 {result["handler_p50_ms"]} мс, '
+          f'p99 {result["handler_p99_ms"]} мс')
+    print(f'Вызовов Bot API на обновление: '
+          f'{result["api_calls_per_update"]}')
+    for method, count in result['api_calls'].items():
+        print(f'  {method}: {count}')
+    print(f'Ошибок API: {sum(result["api_errors"].values())}, '
+          f'запросов к провайдерам: {sum(result["provider_calls"].values())}'
+          f', таймаутов: {result["timeouts"]}, '
+          f'пропущено действий: {result["skipped"]}')
+    if 'webhook_rejected' in result:
+        print(f'Вебхук: без секрета, с чужим секретом и с большим телом — '
+              f'ответы '
+              f'{result["webhook_rejected"]}, дошло до обработчиков '
+              f'{result["webhook_leaked"]}; повторных доставок '
+              f'{result["webhook_redelivered"]}')
+    for line in result['handlers']:
+        print(f'  {line}')
+    print(', '.join(f'{name}={value}'
+                    for name, value in result['gauges'].items()))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Нагрузочный прогон бота на поддельных Bot API и '
+                    'провайдерах картинок.')
+    parser.add_argument('--script', choices=sorted(SCRIPTS), default='mixed')
+    parser.add_argument(
+        '--mode', choices=('polling', 'webhook'), default='polling',
+        help='как поддельный Telegram доставляет обновления')
+    parser.add_argument('--rounds', type=int, default=1)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--members', type=int, default=20)
+    parser.add_argument('--notes', type=int, default=10)
+    parser.add_argument('--group-notes', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--api-latency', type=float, default=0.02)
+    parser.add_argument('--api-jitter', type=float, default=0.01)
+    parser.add_argument('--api-errors', type=float, default=0.0)
+    parser.add_argument('--provider-latency', type=float, default=0.05)
+    parser.add_argument('--provider-jitter', type=float, default=0.05)
+    parser.add_argument('--provider-errors', type=float, default=0.0)
+    parser.add_argument('--action-timeout', type=float, default=10.0)
+    parser.add_argument('--timeout', type=float, default=600.0)
+    parser.add_argument(
+        '--unthrottled', action='store_true',
+        help='снять лимиты Telegram в исходящей очереди')
+    parser.add_argument('--json', action='store_true')
+    parser.add_argument('--keep', action='store_true',
+                        help='не удалять базу после прогона')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+    webhook = args.mode == 'webhook'
+    api = FakeBotApi(
+        Fault(args.api_latency, args.api_jitter, args.api_errors),
+        action_timeout=args.action_timeout, webhook=webhook)
+    providers = FakeProviders(Fault(
+        args.provider_latency, args.provider_jitter, args.provider_errors))
+    api.start()
+    providers.start()
+    directory = tempfile.mkdtemp(prefix='bench-')
+    # Настройки читаются при импорте constants, поэтому задаём их до
+    # импорта бота. Базу и токен подменяем всегда, чтобы не задеть боевые.
+    os.environ['DB_PATH'] = os.path.join(directory, 'bench.db')
+    os.environ['TOKEN'] = '123456:bench'
+    os.environ['UPDATE_MODE'] = args.mode
+    os.environ['POLLING_TIMEOUT'] = '1'
+    if webhook:
+        port = free_port()
+        os.environ['WEBHOOK_HOST'] = '127.0.0.1'
+        os.environ['WEBHOOK_PORT'] = str(port)
+        os.environ['WEBHOOK_PATH'] = '/bench'
+        os.environ['WEBHOOK_URL'] = f'http://127.0.0.1:{port}/bench'
+        os.environ['WEBHOOK_SECRET'] = 'bench-secret'
+    os.environ.setdefault('BOSS_IDS', '1')
+    if args.unthrottled:
+        os.environ['OUTBOX_RATE'] = '1000000'
+        os.environ['OUTBOX_CHAT_RATE'] = '1000000'
+        os.environ['OUTBOX_CHAT_BURST'] = '1000000'
+    import constants
+    constants.ANIMAL_URLS.clear()
+    constants.ANIMAL_URLS.update(providers.urls())
+    from telebot import apihelper
+    apihelper.API_URL = api.api_url()
+    import polling
+    from metrics import registry
+    logging.disable(logging.WARNING)
+
+    generate(polling.db, args.users, args.groups, args.members, args.notes,
+             args.group_notes, args.seed)
+    target = polling.chat_webhook if webhook else polling.chat_polling
+    threading.Thread(target=target, name=f'bench-{args.mode}',
+                     daemon=True).start()
+    script = SCRIPTS[args.script] * args.rounds
+    api.run({FIRST_CHAT + index: script for index in range(args.users)})
+    finished = api.done.wait(args.timeout)
+    result = report(api, providers, registry)
+    if webhook:
+        # Запросы без верного секрета и со слишком большим телом должны
+        # отклоняться и не доходить до обработчиков, остальные — доходить.
+        finished = (finished and api.leaked == 0
+                    and api.rejected == [403, 403, 413])
+    result['finished'] = finished
+    # Цикл опроса не останавливается, его ошибки после выключения
+    # поддельного API не интересны.
+    logging.disable(logging.CRITICAL)
+    polling.stop_background()
+    api.stop()
+    providers.stop()
+    if not args.keep:
+        polling.db.close()
+        shutil.rmtree(directory, ignore_errors=True)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
+    return 0 if finished else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,159 @@
+import base64
+import logging
+import secrets
+import threading
+import time
+
+from collections import OrderedDict
+
+from constants import CALLBACK_TOKEN_SIZE, CALLBACK_TOKEN_TTL
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Telegram ограничивает callback_data 64 байтами.
+MAX_DATA = 64
+# Старые текстовые кнопки никогда не начинаются с этого символа.
+PREFIX = '~'
+TOKEN_ACTION = 0
+
+
+def pack_varint(value, out):
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def unpack_varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def pack_args(action_id, fields, args):
+    out = bytearray()
+    pack_varint(action_id, out)
+    for kind, value in zip(fields, args):
+        if kind is int:
+            value = int(value)
+            # zigzag: отрицательные id чатов тоже занимают мало байт.
+            pack_varint(value << 1 if value >= 0 else (~value << 1) | 1, out)
+        else:
+            raw = str(value).encode('utf-8')
+            pack_varint(len(raw), out)
+            out += raw
+    return bytes(out)
+
+
+def unpack_args(data, fields, offset):
+    args = []
+    for kind in fields:
+        value, offset = unpack_varint(data, offset)
+        if kind is int:
+            args.append(value >> 1 if not value & 1 else ~(value >> 1))
+        else:
+            args.append(data[offset:offset + value].decode('utf-8'))
+            offset += value
+    if offset != len(data):
+        raise ValueError('лишние байты в callback_data')
+    return args
+
+
+def to_text(data):
+    return PREFIX + base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def from_text(text):
+    if not text.startswith(PREFIX):
+        raise ValueError('неизвестный формат callback_data')
+    raw = text[len(PREFIX):]
+    return base64.urlsafe_b64decode(raw + '=' * (-len(raw) % 4))
+
+
+class TokenStore:
+
+    def __init__(self, ttl=CALLBACK_TOKEN_TTL, max_size=CALLBACK_TOKEN_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, value):
+        token = secrets.randbits(48)
+        now = time.monotonic()
+        with self._lock:
+            self._values[token] = (now + self.ttl, value)
+            while self._values:
+                oldest, (expires, _) = next(iter(self._values.items()))
+                if expires > now and len(self._values) <= self.max_size:
+                    break
+                del self._values[oldest]
+        return token
+
+    def get(self, token):
+        with self._lock:
+            item = self._values.get(token)
+        if item is None or item[0] < time.monotonic():
+            return None
+        return item[1]
+
+
+class CallbackRouter:
+
+    def __init__(self, tokens=None):
+        self.tokens = tokens or TokenStore()
+        self._by_id = {}
+        self._by_name = {}
+
+    def action(self, name, action_id, *fields):
+        if action_id == TOKEN_ACTION or action_id in self._by_id:
+            raise ValueError(f'id {action_id} уже занят')
+
+        def register(handler):
+            self._by_id[action_id] = (
+                registry.wrap('callback', name, handler), fields)
+            self._by_name[name] = (action_id, fields)
+            return handler
+        return register
+
+    def data(self, name, *args):
+        action_id, fields = self._by_name[name]
+        if len(args) != len(fields):
+            raise TypeError(f'{name} ожидает {len(fields)} аргументов')
+        text = to_text(pack_args(action_id, fields, args))
+        if len(text.encode()) <= MAX_DATA:
+            return text
+        # Длинные значения остаются на сервере, в кнопке — только токен.
+        token = self.tokens.put((action_id, args))
+        return to_text(pack_args(TOKEN_ACTION, (int,), (token,)))
+
+    def decode(self, text):
+        try:
+            data = from_text(text)
+            action_id, offset = unpack_varint(data, 0)
+            if action_id == TOKEN_ACTION:
+                token, = unpack_args(data, (int,), offset)
+                item = self.tokens.get(token)
+                if item is None:
+                    return None
+                action_id, args = item
+                return self._by_id[action_id][0], list(args)
+            handler, fields = self._by_id[action_id]
+            return handler, unpack_args(data, fields, offset)
+        except (KeyError, IndexError, ValueError) as error:
+            logger.warning(f'Не удалось разобрать callback_data: {error}')
+            return None
+
+    def dispatch(self, c):
+        route = self.decode(c.data or '')
+        if route is None:
+            return False
+        handler, args = route
+        handler(c, *args)
+        return True
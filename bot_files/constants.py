@@ -10,6 +10,108 @@ ANIMAL_URLS = {
     'fox': 'https://randomfox.ca/floof/',
     'duck': 'https://random-d.uk/api/random',
 }
+PROVIDER_CONNECT_TIMEOUT = float(os.getenv('PROVIDER_CONNECT_TIMEOUT', 2))
+PROVIDER_READ_TIMEOUT = float(os.getenv('PROVIDER_READ_TIMEOUT', 4))
+PROVIDER_WINDOW = int(os.getenv('PROVIDER_WINDOW', 50))
+PROVIDER_BREAKER_FAILURES = int(os.getenv('PROVIDER_BREAKER_FAILURES', 3))
+PROVIDER_BREAKER_COOLDOWN = int(os.getenv('PROVIDER_BREAKER_COOLDOWN', 60))
+DB_PATH = os.getenv('DB_PATH', 'bot.db')
+DB_MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', 256 * 1024 * 1024))
+# Отрицательное значение cache_size задаёт размер кэша в КиБ.
+DB_CACHE_SIZE = int(os.getenv('DB_CACHE_SIZE', -16000))
+DB_CACHED_STATEMENTS = int(os.getenv('DB_CACHED_STATEMENTS', 256))
+IMAGE_POOL_SIZE = int(os.getenv('IMAGE_POOL_SIZE', 50))
+IMAGE_POOL_LOW = int(os.getenv('IMAGE_POOL_LOW', 10))
+IMAGE_POOL_HIGH = int(os.getenv('IMAGE_POOL_HIGH', 40))
+IMAGE_POOL_TTL = int(os.getenv('IMAGE_POOL_TTL', 3600))
+PHOTO_CACHE_SIZE = int(os.getenv('PHOTO_CACHE_SIZE', 1000))
+PHOTO_RECENT_SIZE = int(os.getenv('PHOTO_RECENT_SIZE', 50))
+PHOTO_TOUCH_INTERVAL = int(os.getenv('PHOTO_TOUCH_INTERVAL', 60))
+PHOTO_REUSE = float(os.getenv('PHOTO_REUSE', 0.5))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+NOTE_COUNT_CACHE_SIZE = int(os.getenv('NOTE_COUNT_CACHE_SIZE', 10000))
+CALLBACK_TOKEN_TTL = int(os.getenv('CALLBACK_TOKEN_TTL', 86400))
+CALLBACK_TOKEN_SIZE = int(os.getenv('CALLBACK_TOKEN_SIZE', 10000))
+CONVERSATION_TTL = int(os.getenv('CONVERSATION_TTL', 86400))
+CONVERSATION_SIZE = int(os.getenv('CONVERSATION_SIZE', 10000))
+# 0 — хранить незавершённые разговоры только в памяти.
+CONVERSATION_PERSIST = os.getenv('CONVERSATION_PERSIST', '1') == '1'
+# 'edit' меняет подпись текущего сообщения, 'resend' шлёт новое фото.
+PAGINATION_MODE = os.getenv('PAGINATION_MODE', 'edit')
+MEMBERS_PER_PAGE = 10
+SEARCH_PER_PAGE = int(os.getenv('SEARCH_PER_PAGE', 10))
+DIGEST_INTERVAL = int(os.getenv('DIGEST_INTERVAL', 86400))
+# Смещение от полуночи UTC: 06:00 UTC — 09:00 по Москве.
+DIGEST_OFFSET = int(os.getenv('DIGEST_OFFSET', 6 * 3600))
+DIGEST_MAX_LINES = int(os.getenv('DIGEST_MAX_LINES', 30))
+DIGEST_CHUNK = int(os.getenv('DIGEST_CHUNK', 200))
+# 1 — копить вставки записок и запросов и фиксировать их пачкой.
+WRITE_BEHIND = os.getenv('WRITE_BEHIND', '0') == '1'
+WRITE_BUFFER_INTERVAL = float(os.getenv('WRITE_BUFFER_INTERVAL', 0.05))
+WRITE_BUFFER_ROWS = int(os.getenv('WRITE_BUFFER_ROWS', 200))
+FANOUT_DELAY = float(os.getenv('FANOUT_DELAY', 30))
+FANOUT_CHUNK = int(os.getenv('FANOUT_CHUNK', 200))
+FANOUT_MAX_PENDING = int(os.getenv('FANOUT_MAX_PENDING', 500))
+INLINE_PER_PAGE = int(os.getenv('INLINE_PER_PAGE', 20))
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', 30))
+INLINE_CACHE_SIZE = int(os.getenv('INLINE_CACHE_SIZE', 5000))
+INLINE_CACHE_ROWS = int(os.getenv('INLINE_CACHE_ROWS', 200))
+# 'polling' — getUpdates, 'webhook' — встроенный HTTP-сервер.
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'polling')
+POLLING_TIMEOUT = int(os.getenv('POLLING_TIMEOUT', 20))
+OUTBOX_RATE = float(os.getenv('OUTBOX_RATE', 30))
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', 1))
+OUTBOX_CHAT_BURST = int(os.getenv('OUTBOX_CHAT_BURST', 3))
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', 4))
+OUTBOX_RETRIES = int(os.getenv('OUTBOX_RETRIES', 3))
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# Пустой секрет заменяется случайным при каждом запуске.
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_MAX_BODY = int(os.getenv('WEBHOOK_MAX_BODY', 1024 * 1024))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))
+DISPATCHER_WORKERS = int(os.getenv('DISPATCHER_WORKERS', 8))
+DISPATCHER_QUEUE_SIZE = int(os.getenv('DISPATCHER_QUEUE_SIZE', 1000))
+LAST_CURSOR = 2 ** 63 - 1
+REMINDER_WINDOW = int(os.getenv('REMINDER_WINDOW', 3600))
+REMINDER_BATCH = int(os.getenv('REMINDER_BATCH', 500))
+REQUEST_TTL = int(os.getenv('REQUEST_TTL', 86400))
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_JITTER = int(os.getenv('JOB_JITTER', 60))
+EXPIRE_INTERVAL = int(os.getenv('EXPIRE_INTERVAL', 3600))
+EXPIRE_CHUNK = int(os.getenv('EXPIRE_CHUNK', 500))
+EXPIRE_PAUSE = float(os.getenv('EXPIRE_PAUSE', 0.05))
+VACUUM_INTERVAL = int(os.getenv('VACUUM_INTERVAL', 21600))
+VACUUM_PAGES = int(os.getenv('VACUUM_PAGES', 1000))
+
+# 0 — не поднимать HTTP-страницу с метриками.
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_INTERVAL = int(os.getenv('METRICS_INTERVAL', 300))
+STATS_LINES = int(os.getenv('STATS_LINES', 15))
+FANOUT_STATS_LINES = int(os.getenv('FANOUT_STATS_LINES', 5))
+# Переход в режим без новых фото: очередь обновлений или p99 их обработки
+# выше порога; обратно — когда обе ниже порогов возврата SHED_HOLD секунд.
+SHED_DEPTH = int(os.getenv('SHED_DEPTH', 200))
+SHED_P99 = float(os.getenv('SHED_P99', 2.0))
+SHED_RECOVER_DEPTH = int(os.getenv('SHED_RECOVER_DEPTH', 50))
+SHED_RECOVER_P99 = float(os.getenv('SHED_RECOVER_P99', 0.5))
+SHED_HOLD = float(os.getenv('SHED_HOLD', 30))
+SHED_INTERVAL = float(os.getenv('SHED_INTERVAL', 1))
+# text или json.
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+# Не больше LOG_SAMPLE_BURST записей DEBUG/INFO с одной строки кода за
+# LOG_SAMPLE_WINDOW секунд; 0 — без ограничения.
+LOG_SAMPLE_BURST = int(os.getenv('LOG_SAMPLE_BURST', 20))
+LOG_SAMPLE_WINDOW = float(os.getenv('LOG_SAMPLE_WINDOW', 10))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_UPDATES = int(os.getenv('PROFILE_UPDATES', 200))
+PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', 300))
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.005))
+PROFILE_TOP = int(os.getenv('PROFILE_TOP', 20))
 
 BOT_TOKEN = os.getenv('TOKEN')
 BOSS_IDS = os.getenv('BOSS_IDS')
@@ -0,0 +1,116 @@
+import json
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+from telebot import Handler
+from telebot.handler_backends import HandlerBackend
+
+import queries
+from constants import CONVERSATION_SIZE, CONVERSATION_TTL
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationStore(HandlerBackend):
+
+    def __init__(self, db=None, ttl=CONVERSATION_TTL,
+                 max_size=CONVERSATION_SIZE):
+        super().__init__(OrderedDict())
+        self.db = db
+        self.ttl = ttl
+        self.max_size = max_size
+        self.steps = {}
+        self._timed = {}
+        self._lock = threading.Lock()
+        # В базе есть разговоры, которых нет в памяти.
+        self._spilled = False
+        if db is not None:
+            self._restore()
+
+    def step(self, func):
+        self.steps[func.__name__] = func
+        self._timed[func.__name__] = registry.wrap('step', func.__name__, func)
+        return func
+
+    def register_handler(self, chat_id, handler):
+        name = handler.callback.__name__
+        if self.steps.get(name) is not handler.callback:
+            raise ValueError(f'Шаг {name} не зарегистрирован')
+        expires_at = int(time.time()) + self.ttl
+        args = json.dumps([handler.args, handler.kwargs])
+        with self._lock:
+            # Новый вопрос заменяет неотвеченный предыдущий.
+            self.handlers[chat_id] = (expires_at, name, args)
+            self.handlers.move_to_end(chat_id)
+            while len(self.handlers) > self.max_size:
+                self.handlers.popitem(last=False)
+                self._spilled = self.db is not None
+        if self.db is not None:
+            with self.db.transaction() as conn:
+                conn.execute(queries.UPSERT_CONVERSATION,
+                             (chat_id, name, args, expires_at))
+
+    def clear_handlers(self, chat_id):
+        self._take(chat_id)
+
+    def get_handlers(self, chat_id):
+        state = self._take(chat_id)
+        if state is None:
+            return None
+        expires_at, name, args = state
+        step = self._timed.get(name)
+        if expires_at < time.time() or step is None:
+            return None
+        args, kwargs = json.loads(args)
+        return [Handler(step, *args, **kwargs)]
+
+    def purge(self, limit):
+        now = int(time.time())
+        with self._lock:
+            expired = [chat_id for chat_id, state in self.handlers.items()
+                       if state[0] < now]
+            for chat_id in expired:
+                del self.handlers[chat_id]
+        if self.db is None:
+            return len(expired)
+        deleted = 0
+        while True:
+            with self.db.transaction() as conn:
+                count = conn.execute(
+                    queries.DELETE_EXPIRED_CONVERSATIONS, (now, limit)
+                ).rowcount
+            deleted += count
+            if count < limit:
+                break
+        stored = self.db.fetchone(queries.COUNT_CONVERSATIONS)[0]
+        with self._lock:
+            self._spilled = stored > len(self.handlers)
+        return deleted
+
+    def _take(self, chat_id):
+        with self._lock:
+            state = self.handlers.pop(chat_id, None)
+            spilled = self._spilled
+        if self.db is None or (state is None and not spilled):
+            return state
+        with self.db.transaction() as conn:
+            if state is None:
+                state = conn.execute(
+                    queries.SELECT_CONVERSATION, (chat_id,)).fetchone()
+            if state is not None:
+                conn.execute(queries.DELETE_CONVERSATION, (chat_id,))
+        return state
+
+    def _restore(self):
+        rows = self.db.fetchall(
+            queries.RECENT_CONVERSATIONS, (int(time.time()), self.max_size))
+        for chat_id, expires_at, name, args in reversed(rows):
+            self.handlers[chat_id] = (expires_at, name, args)
+        stored = self.db.fetchone(queries.COUNT_CONVERSATIONS)[0]
+        self._spilled = stored > len(rows)
+        if rows:
+            logger.info(f'Восстановлено незавершённых разговоров: {len(rows)}')
@@ -0,0 +1,107 @@
+import logging
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+
+import schema
+from constants import DB_CACHED_STATEMENTS, DB_PATH
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+class TimedConnection(sqlite3.Connection):
+    # Время выполнения каждого запроса попадает в гистограмму по его имени
+    # из queries.py.
+
+    def execute(self, sql, parameters=()):
+        histogram = registry.sql(sql)
+        start = time.perf_counter()
+        try:
+            cursor = super().execute(sql, parameters)
+        except BaseException:
+            histogram.observe(time.perf_counter() - start, True)
+            raise
+        histogram.observe(time.perf_counter() - start)
+        return cursor
+
+    def executemany(self, sql, parameters):
+        histogram = registry.sql(sql)
+        start = time.perf_counter()
+        try:
+            cursor = super().executemany(sql, parameters)
+        except BaseException:
+            histogram.observe(time.perf_counter() - start, True)
+            raise
+        histogram.observe(time.perf_counter() - start)
+        return cursor
+
+
+class Database:
+
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        schema.migrate(self.connection())
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                isolation_level=None,
+                check_same_thread=False,
+                cached_statements=DB_CACHED_STATEMENTS,
+                factory=TimedConnection,
+            )
+            schema.configure(conn)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connection()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def incremental_vacuum(self, pages):
+        conn = self.connection()
+        if not schema.incremental_vacuum_enabled(conn):
+            # Старая база без auto_vacuum: освобождать страницы нечем.
+            size = schema.database_size(conn) / 2 ** 20
+            logger.warning(
+                f'База ({size:.1f} МБ) не в режиме incremental_vacuum, '
+                f'переведите её командой python schema.py vacuum')
+            return None
+        conn.execute(f'PRAGMA incremental_vacuum({int(pages)})').fetchall()
+        return conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+    def execute(self, sql, params=()):
+        return self.connection().execute(sql, params)
+
+    def fetchone(self, sql, params=()):
+        return self.connection().execute(sql, params).fetchone()
+
+    def fetchall(self, sql, params=()):
+        return self.connection().execute(sql, params).fetchall()
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
@@ -0,0 +1,51 @@
+import logging
+
+from constants import DIGEST_CHUNK, DIGEST_MAX_LINES
+from outbox import NOTIFICATION
+
+logger = logging.getLogger(__name__)
+
+
+class Digest:
+
+    def __init__(self, repo, outbox, max_lines=DIGEST_MAX_LINES,
+                 chunk=DIGEST_CHUNK):
+        self.repo = repo
+        self.outbox = outbox
+        self.max_lines = max_lines
+        self.chunk = chunk
+        self.collected = 0
+        self.sent = 0
+
+    def notify(self, user_id_t, text):
+        user = self.repo.get_user(user_id_t)
+        if user is None or not user.digest:
+            return self.outbox.send_message(
+                user_id_t, text, lane=NOTIFICATION)
+        self.repo.add_events([(user.id, text)])
+        self.collected += 1
+
+    def flush(self):
+        after = 0
+        users = 0
+        while True:
+            rows = self.repo.digests_page(after, self.chunk)
+            for user_id, user_id_t in rows:
+                count, lines = self.repo.take_digest(user_id, self.max_lines)
+                if count:
+                    self.outbox.send_message(
+                        user_id_t, self.render(count, lines),
+                        lane=NOTIFICATION)
+                    users += 1
+            if len(rows) < self.chunk:
+                break
+            after = rows[-1][0]
+        self.sent += users
+        logger.info(f'Отправлено сводок: {users}')
+
+    def render(self, count, lines):
+        text = f'Сводка событий ({count}):\n' + '\n'.join(
+            f'• {line}' for line in lines)
+        if count > len(lines):
+            text += f'\n…и ещё {count - len(lines)}'
+        return text
@@ -0,0 +1,143 @@
+import functools
+import logging
+import queue
+import threading
+import time
+
+from metrics import registry
+from constants import DISPATCHER_QUEUE_SIZE, DISPATCHER_WORKERS
+
+logger = logging.getLogger(__name__)
+
+STOP = object()
+
+
+class UpdateQueue(queue.Queue):
+
+    def put_unbounded(self, item):
+        # Продолжения уже принятых обновлений и STOP не ждут места в
+        # очереди: иначе поток, который их передаёт, встал бы за новыми
+        # обновлениями.
+        with self.mutex:
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+
+def chat_key(update):
+    if update.message is not None:
+        return update.message.chat.id
+    if update.edited_message is not None:
+        return update.edited_message.chat.id
+    if update.callback_query is not None:
+        if update.callback_query.message is not None:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    if update.inline_query is not None:
+        return update.inline_query.from_user.id
+    return update.update_id
+
+
+class UpdateDispatcher:
+
+    def __init__(self, handle, workers=DISPATCHER_WORKERS,
+                 queue_size=DISPATCHER_QUEUE_SIZE):
+        self.handle = handle
+        self.queues = [UpdateQueue(maxsize=queue_size)
+                       for _ in range(workers)]
+        self.busy = [0.0] * workers
+        self.processed = [0] * workers
+        self.started_at = None
+        self._threads = []
+        self._local = threading.local()
+        self._running = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self._running = True
+        for index in range(len(self.queues)):
+            thread = threading.Thread(
+                target=self._worker, args=(index,),
+                name=f'updates-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        with self._lock:
+            self._running = False
+            for updates in self.queues:
+                updates.put_unbounded(STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads.clear()
+
+    def submit(self, update):
+        # Обновления одного чата всегда попадают в одну очередь, поэтому
+        # обрабатываются строго по порядку.
+        index = hash(chat_key(update)) % len(self.queues)
+        self.queues[index].put(update)
+
+    def call(self, chat_id, func, *args):
+        # Завершение работы, начатой обработчиком в другом потоке, ставится
+        # в очередь того же чата и выполняется по порядку с его обновлениями.
+        index = hash(chat_id) % len(self.queues)
+        with self._lock:
+            queued = (self._running
+                      and getattr(self._local, 'index', None) != index)
+            if queued:
+                self.queues[index].put_unbounded(
+                    functools.partial(func, *args))
+        if not queued:
+            # Очереди уже остановлены или мы и так в потоке этого чата.
+            func(*args)
+
+    def depth(self):
+        return sum(updates.qsize() for updates in self.queues)
+
+    def utilisation(self, index):
+        elapsed = max(time.monotonic() - (self.started_at or 0), 1e-9)
+        return round(self.busy[index] / elapsed, 3)
+
+    def stats(self):
+        return [
+            {
+                'depth': updates.qsize(),
+                'processed': self.processed[index],
+                'utilisation': self.utilisation(index),
+            } for index, updates in enumerate(self.queues)]
+
+    def _worker(self, index):
+        self._local.index = index
+        updates = self.queues[index]
+        histogram = registry.histogram('update', 'total')
+        while True:
+            update = updates.get()
+            if update is STOP:
+                break
+            if isinstance(update, functools.partial):
+                self._continue(index, update)
+                continue
+            start = time.monotonic()
+            failed = False
+            try:
+                self.handle(update)
+            except Exception as error:
+                failed = True
+                logger.exception(
+                    f'Ошибка при обработке обновления {update.update_id}: '
+                    f'{error}')
+            finally:
+                elapsed = time.monotonic() - start
+                self.busy[index] += elapsed
+                self.processed[index] += 1
+                histogram.observe(elapsed, failed)
+
+    def _continue(self, index, func):
+        start = time.monotonic()
+        try:
+            func()
+        except Exception as error:
+            logger.exception(f'Ошибка при завершении обработки: {error}')
+        finally:
+            self.busy[index] += time.monotonic() - start
@@ -1,3 +1,7 @@
 
 class AlreadyExistsError(Exception):
     pass
+
+
+class ProviderUnavailableError(Exception):
+    pass
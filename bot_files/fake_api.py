@@ -0,0 +1,382 @@
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError, URLError
+from urllib.parse import parse_qsl, urlsplit
+from urllib.request import Request, urlopen
+
+logger = logging.getLogger(__name__)
+
+# Ответы в том виде, в каком их отдают настоящие API из ANIMAL_URLS.
+PROVIDER_SHAPES = {
+    'cat': lambda url: [{'id': 'bench', 'url': url}],
+    'dog': lambda url: {'message': url, 'status': 'success'},
+    'fox': lambda url: {'image': url, 'link': url},
+    'duck': lambda url: {'url': url, 'message': 'bench'},
+}
+# Методы, после которых пользователь считает, что бот ему ответил.
+REPLIES = {'sendMessage', 'sendPhoto', 'editMessageText',
+           'editMessageCaption', 'editMessageMedia'}
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# Чат, от имени которого на вебхук приходят запросы без секрета.
+PROBE_CHAT = 1
+
+
+class Fault:
+
+    def __init__(self, latency=0.0, jitter=0.0, errors=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = errors
+
+    def apply(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        return random.random() < self.errors
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.respond(b'')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.respond(self.rfile.read(length))
+
+    def respond(self, body):
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query))
+        if body and self.headers.get('Content-Type', '').startswith(
+                'application/x-www-form-urlencoded'):
+            params.update(parse_qsl(body.decode('utf-8')))
+        status, result = self.server.fake.handle(url.path, params)
+        payload = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeServer:
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), FakeHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name=type(self).__name__,
+            daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def handle(self, path, params):
+        raise NotImplementedError
+
+
+class FakeProviders(FakeServer):
+
+    def __init__(self, fault=None, images=100, **kwargs):
+        super().__init__(**kwargs)
+        self.fault = fault or Fault()
+        self.images = images
+        self.calls = Counter()
+
+    def urls(self):
+        return {name: f'{self.base_url}/{name}' for name in PROVIDER_SHAPES}
+
+    def handle(self, path, params):
+        name = path.strip('/')
+        shape = PROVIDER_SHAPES.get(name)
+        if shape is None:
+            return 404, {}
+        self.calls[name] += 1
+        if self.fault.apply():
+            return 500, {'error': 'bench'}
+        image = random.randrange(self.images)
+        return 200, shape(f'{self.base_url}/images/{name}/{image}.jpg')
+
+
+class UserSession:
+
+    __slots__ = ('chat_id', 'actions', 'index', 'sent_at', 'message',
+                 'latencies', 'timeouts', 'skipped')
+
+    def __init__(self, chat_id, actions):
+        self.chat_id = chat_id
+        self.actions = actions
+        self.index = 0
+        self.sent_at = None
+        # Последнее сообщение бота с кнопками — по нему «нажимаем».
+        self.message = None
+        self.latencies = []
+        self.timeouts = 0
+        self.skipped = 0
+
+    def expects_keyboard(self):
+        return (self.index < len(self.actions)
+                and not self.actions[self.index].startswith('/'))
+
+
+class FakeBotApi(FakeServer):
+
+    def __init__(self, fault=None, action_timeout=10.0, webhook=False,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.fault = fault or Fault()
+        self.action_timeout = action_timeout
+        # В режиме вебхука обновления не отдаются через getUpdates, а
+        # отправляются POST-запросами на адрес из setWebhook.
+        self.webhook = webhook
+        self.webhook_url = None
+        self.webhook_secret = ''
+        # Ответы вебхука на запросы без секрета и с чужим секретом.
+        self.rejected = []
+        self.leaked = 0
+        self.redelivered = 0
+        self.calls = Counter()
+        self.errors = Counter()
+        self.sessions = {}
+        self.emitted = 0
+        self.started_at = None
+        self.finished_at = None
+        self.done = threading.Event()
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._cond = threading.Condition()
+
+    def api_url(self):
+        return f'{self.base_url}/bot{{0}}/{{1}}'
+
+    def start(self):
+        super().start()
+        if self.webhook:
+            threading.Thread(target=self._deliver, name='fake-webhook',
+                             daemon=True).start()
+
+    def run(self, scripts):
+        # scripts: chat_id -> последовательность команд и нажатий кнопок.
+        with self._cond:
+            self.started_at = time.monotonic()
+            for chat_id, actions in scripts.items():
+                session = self.sessions[chat_id] = UserSession(
+                    chat_id, actions)
+                self._next_action(session)
+            self._check_done()
+
+    def handle(self, path, params):
+        method = path.rsplit('/', 1)[-1]
+        self.calls[method] += 1
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self._get_updates(params)}
+        if method == 'setWebhook':
+            with self._cond:
+                self.webhook_url = params.get('url') or None
+                self.webhook_secret = params.get('secret_token', '')
+                self._cond.notify_all()
+            return 200, {'ok': True, 'result': True}
+        if self.fault.apply():
+            self.errors[method] += 1
+            return 500, {'ok': False, 'error_code': 500,
+                         'description': 'Internal Server Error: bench'}
+        return 200, {'ok': True, 'result': self._reply(method, params)}
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        deadline = time.monotonic() + min(float(params.get('timeout', 0)), 1)
+        with self._cond:
+            while True:
+                self._expire()
+                self._updates = [update for update in self._updates
+                                 if update['update_id'] >= offset]
+                if self._updates or time.monotonic() >= deadline:
+                    return self._updates[:limit]
+                self._cond.wait(min(deadline - time.monotonic(), 0.1))
+
+    def _deliver(self):
+        with self._cond:
+            while self.webhook_url is None:
+                self._cond.wait()
+        probe = self._make_update(UserSession(PROBE_CHAT, ()), '/start')
+        probe['update_id'] = 0
+        for secret in ('', 'wrong-' + self.webhook_secret):
+            self.rejected.append(self._post(probe, secret))
+        # Заявленное тело больше WEBHOOK_MAX_BODY: его не должны читать.
+        self.rejected.append(
+            self._post(probe, self.webhook_secret, length=2 ** 31))
+        while True:
+            with self._cond:
+                while True:
+                    self._expire()
+                    if self._updates:
+                        update = self._updates.pop(0)
+                        break
+                    self._cond.wait(0.1)
+            # Как и Telegram, повторяем доставку, пока бот не ответит 2xx.
+            while self._post(update, self.webhook_secret) // 100 != 2:
+                self.redelivered += 1
+                time.sleep(0.1)
+
+    def _post(self, update, secret, length=None):
+        request = Request(
+            self.webhook_url, data=json.dumps(update).encode('utf-8'),
+            headers={'Content-Type': 'application/json'})
+        if secret:
+            request.add_header(SECRET_HEADER, secret)
+        if length is not None:
+            request.add_header('Content-Length', str(length))
+        try:
+            with urlopen(request, timeout=10) as response:
+                return response.status
+        except HTTPError as error:
+            return error.code
+        except URLError as error:
+            logger.warning(f'Вебхук недоступен: {error}')
+            return 0
+
+    def _reply(self, method, params):
+        chat_id = params.get('chat_id')
+        if method not in REPLIES or chat_id is None:
+            return True
+        chat_id = int(chat_id)
+        if chat_id == PROBE_CHAT:
+            # Ответ на запрос без секрета: вебхук его пропустил.
+            self.leaked += 1
+        message = {
+            'message_id': int(params.get('message_id') or 0)
+            or next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private',
+                     'first_name': f'user{chat_id}'},
+        }
+        if 'text' in params:
+            message['text'] = params['text']
+        if 'caption' in params:
+            message['caption'] = params['caption']
+        photo = params.get('photo')
+        if 'media' in params:
+            media = json.loads(params['media'])
+            photo = media['media']
+            message['caption'] = media.get('caption')
+        if photo is not None:
+            message['photo'] = [{
+                'file_id': photo if photo.startswith('file-')
+                else f'file-{abs(hash(photo))}',
+                'file_unique_id': str(abs(hash(photo))),
+                'width': 320, 'height': 320}]
+        if 'reply_markup' in params:
+            message['reply_markup'] = json.loads(params['reply_markup'])
+        with self._cond:
+            session = self.sessions.get(chat_id)
+            if session is None:
+                return message
+            keyboard = 'inline_keyboard' in message.get('reply_markup', {})
+            if keyboard:
+                session.message = message
+            elif (method.startswith('edit') and session.message
+                  and session.message['message_id']
+                  == message['message_id']):
+                message['reply_markup'] = session.message['reply_markup']
+            # Чтобы нажать кнопку, нужно дождаться сообщения с кнопками,
+            # а не очередного ответа на прошлую команду.
+            if session.sent_at is not None and (
+                    keyboard or not session.expects_keyboard()):
+                session.latencies.append(time.monotonic() - session.sent_at)
+                self._next_action(session)
+                self._check_done()
+        return message
+
+    def _next_action(self, session):
+        session.sent_at = None
+        while session.index < len(session.actions):
+            action = session.actions[session.index]
+            session.index += 1
+            update = self._make_update(session, action)
+            if update is None:
+                # Нужной кнопки нет: например, у пользователя одна группа.
+                session.skipped += 1
+                continue
+            update['update_id'] = next(self._update_ids)
+            self._updates.append(update)
+            self.emitted += 1
+            session.sent_at = time.monotonic()
+            self._cond.notify_all()
+            return
+
+    def _make_update(self, session, action):
+        user = {'id': session.chat_id, 'is_bot': False,
+                'first_name': f'user{session.chat_id}',
+                'username': f'user{session.chat_id}'}
+        if action.startswith('/'):
+            command = action.split()[0]
+            return {'message': {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': session.chat_id, 'type': 'private',
+                         'first_name': user['first_name'],
+                         'username': user['username']},
+                'from': user, 'text': action,
+                'entities': [{'type': 'bot_command', 'offset': 0,
+                              'length': len(command)}]}}
+        data = self._find_button(session.message, action)
+        if data is None:
+            return None
+        return {'callback_query': {
+            'id': str(next(self._message_ids)), 'from': user,
+            'chat_instance': str(session.chat_id), 'data': data,
+            'message': session.message}}
+
+    def _find_button(self, message, action):
+        if message is None:
+            return None
+        for row in message['reply_markup']['inline_keyboard']:
+            for button in row:
+                text = button.get('text', '')
+                # «#» — средняя кнопка со счётчиком страниц, она меняет фото.
+                if text == action or (action == '#' and '/' in text):
+                    return button.get('callback_data')
+        return None
+
+    def _expire(self):
+        now = time.monotonic()
+        for session in self.sessions.values():
+            if (session.sent_at is not None
+                    and now - session.sent_at > self.action_timeout):
+                session.timeouts += 1
+                self._next_action(session)
+        self._check_done()
+
+    def _check_done(self):
+        if self.done.is_set():
+            return
+        if all(session.sent_at is None and
+               session.index >= len(session.actions)
+               for session in self.sessions.values()):
+            self.finished_at = time.monotonic()
+            self.done.set()
@@ -0,0 +1,153 @@
+import heapq
+import logging
+import threading
+import time
+
+from constants import FANOUT_CHUNK, FANOUT_DELAY, FANOUT_MAX_PENDING
+from outbox import NOTIFICATION
+
+logger = logging.getLogger(__name__)
+
+
+class Progress:
+
+    __slots__ = ('note_id', 'group_name', 'queued', 'sent', 'failed',
+                 'total', 'started_at', 'finished_at')
+
+    def __init__(self, note_id, group_name):
+        self.note_id = note_id
+        self.group_name = group_name
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        # Известно, только когда все получатели поставлены в очередь.
+        self.total = None
+        self.started_at = time.time()
+        self.finished_at = None
+
+    def check(self):
+        if self.total is not None and self.sent + self.failed == self.total:
+            self.finished_at = time.time()
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class NoteFanout:
+
+    def __init__(self, repo, outbox, delay=FANOUT_DELAY, chunk=FANOUT_CHUNK,
+                 max_pending=FANOUT_MAX_PENDING):
+        self.repo = repo
+        self.outbox = outbox
+        self.delay = delay
+        self.chunk = chunk
+        self.max_pending = max_pending
+        self.deduplicated = 0
+        self.history = []
+        # note_id -> (author_id, edited); в куче — (время отправки, note_id).
+        self._pending = {}
+        self._heap = []
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='fanout', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def notify(self, note_id, author_id, edited=False):
+        with self._cond:
+            if note_id in self._pending:
+                # Правки в пределах окна уйдут одним сообщением.
+                self.deduplicated += 1
+                first_author, was_edited = self._pending[note_id]
+                self._pending[note_id] = (first_author, was_edited or edited)
+                return
+            self._pending[note_id] = (author_id, edited)
+            heapq.heappush(self._heap, (time.monotonic() + self.delay,
+                                        note_id))
+            self._cond.notify()
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending)
+
+    def progress(self):
+        with self._cond:
+            return [item.as_dict() for item in self.history]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and (
+                        not self._heap
+                        or self._heap[0][0] > time.monotonic()):
+                    timeout = None
+                    if self._heap:
+                        timeout = self._heap[0][0] - time.monotonic()
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+                _, note_id = heapq.heappop(self._heap)
+                author_id, edited = self._pending.pop(note_id)
+            try:
+                self._send(note_id, author_id, edited)
+            except Exception as error:
+                logger.error(f'Ошибка при рассылке записки {note_id}: {error}')
+
+    def _send(self, note_id, author_id, edited):
+        note = self.repo.get_fanout_note(note_id)
+        if note is None or note[1] is None:
+            return
+        text, group_id, group_name = note
+        title = 'Изменена записка' if edited else 'Новая записка'
+        message = f'{title} в группе {group_name}:\n{text}'
+        progress = Progress(note_id, group_name)
+        with self._cond:
+            self.history.append(progress)
+            del self.history[:-100]
+        after = 0
+        while True:
+            rows = self.repo.notify_members(group_id, after, self.chunk)
+            # Тем, кто выбрал сводку, пишем событие, а не сообщение.
+            self.repo.add_events([
+                (user_id, message) for user_id, _, digest in rows
+                if digest and user_id != author_id])
+            for user_id, user_id_t, digest in rows:
+                if digest or user_id == author_id:
+                    continue
+                self._wait_for_outbox()
+                future = self.outbox.send_message(
+                    user_id_t, message, lane=NOTIFICATION)
+                progress.queued += 1
+                future.add_done_callback(
+                    lambda future: self._delivered(progress, future))
+            if len(rows) < self.chunk:
+                break
+            after = rows[-1][0]
+        with self._cond:
+            progress.total = progress.queued
+            progress.check()
+        logger.info(f'Записка {note_id}: в очередь поставлено '
+                    f'{progress.queued} уведомлений')
+
+    def _wait_for_outbox(self):
+        # Не держим в памяти исходящей очереди больше max_pending писем.
+        while self.outbox.depth() >= self.max_pending and not self._stopped:
+            time.sleep(0.1)
+
+    def _delivered(self, progress, future):
+        with self._cond:
+            if future.exception() is None:
+                progress.sent += 1
+            else:
+                progress.failed += 1
+            progress.check()
@@ -0,0 +1,89 @@
+import logging
+import threading
+import time
+
+from collections import deque
+
+from constants import (IMAGE_POOL_HIGH, IMAGE_POOL_LOW, IMAGE_POOL_SIZE,
+                       IMAGE_POOL_TTL)
+
+logger = logging.getLogger(__name__)
+
+
+class ImagePool:
+
+    def __init__(self, fetch, size=IMAGE_POOL_SIZE, low=IMAGE_POOL_LOW,
+                 high=IMAGE_POOL_HIGH, ttl=IMAGE_POOL_TTL):
+        if not 0 <= low < high <= size:
+            raise ValueError('Должно выполняться 0 <= low < high <= size')
+        self.fetch = fetch
+        self.size = size
+        self.low = low
+        self.high = high
+        self.ttl = ttl
+        self._images = deque(maxlen=size)
+        self._last = None
+        self._lock = threading.Lock()
+        self._refill = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._images)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._worker, name='image-pool', daemon=True)
+            self._thread.start()
+        self._refill.set()
+
+    def stop(self):
+        self._stop.set()
+        self._refill.set()
+
+    def take(self):
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            url = self._images.popleft()[1] if self._images else None
+            if url is None:
+                url = self._last
+            else:
+                self._last = url
+            if len(self._images) <= self.low:
+                self._refill.set()
+        if url is None:
+            # Холодный старт: пул ещё ни разу не наполнялся. Загружать
+            # картинку здесь нельзя — take() зовут из обработчиков.
+            logger.warning('Пул картинок пуст')
+        return url
+
+    def put(self, url):
+        with self._lock:
+            self._images.append((time.monotonic(), url))
+
+    def _evict(self, now):
+        while self._images and now - self._images[0][0] > self.ttl:
+            self._images.popleft()
+
+    def _fetch_one(self):
+        try:
+            return self.fetch()
+        except Exception as error:
+            logger.error(f'Не удалось получить картинку: {error}')
+
+    def _worker(self):
+        while not self._stop.is_set():
+            self._refill.wait(timeout=self.ttl / 2)
+            self._refill.clear()
+            with self._lock:
+                self._evict(time.monotonic())
+                missing = self.high - len(self._images)
+            while missing > 0 and not self._stop.is_set():
+                image = self._fetch_one()
+                if image is None:
+                    break
+                self.put(image)
+                missing -= 1
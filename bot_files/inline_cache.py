@@ -0,0 +1,104 @@
+import re
+import threading
+import unicodedata
+
+from collections import OrderedDict
+
+from constants import INLINE_CACHE_ROWS, INLINE_CACHE_SIZE
+
+
+def words(text):
+    # Та же свёртка, что у токенизатора unicode61 с remove_diacritics.
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return re.findall(r'\w+', text)
+
+
+def normalize(query):
+    return ' '.join(words(query))
+
+
+def matches(note, prefixes):
+    tokens = words(note)
+    return all(any(token.startswith(prefix) for token in tokens)
+               for prefix in prefixes)
+
+
+class InlineCache:
+
+    def __init__(self, max_size=INLINE_CACHE_SIZE,
+                 max_rows=INLINE_CACHE_ROWS):
+        self.max_size = max_size
+        self.max_rows = max_rows
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, user_id, query):
+        with self._lock:
+            rows = self._lookup(user_id, query)
+            if rows is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return rows
+
+    def generation(self, user_id):
+        with self._lock:
+            return self._generations.get(user_id, 0)
+
+    def put(self, user_id, query, rows, generation):
+        # Полный список можно фильтровать для более длинных запросов.
+        complete = len(rows) <= self.max_rows
+        with self._lock:
+            # Записки изменились, пока мы читали базу, — не кэшируем.
+            if self._generations.get(user_id, 0) != generation:
+                return
+            self._store((user_id, query), rows[:self.max_rows], complete)
+
+    def invalidate(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._generations[user_id] = (
+                    self._generations.get(user_id, 0) + 1)
+                for key in self._by_user.pop(user_id, ()):
+                    self._entries.pop(key, None)
+
+    def _lookup(self, user_id, query):
+        entry = self._entries.get((user_id, query))
+        if entry is not None:
+            self._entries.move_to_end((user_id, query))
+            return entry[0]
+        if not query:
+            return None
+        # Результаты «моло» — подмножество результатов «мол» в том же
+        # порядке: inline-поиск сортирует по id, а не по рангу.
+        prefixes = query.split(' ')
+        for end in range(len(query) - 1, -1, -1):
+            entry = self._entries.get((user_id, query[:end]))
+            if entry is None or not entry[1]:
+                continue
+            rows = [row for row in entry[0] if matches(row[1], prefixes)]
+            self._store((user_id, query), rows, True)
+            return rows
+        return None
+
+    def _store(self, key, rows, complete):
+        self._entries[key] = (rows, complete)
+        self._entries.move_to_end(key)
+        self._by_user.setdefault(key[0], set()).add(key)
+        while len(self._entries) > self.max_size:
+            old, _ = self._entries.popitem(last=False)
+            keys = self._by_user.get(old[0])
+            if keys is not None:
+                keys.discard(old)
+                if not keys:
+                    del self._by_user[old[0]]
@@ -1,21 +1,129 @@
+import atexit
+import json
 import logging
 import logging.config
+import logging.handlers
+import queue
+import sys
+import threading
+
+from constants import (LOG_FORMAT, LOG_QUEUE_SIZE, LOG_SAMPLE_BURST,
+                       LOG_SAMPLE_WINDOW)
+
+TEXT_FORMAT = ('[%(asctime)s] [%(name)s] [%(levelname)s] [%(funcName)s] '
+               '[%(lineno)d] > %(message)s')
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'func': record.funcName,
+            'line': record.lineno,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+
+    # Каждое место вызова пишет DEBUG и INFO не чаще burst раз за window
+    # секунд; число пропущенных допишется к первой записи следующего окна.
+    def __init__(self, burst=LOG_SAMPLE_BURST, window=LOG_SAMPLE_WINDOW,
+                 level=logging.WARNING):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.level = level
+        self._sites = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= self.level or not self.burst:
+            return True
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or record.created - site[0] >= self.window:
+                suppressed = site[2] if site is not None else 0
+                self._sites[key] = [record.created, 1, 0]
+            elif site[1] < self.burst:
+                site[1] += 1
+                return True
+            else:
+                site[2] += 1
+                return False
+        if suppressed:
+            record.msg = (f'{record.getMessage()} '
+                          f'[пропущено похожих: {suppressed}]')
+            record.args = None
+        return True
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._reported = 0
+
+    def prepare(self, record):
+        # Форматирует и пишет слушатель в своём потоке; здесь только
+        # подставляем аргументы, пока они не изменились.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Медленный вывод не должен ни останавливать обработчики,
+            # ни копить записи без предела.
+            self.dropped += 1
+            return
+        if self.dropped != self._reported:
+            lost = self.dropped - self._reported
+            self._reported = self.dropped
+            warning = logging.LogRecord(
+                __name__, logging.WARNING, __file__, 0,
+                f'Очередь логов была переполнена, потеряно записей: {lost}',
+                None, None)
+            try:
+                self.queue.put_nowait(warning)
+            except queue.Full:
+                pass
+
+
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+# В консоль пишет только слушатель очереди, в своём потоке.
+console = logging.StreamHandler(sys.stdout)
+if LOG_FORMAT == 'json':
+    console.setFormatter(JsonFormatter(datefmt=DATE_FORMAT))
+else:
+    console.setFormatter(logging.Formatter(TEXT_FORMAT, DATE_FORMAT))
+listener = logging.handlers.QueueListener(log_queue, console)
 
 logging.config.dictConfig({
     'version': 1,
-    'formatters': {
-        'default': {
-            'format': '[%(asctime)s] [%(name)s] [%(levelname)s] [%(funcName)s] [%(lineno)d] > %(message)s',
-            'datefmt': '%Y-%m-%d %H:%M:%S'
-        }
+    'filters': {
+        'sampling': {
+            '()': SamplingFilter,
+        },
     },
     'handlers': {
-        'console': {
-            'class': 'logging.StreamHandler',
-            'level': 'DEBUG',
-            'formatter': 'default',
-            'stream': 'ext://sys.stdout'
-        }
+        'queue': {
+            '()': BoundedQueueHandler,
+            'log_queue': log_queue,
+            'filters': ['sampling'],
+        },
     },
     'loggers': {
         'requests': {
@@ -33,6 +141,8 @@ logging.config.dictConfig({
     },
     'root': {
         'level': 'INFO',
-        'handlers': ['console']
+        'handlers': ['queue']
     }
 })
+listener.start()
+atexit.register(listener.stop)
@@ -0,0 +1,225 @@
+import functools
+import logging
+import threading
+import time
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import queries
+from constants import METRICS_HOST, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+# Верхние границы корзин в секундах; последняя корзина — всё, что дольше.
+BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+          1.0, 2.5, 5.0, 10.0)
+# Непохожих запросов (PRAGMA с числом и т.п.) в кэше не больше этого.
+MAX_SQL_NAMES = 1000
+
+
+def percentile(counts, q):
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank = q * total
+    seen = 0
+    for index, count in enumerate(counts):
+        if count and seen + count >= rank:
+            if index == len(BOUNDS):
+                return BOUNDS[-1]
+            lower = BOUNDS[index - 1] if index else 0.0
+            return lower + (BOUNDS[index] - lower) * (rank - seen) / count
+        seen += count
+    return BOUNDS[-1]
+
+
+class Histogram:
+
+    __slots__ = ('kind', 'name', 'counts', 'errors', 'total', '_lock')
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.errors = 0
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, error=False):
+        index = bisect_left(BOUNDS, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.total += seconds
+            if error:
+                self.errors += 1
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.errors, self.total
+
+
+class Metrics:
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._histograms = {}
+        self._gauges = {}
+        self._sql = {}
+        self._lock = threading.Lock()
+        self._statements = {sql: name for name, sql in queries.statements()}
+
+    def histogram(self, kind, name):
+        histogram = self._histograms.get((kind, name))
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(
+                    (kind, name), Histogram(kind, name))
+        return histogram
+
+    def gauge(self, name, func):
+        self._gauges[name] = func
+
+    def wrap(self, kind, name, func):
+        # Гистограмма выбирается один раз, при вызове — только два замера.
+        histogram = self.histogram(kind, name)
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                histogram.observe(time.perf_counter() - start, True)
+                raise
+            histogram.observe(time.perf_counter() - start)
+            return result
+
+        timed.instrumented = True
+        return timed
+
+    def sql(self, sql):
+        histogram = self._sql.get(sql)
+        if histogram is None:
+            name = self._statements.get(sql)
+            if name is None:
+                name = sql.split(None, 1)[0].upper() if sql.strip() else '?'
+            histogram = self.histogram('sql', name)
+            if len(self._sql) < MAX_SQL_NAMES:
+                self._sql[sql] = histogram
+        return histogram
+
+    def instrument_bot(self, bot):
+        for kind in ('message_handlers', 'edited_message_handlers',
+                     'callback_query_handlers', 'inline_handlers'):
+            for handler in getattr(bot, kind):
+                func = handler['function']
+                if not getattr(func, 'instrumented', False):
+                    handler['function'] = self.wrap(
+                        'handler', func.__name__, func)
+
+    def rows(self):
+        with self._lock:
+            histograms = list(self._histograms.values())
+        rows = []
+        for histogram in histograms:
+            counts, errors, total = histogram.snapshot()
+            if sum(counts):
+                rows.append((histogram, counts, errors, total))
+        # Сначала то, на что в сумме ушло больше всего времени.
+        rows.sort(key=lambda row: row[3], reverse=True)
+        return rows
+
+    def gauges(self):
+        values = {}
+        for name, func in list(self._gauges.items()):
+            try:
+                values[name] = func()
+            except Exception as error:
+                logger.warning(f'Не удалось снять метрику {name}: {error}')
+        return values
+
+    def render(self):
+        lines = ['# TYPE bot_latency_seconds histogram']
+        for histogram, counts, errors, total in self.rows():
+            labels = f'kind="{histogram.kind}",name="{histogram.name}"'
+            seen = 0
+            for bound, count in zip(BOUNDS + ('+Inf',), counts):
+                seen += count
+                lines.append(f'bot_latency_seconds_bucket{{{labels},'
+                             f'le="{bound}"}} {seen}')
+            lines.append(f'bot_latency_seconds_sum{{{labels}}} {total:.6f}')
+            lines.append(f'bot_latency_seconds_count{{{labels}}} {seen}')
+            lines.append(f'bot_errors_total{{{labels}}} {errors}')
+        for name, value in self.gauges().items():
+            lines.append(f'bot_{name} {value}')
+        lines.append(f'bot_uptime_seconds {time.time() - self.started_at:.0f}')
+        return '\n'.join(lines) + '\n'
+
+    def describe(self, limit=10, kinds=None):
+        lines = []
+        for histogram, counts, errors, total in self.rows():
+            if kinds is not None and histogram.kind not in kinds:
+                continue
+            count = sum(counts)
+            lines.append(
+                f'{histogram.kind}:{histogram.name} n={count} '
+                f'p50={percentile(counts, 0.5) * 1000:.1f}мс '
+                f'p95={percentile(counts, 0.95) * 1000:.1f}мс '
+                f'p99={percentile(counts, 0.99) * 1000:.1f}мс '
+                f'ошибок={errors / count:.1%}')
+            if len(lines) == limit:
+                break
+        return lines
+
+    def summary(self, limit=5):
+        lines = self.describe(limit)
+        logger.info('Метрики: ' + ('; '.join(lines) or 'нет данных'))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class MetricsServer:
+
+    def __init__(self, metrics, host=METRICS_HOST, port=METRICS_PORT):
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.daemon_threads = True
+        self.server.metrics = metrics
+        self._thread = None
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name='metrics-http',
+            daemon=True)
+        self._thread.start()
+        logger.info(f'Метрики доступны на http://{self.address[0]}:'
+                    f'{self.address[1]}/metrics')
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+registry = Metrics()
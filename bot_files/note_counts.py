@@ -0,0 +1,53 @@
+import threading
+
+from collections import OrderedDict
+
+from constants import NOTE_COUNT_CACHE_SIZE
+
+
+class NoteCounts:
+
+    def __init__(self, max_size=NOTE_COUNT_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # user_id -> {group_id: число записок}, group_id None — все записки.
+        self._counts = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, user_id, group_id):
+        with self._lock:
+            count = self._counts.get(user_id, {}).get(group_id)
+            if count is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._counts.move_to_end(user_id)
+            return count
+
+    def generation(self, user_id):
+        with self._lock:
+            return self._generations.get(user_id, 0)
+
+    def put(self, user_id, group_id, count, generation):
+        with self._lock:
+            # Записки изменились, пока мы считали, — не кэшируем.
+            if self._generations.get(user_id, 0) != generation:
+                return
+            self._counts.setdefault(user_id, {})[group_id] = count
+            self._counts.move_to_end(user_id)
+            while len(self._counts) > self.max_size:
+                self._counts.popitem(last=False)
+
+    def invalidate(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._generations[user_id] = (
+                    self._generations.get(user_id, 0) + 1)
+                self._counts.pop(user_id, None)
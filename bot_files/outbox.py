@@ -0,0 +1,332 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from telebot.apihelper import ApiTelegramException
+
+from metrics import registry
+from constants import (OUTBOX_CHAT_BURST, OUTBOX_CHAT_RATE, OUTBOX_RATE,
+                       OUTBOX_RETRIES, OUTBOX_WORKERS)
+
+logger = logging.getLogger(__name__)
+
+# Ответы на inline-запросы идут вне очередей чатов и раньше всех.
+INLINE = -1
+INTERACTIVE = 0
+NOTIFICATION = 1
+# Методы без chat_id: очередь и лимит ведутся по id пользователя.
+CHATLESS = {'answer_inline_query', 'answer_callback_query'}
+METHODS = ('send_message', 'send_photo', 'delete_message',
+           'edit_message_caption', 'edit_message_text', 'edit_message_media',
+           *CHATLESS)
+
+
+class TokenBucket:
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, now):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class Job:
+
+    __slots__ = ('lane', 'chat_id', 'method', 'args', 'kwargs', 'future',
+                 'replaces', 'key', 'attempts', 'merged')
+
+    def __init__(self, lane, chat_id, method, args, kwargs, replaces, key):
+        self.lane = lane
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.replaces = replaces
+        self.key = key
+        self.attempts = 0
+        self.merged = []
+
+
+class Outbox:
+
+    def __init__(self, bot, rate=OUTBOX_RATE, chat_rate=OUTBOX_CHAT_RATE,
+                 chat_burst=OUTBOX_CHAT_BURST, workers=OUTBOX_WORKERS,
+                 retries=OUTBOX_RETRIES):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.retries = retries
+        self.sent = 0
+        self.coalesced = 0
+        self.throttled = 0
+        self._bucket = TokenBucket(rate, rate)
+        # Гистограммы вызовов выбираются один раз, а не в каждом _call.
+        self._histograms = {
+            method: registry.histogram('api', method) for method in METHODS}
+        self._chat_buckets = {}
+        self._chats = {}
+        self._inline = OrderedDict()
+        self._ready = []
+        self._delayed = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._threads = []
+
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(
+                target=self._worker, name=f'outbox-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads.clear()
+
+    def depth(self):
+        with self._cond:
+            return len(self._inline) + sum(
+                len(jobs) for jobs in self._chats.values())
+
+    def submit(self, method, chat_id, *args, lane=INTERACTIVE,
+               replaces=None, key=None, **kwargs):
+        if method not in CHATLESS:
+            kwargs['chat_id'] = chat_id
+        job = Job(lane, chat_id, method, args, kwargs, replaces, key)
+        with self._cond:
+            if lane == INLINE:
+                self._submit_inline(job)
+                return job.future
+            jobs = self._chats.get(chat_id)
+            if jobs is None:
+                jobs = self._chats[chat_id] = deque()
+                self._push_ready(job)
+            elif self._coalesce(jobs, job):
+                return job.future
+            jobs.append(job)
+            self._cond.notify()
+        return job.future
+
+    def send_message(self, chat_id, text, lane=INTERACTIVE, **kwargs):
+        return self.submit('send_message', chat_id, text=text, lane=lane,
+                           **kwargs)
+
+    def send_photo(self, chat_id, photo, lane=INTERACTIVE, replaces=None,
+                   **kwargs):
+        return self.submit('send_photo', chat_id, photo=photo, lane=lane,
+                           replaces=replaces, **kwargs)
+
+    def delete_message(self, chat_id, message_id, lane=INTERACTIVE):
+        return self.submit('delete_message', chat_id, message_id=message_id,
+                           lane=lane, key=('delete', message_id))
+
+    def edit_message_caption(self, chat_id, message_id, caption, **kwargs):
+        return self.submit('edit_message_caption', chat_id,
+                           message_id=message_id, caption=caption,
+                           key=('edit', message_id), **kwargs)
+
+    def answer_inline_query(self, user_id, inline_query_id, results,
+                            **kwargs):
+        return self.submit('answer_inline_query', user_id, inline_query_id,
+                           results, lane=INLINE, **kwargs)
+
+    def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        return self.submit('edit_message_text', chat_id, text=text,
+                           message_id=message_id, key=('edit', message_id),
+                           **kwargs)
+
+    def edit_message_media(self, chat_id, message_id, media, **kwargs):
+        return self.submit('edit_message_media', chat_id,
+                           message_id=message_id, media=media,
+                           key=('edit', message_id), **kwargs)
+
+    def _submit_inline(self, job):
+        # Пока пользователь печатает, каждый символ — новый запрос. Ответ на
+        # устаревший не нужен: неотправленный заменяется свежим.
+        previous = self._inline.pop(job.chat_id, None)
+        if previous is not None:
+            self.coalesced += 1
+            job.merged.extend(previous.merged)
+            job.merged.append(previous)
+        self._inline[job.chat_id] = job
+        self._cond.notify()
+
+    def _coalesce(self, jobs, job):
+        # Первое задание в очереди чата уже может выполняться, его не трогаем.
+        pending = list(itertools.islice(jobs, 1, None))
+        if job.key is not None:
+            for other in pending:
+                if other.key == job.key:
+                    # Новое изменение того же сообщения заменяет старое.
+                    other.args, other.kwargs = job.args, job.kwargs
+                    self._chain(other, job)
+                    return True
+            if job.key[0] == 'delete':
+                for other in pending:
+                    if other.replaces == job.key[1]:
+                        self._chain(other, job)
+                        return True
+        if job.replaces is not None:
+            for other in pending:
+                if other.key == ('delete', job.replaces):
+                    jobs.remove(other)
+                    job.merged.append(other)
+                    self.coalesced += 1
+        return False
+
+    def _chain(self, target, job):
+        self.coalesced += 1
+        target.merged.append(job)
+
+    def _push_ready(self, job):
+        heapq.heappush(self._ready, (job.lane, next(self._seq), job.chat_id))
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._chat_buckets = {
+                    key: value for key, value in self._chat_buckets.items()
+                    if not value.full(now)}
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, seq, lane, chat_id = heapq.heappop(self._delayed)
+                    heapq.heappush(self._ready, (lane, seq, chat_id))
+                if self._inline or self._ready:
+                    wait = self._bucket.reserve(now)
+                    if wait > 0:
+                        self.throttled += 1
+                        self._cond.wait(wait)
+                        continue
+                    if self._inline:
+                        # Лимит чата на ответы inline не действует.
+                        return self._inline.popitem(last=False)[1]
+                    lane, seq, chat_id = heapq.heappop(self._ready)
+                    wait = self._chat_bucket(chat_id, now).reserve(now)
+                    if wait > 0:
+                        # Общий токен не израсходован на этот чат — вернём.
+                        self._bucket.tokens += 1
+                        self.throttled += 1
+                        heapq.heappush(
+                            self._delayed, (now + wait, seq, lane, chat_id))
+                        continue
+                    return self._chats[chat_id][0]
+                if self._stopped and not self._delayed:
+                    return None
+                timeout = None
+                if self._delayed:
+                    timeout = self._delayed[0][0] - now
+                self._cond.wait(timeout)
+
+    def _finish(self, job, retry_after=None):
+        with self._cond:
+            if job.lane == INLINE:
+                return
+            jobs = self._chats[job.chat_id]
+            if retry_after is not None:
+                heapq.heappush(self._delayed, (
+                    time.monotonic() + retry_after, next(self._seq),
+                    job.lane, job.chat_id))
+            else:
+                jobs.popleft()
+                if jobs:
+                    self._push_ready(jobs[0])
+                else:
+                    del self._chats[job.chat_id]
+            self._cond.notify()
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            job.attempts += 1
+            try:
+                result = self._call(job.method, *job.args, **job.kwargs)
+            except ApiTelegramException as error:
+                # Повторять ответ inline бессмысленно: к тому времени
+                # пользователь уже набрал другой запрос.
+                if (error.error_code == 429 and job.lane != INLINE
+                        and job.attempts <= self.retries):
+                    retry_after = error.result_json.get(
+                        'parameters', {}).get('retry_after', 1)
+                    logger.warning(f'Telegram просит подождать {retry_after} '
+                                   f'с перед отправкой в {job.chat_id}')
+                    self._finish(job, retry_after)
+                    continue
+                self._finish(job)
+                self._fail(job, error)
+                continue
+            except Exception as error:
+                self._finish(job)
+                self._fail(job, error)
+                continue
+            self.sent += 1
+            if job.replaces is not None:
+                self._delete(job.chat_id, job.replaces)
+            self._finish(job)
+            self._resolve(job, result)
+
+    def _delete(self, chat_id, message_id):
+        try:
+            self._call('delete_message', chat_id, message_id)
+        except Exception as error:
+            logger.warning(f'Не удалось удалить сообщение: {error}')
+
+    def _call(self, method, *args, **kwargs):
+        histogram = self._histograms.get(method)
+        if histogram is None:
+            histogram = self._histograms.setdefault(
+                method, registry.histogram('api', method))
+        start = time.perf_counter()
+        try:
+            result = getattr(self.bot, method)(*args, **kwargs)
+        except Exception:
+            histogram.observe(time.perf_counter() - start, True)
+            raise
+        histogram.observe(time.perf_counter() - start)
+        return result
+
+    def _resolve(self, job, result):
+        job.future.set_result(result)
+        for merged in job.merged:
+            merged.future.set_result(result)
+
+    def _fail(self, job, error):
+        logger.error(f'Ошибка при вызове {job.method}: {error}')
+        job.future.set_exception(error)
+        for merged in job.merged:
+            merged.future.set_exception(error)
@@ -0,0 +1,112 @@
+import logging
+import random
+import threading
+import time
+
+from collections import deque
+
+import queries
+from constants import (PHOTO_CACHE_SIZE, PHOTO_RECENT_SIZE, PHOTO_REUSE,
+                       PHOTO_TOUCH_INTERVAL)
+
+logger = logging.getLogger(__name__)
+
+
+class PhotoCache:
+
+    def __init__(self, db, max_size=PHOTO_CACHE_SIZE,
+                 touch_interval=PHOTO_TOUCH_INTERVAL, reuse=PHOTO_REUSE):
+        self.db = db
+        self.max_size = max_size
+        self.touch_interval = touch_interval
+        self.reuse_ratio = reuse
+        self.hits = 0
+        self.misses = 0
+        # Недавно отправленные file_id: их можно слать без похода к API
+        # картинок, когда бот перегружен.
+        self._recent = deque(maxlen=PHOTO_RECENT_SIZE)
+        # used_at нужен только для вытеснения, поэтому отметки о попаданиях
+        # копятся здесь и пишутся пачкой, а не транзакцией на каждое фото.
+        self._touched = {}
+        self._touched_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._size = self.db.fetchone(queries.COUNT_PHOTOS)[0]
+        # После перезапуска повторно используем то, что уже загружено.
+        for row in reversed(self.db.fetchall(
+                queries.RECENT_PHOTOS, (PHOTO_RECENT_SIZE,))):
+            self._recent.append(row[0])
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, source):
+        row = self.db.fetchone(queries.SELECT_PHOTO, (source,))
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched[source] = int(time.time())
+            touched = None
+            if time.monotonic() - self._touched_at >= self.touch_interval:
+                touched = self._take_touched()
+        if touched:
+            with self.db.transaction() as conn:
+                conn.executemany(queries.TOUCH_PHOTO, touched)
+        return row[0]
+
+    def _take_touched(self):
+        touched = [(used_at, source)
+                   for source, used_at in self._touched.items()]
+        self._touched.clear()
+        self._touched_at = time.monotonic()
+        return touched
+
+    def put(self, source, file_id):
+        now = int(time.time())
+        with self._lock, self.db.transaction() as conn:
+            self._recent.append(file_id)
+            # Перед вытеснением записываем накопленные попадания.
+            touched = self._take_touched()
+            if touched:
+                conn.executemany(queries.TOUCH_PHOTO, touched)
+            updated = conn.execute(
+                queries.UPDATE_PHOTO, (file_id, now, source)).rowcount
+            if not updated:
+                conn.execute(queries.INSERT_PHOTO, (source, file_id, now))
+                self._size += 1
+            if self._size > self.max_size:
+                self._size -= conn.execute(
+                    queries.EVICT_PHOTOS, (self._size - self.max_size,)
+                ).rowcount
+
+    def reuse(self):
+        # URL из пула почти не повторяются, поэтому часть фото намеренно
+        # берём из уже загруженных в Telegram — без новой загрузки.
+        if random.random() >= self.reuse_ratio:
+            return None
+        file_id = self.recent()
+        if file_id is not None:
+            with self._lock:
+                self.hits += 1
+        return file_id
+
+    def discard(self, file_id):
+        with self._lock:
+            try:
+                self._recent.remove(file_id)
+            except ValueError:
+                pass
+
+    def recent(self):
+        with self._lock:
+            if not self._recent:
+                return None
+            return random.choice(self._recent)
+
+    def forget(self, source):
+        with self._lock, self.db.transaction() as conn:
+            self._size -= conn.execute(
+                queries.DELETE_PHOTO, (source,)).rowcount
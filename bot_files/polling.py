@@ -1,160 +1,270 @@
 import logging
 
 import math
-import requests
-import sqlite3
 import time
 
+from callbacks import CallbackRouter
+from conversations import ConversationStore
+from database import Database
+from datetime import datetime
+from digest import Digest
+from dispatcher import UpdateDispatcher
 from exceptions import AlreadyExistsError
-from random import choice
+from fanout import NoteFanout
+from outbox import NOTIFICATION, Outbox
+from images import ImagePool
+from inline_cache import InlineCache, normalize
+from metrics import MetricsServer, registry
+from photo_cache import PhotoCache
+from profiler import UpdateProfiler
+from providers import ProviderManager
+from reminders import (ReminderScheduler, parse_no_reminder,
+                       parse_reminder)
+from repository import Repository
+from scheduler import JobScheduler
+from shedding import LoadShedder
 from telebot import TeleBot, types
-
-from constants import ANIMAL_URLS, BOT_TOKEN, BOSSES
+from webhook import WebhookServer
+from writebehind import WriteBuffer
+
+from constants import (BOSSES, BOT_TOKEN, CONVERSATION_PERSIST,
+                       DIGEST_INTERVAL, DIGEST_OFFSET, EXPIRE_CHUNK,
+                       EXPIRE_INTERVAL, EXPIRE_PAUSE, FANOUT_STATS_LINES,
+                       INLINE_CACHE_TIME, INLINE_PER_PAGE, JOB_JITTER,
+                       JOB_WORKERS, LAST_CURSOR, MEMBERS_PER_PAGE,
+                       METRICS_INTERVAL, METRICS_PORT, PAGINATION_MODE,
+                       POLLING_TIMEOUT, PROFILE_UPDATES, REQUEST_TTL,
+                       SEARCH_PER_PAGE, SHED_INTERVAL, STATS_LINES,
+                       UPDATE_MODE, VACUUM_INTERVAL, VACUUM_PAGES,
+                       WEBHOOK_URL, WRITE_BEHIND)
 import logger_conf
 
 logger = logging.getLogger(__name__)
-bot = TeleBot(token=BOT_TOKEN)
-conn = sqlite3.connect('bot.db', check_same_thread=False)
-conn.execute('PRAGMA foreign_keys = ON')
-cursor = conn.cursor()
+# Обработчики запускает UpdateDispatcher, собственные потоки TeleBot не нужны.
+db = Database()
+writes = WriteBuffer(db) if WRITE_BEHIND else None
+conversations = ConversationStore(db if CONVERSATION_PERSIST else None)
+bot = TeleBot(token=BOT_TOKEN, threaded=False,
+              next_step_backend=conversations)
+repo = Repository(db, writes=writes)
+providers = ProviderManager()
+image_pool = ImagePool(providers.fetch_image)
+photo_cache = PhotoCache(db)
+inline_cache = InlineCache()
+repo.notes_listeners.append(inline_cache.invalidate)
+outbox = Outbox(bot)
+fanout = NoteFanout(repo, outbox)
+digest = Digest(repo, outbox)
+dispatcher = UpdateDispatcher(lambda update: bot.process_new_updates([update]))
+jobs = JobScheduler(JOB_WORKERS)
+profiler = UpdateProfiler(dispatcher)
+shedder = LoadShedder(
+    dispatcher.depth, registry.histogram('update', 'total'))
+router = CallbackRouter()
+registry.gauge('dispatcher_depth', dispatcher.depth)
+registry.gauge('outbox_depth', outbox.depth)
+registry.gauge('outbox_sent_total', lambda: outbox.sent)
+registry.gauge('outbox_coalesced_total', lambda: outbox.coalesced)
+registry.gauge('outbox_throttled_total', lambda: outbox.throttled)
+registry.gauge('photo_cache_hit_rate', lambda: round(photo_cache.hit_rate, 3))
+registry.gauge('user_cache_hit_rate', lambda: round(repo.users.hit_rate, 3))
+registry.gauge('note_count_hit_rate',
+               lambda: round(repo.note_counts.hit_rate, 3))
+registry.gauge('inline_cache_hit_rate',
+               lambda: round(inline_cache.hit_rate, 3))
+registry.gauge('fanout_pending', fanout.pending)
+registry.gauge('fanout_deduplicated_total', lambda: fanout.deduplicated)
+registry.gauge('degraded', lambda: int(shedder.degraded))
+registry.gauge('degraded_transitions_total', lambda: shedder.transitions)
+if writes is not None:
+    registry.gauge('write_buffer_depth', writes.depth)
+for index, updates in enumerate(dispatcher.queues):
+    registry.gauge(f'dispatcher_worker_{index}_depth', updates.qsize)
+    registry.gauge(f'dispatcher_worker_{index}_processed_total',
+                   lambda index=index: dispatcher.processed[index])
+    registry.gauge(f'dispatcher_worker_{index}_utilisation',
+                   lambda index=index: dispatcher.utilisation(index))
+metrics_server = MetricsServer(registry) if METRICS_PORT else None
+
+NO_IMAGE_TEXT = 'Картинки ещё загружаются, попробуйте чуть позже.'
+PAGES = ('groups', 'requests', 'notes', 'members')
+DIRECTIONS = ('next', 'prev')
+
+
+def in_chat(chat_id, func):
+    # Отложенная запись завершается в потоке буфера записи, а продолжение
+    # обработчика должно идти в очереди своего чата.
+    return lambda future: dispatcher.call(chat_id, func, future)
+
+
+def get_current_user(chat_id_t, chat=None):
+    try:
+        user = repo.get_user(chat_id_t)
+        if user is not None and chat is not None and not user.same_chat(chat):
+            # Пользователь сменил имя в Telegram — обновляем запись.
+            repo.update_user(
+                chat_id_t, chat.username, chat.first_name, chat.last_name)
+            user = repo.get_user(chat_id_t)
+        return user
+    except Exception as error:
+        logger.error(f'Ошибка при поиске пользователя: {error}')
 
 
-def db_tables(slug: str, **args):
+def deliver_reminders(rows):
+    for note_id, note, group_name, user_id_t in rows:
+        text = f'⏰ Напоминание: {note}'
+        if group_name:
+            text += f'\nГруппа: {group_name}'
+        outbox.send_message(user_id_t, text, lane=NOTIFICATION)
 
-    if slug == 'users':
-        cursor.execute(
-            'SELECT id FROM users WHERE user_id_t = ?', (args['user_id_t'],)
-        )
-        row = cursor.fetchone()
-        if not row:
-            logger.debug('Добавляем нового пользователя в базу данных')
-            cursor.execute(
-                'INSERT INTO users (user_id_t, user_name, f_name, l_name)'
-                'VALUES (?, ?, ?, ?)',
-                (args['user_id_t'], args['user_name'],
-                 args['f_name'], args['l_name'])
-            )
-        else:
-            raise AlreadyExistsError
-
-    if slug == 'groups':
-        user_id_t = args['owner']['user_id_t']
-        user_id = args['owner']['id']
-        groups = take_groups(user_id_t, user_id=user_id)
-        if args['name'] in [group['name'] for group in groups.values()]:
-            raise AlreadyExistsError
-        else:
-            cursor.execute(
-                'INSERT INTO groups (name, owner_id) VALUES (?, ?)',
-                (args['name'], user_id))
-
-            group_id = cursor.lastrowid
-
-            cursor.execute(
-                'INSERT INTO users_groups (user_id, group_id, add_note)'
-                'VALUES (?, ?, 1)',
-                (user_id, group_id))
-
-    if slug == 'add_request':
-        today = int(time.time())
-        cursor.execute(
-            'INSERT INTO requests (user_id, group_id, date) VALUES (?, ?)',
-            (args['user_id'], args['group_id'], today)
-        )
 
-    if slug == 'add_member':
-        cursor.execute(
-            'INSERT INTO users_groups (user_id, group_id) VALUES (?, ?)',
-            (args['user_id'], args['group_id'])
-        )
+reminders = ReminderScheduler(repo, deliver_reminders)
 
-    if slug == 'add_note':
-        group_id = args.get('group_id')
-        cursor.execute(
-            'INSERT INTO notes (user_id, group_id, note) VALUES (?, ?, ?)',
-            (args['user_id'], group_id, args['note'])
-        )
 
-    conn.commit()
+def reminder_text(remind_at):
+    moment = datetime.fromtimestamp(remind_at).strftime('%d.%m.%Y %H:%M')
+    return f'Напомню {moment}.'
 
 
-def get_current_user(chat_id_t):
-    try:
-        cursor.execute(
-            'SELECT id, user_id_t, user_name, f_name, l_name '
-            'FROM users WHERE user_id_t = ?',
-            [chat_id_t]
-        )
-    except Exception as error:
-        logger.error('Ошибка при поиске пользователя', error)
-        return
-    row = cursor.fetchone()
-    return {
-        'id': row[0],
-        'user_id_t': row[1],
-        'user_name': row[2],
-        'f_name': row[3],
-        'l_name': row[4]
-    }
-
-
-def take_groups(chat, user_id=None):
-    if user_id is None:
-        user_id = get_current_user(chat.id)['id']
-    try:
-        cursor.execute(
-            'SELECT groups.id, groups.name, groups.owner_id,'
-            'users.user_name, users_groups.add_note '
-            'FROM users_groups '
-            'INNER JOIN groups ON users_groups.group_id = groups.id '
-            'INNER JOIN users ON users_groups.user_id = users.id '
-            'WHERE users_groups.user_id = ?', (user_id,))
-    except Exception as error:
-        logger.error('Ошибка при поиске групп', error)
-        return None
-    rows = cursor.fetchall()
-    return {
-        i: {
-            'id': row[0],
-            'name': row[1],
-            'owner_id': row[2],
-            'owner_user_name': row[3],
-            'add_note': row[4]
-        } for i, row in enumerate(rows, 1)}
+def page_buttons(kind, page, pages_count, first_id, last_id, group_id=0):
+    kind = PAGES.index(kind)
+    if page != 1:
+        left = (page - 1, 1, first_id)
+    else:
+        left = (pages_count, 1, LAST_CURSOR)
+    if page != pages_count:
+        right = (page + 1, 0, last_id)
+    else:
+        right = (1, 0, 0)
+    return (
+        types.InlineKeyboardButton("←", callback_data=router.data(
+            'page', kind, *left, group_id or 0)),
+        types.InlineKeyboardButton(
+            f"{str(page)}/{str(pages_count)}",
+            callback_data=router.data('photo')),
+        types.InlineKeyboardButton("→", callback_data=router.data(
+            'page', kind, *right, group_id or 0)),
+    )
 
 
 def check_add_note(group_id, user_id_t):
-    user_id = get_current_user(user_id_t)['id']
-    cursor.execute(
-        'SELECT add_note FROM users_groups WHERE group_id = ? AND user_id = ?',
-        (group_id, user_id)
-    )
-    row = cursor.fetchone()
-    if row and row[0] == 1:
-        return True
-    return False
+    user_id = get_current_user(user_id_t).id
+    return repo.can_add_note(group_id, user_id)
 
 
 def get_new_image():
-    animal, url = choice(list(ANIMAL_URLS.items()))
-    logger.debug(f'Отправляем запрос к API {animal}: {url}')
-    try:
-        response = requests.get(url).json()
-        logger.debug(f'Получен ответ от API {animal}: {response}')
+    return image_pool.take()
+
+
+def cached_photo():
+    # Под нагрузкой не ходим к API картинок и не загружаем новое фото, в
+    # остальное время часть фото берём из уже загруженных.
+    if shedder.degraded:
+        return photo_cache.recent()
+    return photo_cache.reuse()
+
+
+def send_animal_photo(chat_id, **kwargs):
+    file_id = cached_photo()
+    url = get_new_image() if file_id is None else None
+    if url is None:
+        # Пул картинок пуст: шлём недавно отправленное фото, а если его
+        # нет — отвечаем текстом.
+        file_id = file_id or photo_cache.recent()
+        if file_id is not None:
+            return send_cached_photo(chat_id, file_id, **kwargs)
+        text = kwargs.pop('caption', None) or NO_IMAGE_TEXT
+        return outbox.send_message(chat_id, text, **kwargs)
+    return send_photo_source(chat_id, url, photo_cache.get(url), **kwargs)
+
+
+def send_cached_photo(chat_id, file_id, **kwargs):
+    future = outbox.send_photo(chat_id, file_id, **kwargs)
+
+    def sent(future):
+        if future.exception() is not None:
+            logger.warning(f'Не удалось отправить фото по file_id: '
+                           f'{future.exception()}')
+            photo_cache.discard(file_id)
+
+    future.add_done_callback(sent)
+    return future
+
+
+def send_photo_source(chat_id, url, file_id=None, **kwargs):
+    future = outbox.send_photo(chat_id, file_id or url, **kwargs)
+
+    def sent(future):
+        error = future.exception()
+        if error is None:
+            photo_cache.put(url, future.result().photo[-1].file_id)
+            logger.debug(f'Попаданий в кэш фото: {photo_cache.hit_rate:.0%}')
+        elif file_id is not None:
+            logger.warning(f'Не удалось отправить фото по file_id: {error}')
+            photo_cache.forget(url)
+            photo_cache.discard(file_id)
+            send_photo_source(chat_id, url, **kwargs)
+
+    future.add_done_callback(sent)
+    return future
+
+
+def show_page(chat_id, text, buttons, previous_message=None):
+    # Шаги разговора хранят только id сообщения, а не сам объект.
+    previous_id = getattr(previous_message, 'id', previous_message)
+    if previous_id is None or PAGINATION_MODE != 'edit':
+        send_page(chat_id, text, buttons, previous_id)
+        return
 
-    except Exception as err:
-        logger.error(f'При доступе к API возникла ошибка: {err}')
-        new_animal, url = choice(list(ANIMAL_URLS.items()))
-        while animal == new_animal:
-            new_animal, url = choice(list(ANIMAL_URLS.items()))
-        response = requests.get(url).json()
-        logger.debug(f'Получен ответ от API {new_animal}: {response}')
+    def edited(future):
+        error = future.exception()
+        if error is None:
+            return
+        if 'message is not modified' in getattr(error, 'description', ''):
+            return
+        logger.warning(f'Не удалось изменить сообщение: {error}')
+        send_page(chat_id, text, buttons, previous_id)
 
-    if isinstance(response, list):
-        response = response[0]
-    for value in response.values():
-        if value.endswith(('.jpg', '.gif', '.png', '.jpeg')):
-            return value
+    outbox.edit_message_caption(
+        chat_id, previous_id, text, reply_markup=buttons
+    ).add_done_callback(edited)
+
+
+def send_page(chat_id, text, buttons, previous_id=None):
+    if not shedder.degraded:
+        send_animal_photo(chat_id, caption=text, reply_markup=buttons,
+                          replaces=previous_id)
+        return
+    # Под нагрузкой старое сообщение не удаляем, а фото берём из недавно
+    # отправленных или отвечаем одним текстом.
+    file_id = photo_cache.recent()
+    if file_id is not None:
+        outbox.send_photo(chat_id, file_id, caption=text,
+                          reply_markup=buttons)
+    else:
+        outbox.send_message(chat_id, text, reply_markup=buttons)
+
+
+def refresh_photo(message):
+    file_id = cached_photo()
+    url = None
+    if file_id is None:
+        url = get_new_image()
+        file_id = photo_cache.get(url) if url else photo_cache.recent()
+    if file_id is None and url is None:
+        # Показывать нечего, оставляем прежнее фото.
+        return
+    media = types.InputMediaPhoto(
+        file_id or url, caption=message.caption)
+
+    def edited(future):
+        if future.exception() is None and url is not None:
+            photo_cache.put(url, future.result().photo[-1].file_id)
+
+    outbox.edit_message_media(
+        message.chat.id, message.id, media,
+        reply_markup=message.reply_markup
+    ).add_done_callback(edited)
 
 
 def boss_check(chat):
@@ -179,28 +289,26 @@ def start_keyboard():
 def wake_up(message):
     chat = message.chat
     chat_id = chat.id
-    user_data = {'user_id_t': chat_id, 'user_name': chat.username,
-                 'f_name': chat.first_name, 'l_name': chat.last_name}
     try:
         logger.debug('Добавляем пользователя')
-        db_tables('users', **user_data)
+        repo.add_user(chat_id, chat.username, chat.first_name, chat.last_name)
     except AlreadyExistsError:
         pass
     except Exception as error:
-        logger.error('Ошибка при добавлении пользователя', error)
+        logger.error(f'Ошибка при добавлении пользователя: {error}')
     keyboard = start_keyboard()
     text = boss_check(chat) + ('! Спасибо, что вы включили меня!'
                                'Посмотрите, что я вам нашёл.')
-    bot.send_message(chat_id=chat_id, text=text, reply_markup=keyboard,)
-    bot.send_photo(chat.id, get_new_image())
+    outbox.send_message(chat_id, text, reply_markup=keyboard)
+    send_animal_photo(chat.id)
     text_2 = ('Для получения списка команд нажмите /help')
-    bot.send_message(chat_id=chat_id, text=text_2)
+    outbox.send_message(chat_id, text_2)
 
 
 @bot.message_handler(commands=['help'])
 def help(message):
     chat = message.chat
-    bot.send_message(
+    outbox.send_message(
         chat.id,
         '1. Для получения нового изображения нажмите /newanimal.\n\n'
         '2. Для получения списка групп,'
@@ -209,520 +317,807 @@ def help(message):
         '4. Для просмотра своих записок'
         '5. или создания записки для себя нажмите /notes.\n\n'
         '6. Для получения подтверждения на добавление в группу'
-        'нажмите /group_requests.')
+        'нажмите /group_requests.\n\n'
+        '7. Чтобы получить напоминание, начните записку со времени: '
+        '«18:30 текст» или «31.12 18:30 текст».\n\n'
+        '8. Для поиска по запискам нажмите /search и напишите слова.\n\n'
+        '9. Чтобы получать уведомления раз в день одной сводкой, '
+        'нажмите /digest.')
 
 
 @bot.message_handler(commands=['newanimal'])
 def new_animal(message):
     chat = message.chat
-    bot.send_photo(chat.id, get_new_image())
+    send_animal_photo(chat.id)
 
 
 @bot.message_handler(commands=['groups'])
-def groups(message, page=1, previous_message=None):
+def groups(message, page=1, previous_message=None,
+           direction='next', cursor_id=0):
     chat = message.chat
-    groups_dict = take_groups(chat)
+    user = get_current_user(chat.id, chat)
     text = 'Нет групп'
     buttons = types.InlineKeyboardMarkup()
-
-    if groups_dict:
-        pages_count = max(groups_dict.keys())
-        text = (f'Группа: {groups_dict[page]["name"]}\n'
-                f'Cоздал: {groups_dict[page]["owner_user_name"]}')
-        group_id = groups_dict[page]['id']
-        left = page-1 if page != 1 else pages_count
-        right = page+1 if page != pages_count else 1
-        left_button = types.InlineKeyboardButton(
-            "←", callback_data=f'to {left} groups')
-        page_button = types.InlineKeyboardButton(
-            f"{str(page)}/{str(pages_count)}", callback_data='_')
-        right_button = types.InlineKeyboardButton(
-            "→", callback_data=f'to {right} groups')
-        buttons.add(left_button, page_button, right_button)
+    try:
+        pages_count = repo.count_groups(user.id)
+        group = repo.groups_page(user.id, cursor_id, direction)
+    except Exception as error:
+        logger.error(f'Ошибка при поиске групп: {error}')
+        pages_count, group = 0, None
+
+    if group:
+        group = group[0]
+        text = (f'Группа: {group["name"]}\n'
+                f'Cоздал: {group["owner_user_name"]}')
+        group_id = group['id']
+        buttons.add(*page_buttons(
+            'groups', page, pages_count, group_id, group_id))
         button_notes = types.InlineKeyboardButton(
-            "Записки", callback_data=f'notes {group_id}')
-        buttons.add(button_notes)
-        if groups_dict[page]['owner_user_name'] == chat.username:
+            "Записки", callback_data=router.data('notes', group_id))
+        button_notify = types.InlineKeyboardButton(
+            '🔕 Не уведомлять' if group['notify'] else '🔔 Уведомлять',
+            callback_data=router.data(
+                'notify', group_id, page, int(not group['notify'])))
+        buttons.add(button_notes, button_notify)
+        if group['owner_id'] == user.id:
             button_rename = types.InlineKeyboardButton(
-                'Переименовать', callback_data=f'rename {group_id}')
+                'Переименовать',
+                callback_data=router.data('rename', group_id))
             button_delete = types.InlineKeyboardButton(
-                'Удалить', callback_data=f'delete groups {group_id}')
+                'Удалить', callback_data=router.data('delete_group', group_id))
             button_members = types.InlineKeyboardButton(
-                'Участники', callback_data=f'members {group_id}')
+                'Участники', callback_data=router.data('members', group_id))
+            button_invite = types.InlineKeyboardButton(
+                'Пригласить', callback_data=router.data('invite', group_id))
             buttons.add(button_rename, button_delete,
-                        button_members)
+                        button_members, button_invite)
         else:
             button_delete_member = types.InlineKeyboardButton(
                 'Покинуть группу',
-                callback_data=f'delete_member {group_id} me'
+                callback_data=router.data('delete_member', group_id, 0)
             )
             buttons.add(button_delete_member)
-    bot.send_photo(chat.id, photo=get_new_image(),
-                   caption=text, reply_markup=buttons)
-    try:
-        bot.delete_message(message.chat.id, previous_message.id)
-    except AttributeError:
-        pass
+    show_page(chat.id, text, buttons, previous_message)
 
 
 @bot.message_handler(commands=['group_requests'])  # check
-def requests_check(message, page=1, previous_message=None):
+def requests_check(message, page=1, previous_message=None,
+                   direction='next', cursor_id=0):
     chat = message.chat
-    user = get_current_user(chat.id)
-    groups_requests = {}
-
+    user = get_current_user(chat.id, chat)
+    rows = []
     try:
-        cursor.execute(
-            'SELECT groups.id, groups.name, groups.owner_id, '
-            'users.user_name, users.user_id_t '
-            'FROM requests '
-            'INNER JOIN groups ON requests.group_id = groups.id '
-            'INNER JOIN users ON groups.owner_id = users.id '
-            'WHERE requests.user_id = ?',
-            (user['id'],)
-        )
-        requests = cursor.fetchall()
+        pages_count = repo.count_requests(user.id)
+        rows = repo.requests_page(user.id, cursor_id, direction)
     except Exception as error:
         logger.error(error)
     text = 'Нет запросов'
     buttons = types.InlineKeyboardMarkup()
 
-    if requests:
-        groups_requests = enumerate(requests, 1)
-        pages_count = len(requests)
-        text = f'Группа: {groups_requests[page][1]}, создал: {groups[page][3]}'
-        left = page-1 if page != 1 else pages_count
-        right = page+1 if page != pages_count else 1
-        left_button = types.InlineKeyboardButton(
-            "←", callback_data=f'to {left} requests')
-        page_button = types.InlineKeyboardButton(
-            f"{str(page)}/{str(pages_count)}", callback_data='_')
-        right_button = types.InlineKeyboardButton(
-            "→", callback_data=f'to {right} requests')
-        buttons.add(left_button, page_button, right_button)
+    if rows:
+        request = rows[0]
+        text = f'Группа: {request[2]}, создал: {request[3]}'
+        buttons.add(*page_buttons(
+            'requests', page, pages_count, request[0], request[0]))
 
         add_button = types.InlineKeyboardButton(
             'Принять запрос',
-            callback_data=(
-                'add_request'
-                f'{groups_requests[page][0]} {groups_requests[page][4]}')
+            callback_data=router.data('add_request', request[1], request[4])
         )
         buttons.add(add_button)
 
-    bot.send_photo(chat.id, photo=get_new_image(),
-                   caption=text, reply_markup=buttons)
-    try:
-        bot.delete_message(message.chat.id, previous_message.id)
-    except AttributeError:
-        pass
+    show_page(chat.id, text, buttons, previous_message)
 
 
 @bot.message_handler(commands=['notes'])
-def notes(message, page=1, previous_message=None, group_id=None):
+def notes(message, page=1, previous_message=None, group_id=None,
+          direction='next', cursor_id=0):
     chat = message.chat
-    user = get_current_user(chat.id)
-    group_id = (None, None)
+    user = get_current_user(chat.id, chat)
     text = 'Нет записок'
     buttons = types.InlineKeyboardMarkup()
+    rows = []
     try:
-        if group_id:
-            cursor.execute(
-                'SELECT notes.note, notes.id, groups.name,'
-                ' groups.id, users_groups.add_note, notes.user_id '
-                'FROM users_groups '
-                'INNER JOIN groups ON users_groups.group_id = groups.id '
-                'INNER JOIN notes ON groups.id = notes.group_id '
-                'WHERE (user_id = ? AND group_id = ?) OR notes.user_id = ?',
-                (user['id'], group_id, user['id']))
-        else:
-            cursor.execute(
-                'SELECT notes.note, notes.id, groups.name,'
-                ' groups.id, users_groups.add_note, notes.user_id '
-                'FROM users_groups '
-                'INNER JOIN groups ON users_groups.group_id = groups.id '
-                'INNER JOIN notes ON groups.id = notes.group_id '
-                'WHERE user_id = ? OR notes.user_id = ?',
-                (user['id'], user['id']))
+        pages_count = repo.count_notes(user.id, group_id)
+        rows = repo.notes_page(user.id, cursor_id, direction, group_id)
     except Exception as error:
         logger.error(error)
-    finally:
-        rows = cursor.fetchall()
-
-        if rows:
-            notes_num = enumerate(rows)
-            pages_count = len(rows)
-            text = f'{notes_num[page][0]}'
-            if notes_num[page][2]:
-                text += f'\n Из Группы: {notes_num[page][2]}'
-            left = page-1 if page != 1 else pages_count
-            right = page+1 if page != pages_count else 1
-            left_button = types.InlineKeyboardButton(
-                "←", callback_data=f'to {left} notes')
-            page_button = types.InlineKeyboardButton(
-                f"{str(page)}/{str(len(groups))}", callback_data='_')
-            right_button = types.InlineKeyboardButton(
-                "→", callback_data=f'to {right} notes')
-            buttons.add(left_button, page_button, right_button)
-            if notes_num[page][4] or notes_num[page][5] == user['id']:
-                change_button = types.InlineKeyboardButton(
-                    'Изменить заметку',
-                    callback_data=f'change_note {notes_num[page][1]}')
-                delete_button = types.InlineKeyboardButton(
-                    'Удалить заметку',
-                    callback_data=f'delete notes {notes_num[page][1]}')
-                buttons.add(change_button, delete_button)
-            new_note = types.InlineKeyboardButton(
-                'Создать заметку', callback_data='add_note me')
-            if notes_num[page][4]:
-                button_add_group = types.InlineKeyboardButton(
-                    'Создать заметку в группу',
-                    callback_data=f'add_note {notes_num[page][3]}')
-                buttons.add(new_note, button_add_group)
-            else:
-                buttons.add(new_note)
-    bot.send_photo(chat.id, photo=get_new_image(),
-                   caption=text, reply_markup=buttons)
 
-    try:
-        bot.delete_message(message.chat.id, previous_message.id)
-    except AttributeError:
-        pass
+    if rows:
+        note = rows[0]
+        text = f'{note[1]}'
+        if note[2]:
+            text += f'\n Из Группы: {note[2]}'
+        buttons.add(*page_buttons(
+            'notes', page, pages_count, note[0], note[0], group_id))
+        if note[4] or note[5] == user.id:
+            change_button = types.InlineKeyboardButton(
+                'Изменить заметку',
+                callback_data=router.data('change_note', note[0]))
+            delete_button = types.InlineKeyboardButton(
+                'Удалить заметку',
+                callback_data=router.data('delete_note', note[0]))
+            buttons.add(change_button, delete_button)
+    new_note = types.InlineKeyboardButton(
+        'Создать заметку', callback_data=router.data('add_note', 0))
+    if group_id and check_add_note(group_id, chat.id):
+        button_add_group = types.InlineKeyboardButton(
+            'Создать заметку в группу',
+            callback_data=router.data('add_note', group_id))
+        buttons.add(new_note, button_add_group)
+    else:
+        buttons.add(new_note)
+    show_page(chat.id, text, buttons, previous_message)
 
 
-def members(message, page=1, previous_message=None, group_id=None):
+def members(message, page=1, previous_message=None, group_id=None,
+            direction='next', cursor_id=0):
     chat = message.chat
+    rows = []
     try:
-        cursor.execute(
-            'SELECT users_groups.group_id, groups.name,'
-            ' users.user_name, users.user_id_t '
-            'FROM users_groups '
-            'INNER JOIN groups ON users_groups.group_id = groups.id '
-            'INNER JOIN users ON users_groups.user_id = users.id '
-            'WHERE users_groups.group_id = ?',
-            (group_id,))
-        rows = cursor.fetchall()
+        group_name, members_count = repo.group_members_count(group_id)
+        list_count = math.ceil(members_count / MEMBERS_PER_PAGE)
+        limit = MEMBERS_PER_PAGE
+        if cursor_id == LAST_CURSOR:
+            # С первой страницы «←» ведёт на последнюю, а она может быть
+            # неполной: берём ровно столько, сколько на ней участников.
+            limit = members_count - (list_count - 1) * MEMBERS_PER_PAGE
+        rows = repo.members_page(group_id, cursor_id, direction, limit)
     except Exception as error:
         logger.error(error)
     if rows:
         buttons = types.InlineKeyboardMarkup()
-        members = enumerate(rows, 1)
-        pages_count = len(rows)
-        text = 'Всего участников: ' + str(pages_count)
-        end_list = pages_count if pages_count < page*10 else page*10
-        current_list = list(members)[page*10-10:end_list]
-        list_count = math.ceil(pages_count/10)
-        left = page-1 if page != 1 else list_count
-        right = page+1 if page != list_count else 1
-        left_button = types.InlineKeyboardButton(
-            "←", callback_data=f'to {left} members')
-        page_button = types.InlineKeyboardButton(
-            f"{str(page)}/{str(list_count)}", callback_data='_')
-        right_button = types.InlineKeyboardButton(
-            "→", callback_data=f'to {right} members')
-        buttons.add(left_button, page_button, right_button)
-        text += '\n'.join(f'{i}. {member[2]} - {member[1]}' for i,
-                          member in current_list)
-        if len(current_list) > 5:
-            buttons.add(*[types.InlineKeyboardButton(
-                f"{i}", callback_data=f'member {member[0]} {member[3]}'
-            ) for i, member in current_list[:5]])
-            buttons.add(*[types.InlineKeyboardButton(
-                f"{i}", callback_data=f'member {member[0]} {member[3]}'
-            ) for i, member in current_list[5:end_list]])
-        else:
-            buttons.add(*[types.InlineKeyboardButton(
-                f"{i}", callback_data=f'member {member[0]} {member[3]}'
-            ) for i, member in current_list[:end_list]])
-        text += ('\n' + 'Выберете участника чтобы его удалить'
+        buttons.add(*page_buttons(
+            'members', page, list_count, rows[0][0], rows[-1][0], group_id))
+        first = (page - 1) * MEMBERS_PER_PAGE + 1
+        current_list = list(enumerate(rows, first))
+        text = (f'Группа: {group_name}\n'
+                f'Всего участников: {members_count}\n')
+        text += '\n'.join(f'{i}. {member[1]}' for i, member in current_list)
+        member_buttons = [types.InlineKeyboardButton(
+            f"{i}", callback_data=router.data('member', group_id, member[2])
+        ) for i, member in current_list]
+        buttons.add(*member_buttons[:5])
+        if len(member_buttons) > 5:
+            buttons.add(*member_buttons[5:])
+        text += ('\n' + 'Выберете участника чтобы его удалить '
                  'или передать владение группой.')
-        bot.send_photo(chat.id, photo=get_new_image(),
-                       caption=text, reply_markup=buttons)
+        show_page(chat.id, text, buttons, previous_message)
+
+
+@bot.message_handler(commands=['search'])
+def search(message):
+    chat = message.chat
+    text = message.text.partition(' ')[2].strip()
+    if text:
+        show_search(chat, text)
+        return
+    outbox.send_message(chat.id, 'Напишите, что найти в записках')
+    bot.register_next_step_handler(message, search_text)
+
+
+@conversations.step
+def search_text(message):
+    show_search(message.chat, message.text)
+
+
+def show_search(chat, text, page=1, previous_id=None, direction='next',
+                cursor=None):
+    user = get_current_user(chat.id, chat)
+    rows = []
     try:
-        bot.delete_message(message.chat.id, previous_message.id)
-    except AttributeError:
-        pass
+        rows = repo.search_notes(
+            user.id, text, cursor, direction, SEARCH_PER_PAGE + 1)
+    except Exception as error:
+        logger.error(f'Ошибка при поиске записок: {error}')
+    # Лишняя строка показывает, есть ли страница дальше по направлению.
+    more = len(rows) > SEARCH_PER_PAGE
+    if direction == 'prev':
+        rows = rows[-SEARCH_PER_PAGE:]
+        has_prev, has_next = more, True
+    else:
+        rows = rows[:SEARCH_PER_PAGE]
+        has_prev, has_next = page > 1, more
+    buttons = types.InlineKeyboardMarkup()
+    if not rows:
+        result = f'По запросу «{text}» ничего не найдено.'
+    else:
+        first = (page - 1) * SEARCH_PER_PAGE + 1
+        lines = []
+        for i, (note_id, snippet, group_name, _, _) in enumerate(
+                rows, first):
+            line = f'{i}. {snippet}'
+            if group_name:
+                line += f' (Группа: {group_name})'
+            lines.append(line)
+        result = f'Найдено по запросу «{text}»:\n\n' + '\n'.join(lines)
+        navigation = []
+        if has_prev:
+            navigation.append(types.InlineKeyboardButton(
+                '←', callback_data=router.data(
+                    'search', text, page - 1, DIRECTIONS.index('prev'),
+                    repr(rows[0][4]), rows[0][0])))
+        if has_next:
+            navigation.append(types.InlineKeyboardButton(
+                '→', callback_data=router.data(
+                    'search', text, page + 1, DIRECTIONS.index('next'),
+                    repr(rows[-1][4]), rows[-1][0])))
+        buttons.add(*navigation)
+    if previous_id is None:
+        outbox.send_message(chat.id, result, reply_markup=buttons)
+    else:
+        outbox.edit_message_text(
+            chat.id, previous_id, result, reply_markup=buttons)
+
+
+@bot.inline_handler(func=lambda query: True)
+def inline_notes(query):
+    user = get_current_user(query.from_user.id)
+    if user is None:
+        outbox.answer_inline_query(
+            query.from_user.id, query.id, [], cache_time=INLINE_CACHE_TIME,
+            is_personal=True, button=types.InlineQueryResultsButton(
+                'Сначала запустите бота', start_parameter='start'))
+        return
+    text = normalize(query.query)
+    offset = query.offset or ''
+    before = int(offset) if offset.isdigit() else None
+    page = []
+    try:
+        rows = inline_cache.get(user.id, text)
+        if rows is None:
+            generation = inline_cache.generation(user.id)
+            rows = repo.inline_notes(
+                user.id, text, limit=inline_cache.max_rows + 1)
+            inline_cache.put(user.id, text, rows, generation)
+        start = 0
+        if before is not None:
+            start = next((i + 1 for i, row in enumerate(rows)
+                          if row[0] == before), None)
+        if start is not None and (
+                start + INLINE_PER_PAGE < len(rows)
+                or len(rows) < inline_cache.max_rows):
+            page = rows[start:start + INLINE_PER_PAGE + 1]
+        else:
+            # Дальние страницы в кэш не попадают, читаем их из базы.
+            page = repo.inline_notes(
+                user.id, text, before, INLINE_PER_PAGE + 1)
+    except Exception as error:
+        logger.error(f'Ошибка при поиске записок: {error}')
+    results = [
+        types.InlineQueryResultArticle(
+            id=str(note_id), title=note[:64],
+            description=f'Группа: {group_name}' if group_name else None,
+            input_message_content=types.InputTextMessageContent(note))
+        for note_id, note, group_name in page[:INLINE_PER_PAGE]]
+    next_offset = ''
+    if len(page) > INLINE_PER_PAGE:
+        # Курсор — id последней показанной записки.
+        next_offset = str(page[INLINE_PER_PAGE - 1][0])
+    outbox.answer_inline_query(
+        query.from_user.id, query.id, results, cache_time=INLINE_CACHE_TIME,
+        is_personal=True, next_offset=next_offset)
+
+
+@bot.message_handler(commands=['digest'])
+def toggle_digest(message):
+    chat = message.chat
+    user = get_current_user(chat.id, chat)
+    try:
+        repo.set_digest(chat.id, not user.digest)
+    except Exception as error:
+        logger.error(f'Ошибка при смене режима уведомлений: {error}')
+        outbox.send_message(chat.id, 'Ой, ошибка, попробуйте ещё раз.')
+        return
+    if user.digest:
+        text = 'Уведомления снова приходят сразу.'
+    else:
+        text = 'Уведомления будут приходить раз в день одной сводкой.'
+    outbox.send_message(chat.id, text)
+
+
+@bot.message_handler(commands=['stats'],
+                     func=lambda message: message.chat.id in BOSSES)
+def stats(message):
+    lines = registry.describe(STATS_LINES) or ['Замеров пока нет.']
+    lines.append('')
+    for item in fanout.progress()[-FANOUT_STATS_LINES:]:
+        total = '?' if item['total'] is None else item['total']
+        state = 'готово' if item['finished_at'] else 'идёт'
+        lines.append(
+            f'Рассылка записки {item["note_id"]} ({item["group_name"]}): '
+            f'{item["sent"]}/{total}, ошибок {item["failed"]}, {state}')
+    lines.append('')
+    lines.extend(
+        f'{name}: {value}' for name, value in registry.gauges().items())
+    # Telegram не примет сообщение длиннее 4096 символов.
+    outbox.send_message(message.chat.id, '\n'.join(lines)[:4096])
+
+
+@bot.message_handler(commands=['profile'],
+                     func=lambda message: message.chat.id in BOSSES)
+def profile(message):
+    chat_id = message.chat.id
+    args = message.text.split()[1:]
+    if args == ['stop']:
+        profiler.stop()
+        return
+    # /profile 500 — на 500 обновлений, /profile 30s — на 30 секунд.
+    updates, seconds = PROFILE_UPDATES, None
+    if args and args[0].endswith('s') and args[0][:-1].isdigit():
+        updates, seconds = None, int(args[0][:-1])
+    elif args and args[0].isdigit():
+        updates = int(args[0])
+    elif args:
+        outbox.send_message(chat_id, 'Формат: /profile [N | Ns | stop]')
+        return
+    if not profiler.start(
+            lambda text: outbox.send_message(chat_id, text[:4096]),
+            updates, seconds):
+        outbox.send_message(chat_id, 'Профилирование уже идёт.')
+        return
+    window = f'{seconds} с' if seconds else f'{updates} обновлений'
+    outbox.send_message(chat_id, f'Профилирую {window}.')
 
 
 @bot.message_handler(commands=['newgroup'])
 def add_group(message):
     chat = message.chat
-    bot.send_message(chat.id, 'Напишите название группы')
+    outbox.send_message(chat.id, 'Напишите название группы')
     bot.register_next_step_handler(message, add_group_name)
 
 
 @bot.callback_query_handler(func=lambda c: True)
 def callback(c):
-    data = c.data.split(' ')
-    func_back_dict = {'groups': groups,
-                      'requests': requests_check,
-                      'notes': notes,
-                      'members': members, }
-    if data[0] == 'to':
-        page = int(data[1])
-        func_back_dict[data[2]](c.message, page=page,
-                                previous_message=c.message)
-    elif data[0] == 'add_request':
-        add_member(c.message, group_id=data[1], owner_id_t=data[2])
+    if not router.dispatch(c):
+        outbox.send_message(c.message.chat.id,
+                            'Кнопка устарела, откройте список заново.')
+
+
+@router.action('photo', 1)
+def on_photo(c):
+    refresh_photo(c.message)
+
+
+@router.action('page', 2, int, int, int, int, int)
+def on_page(c, kind, page, direction, cursor_id, group_id):
+    show = (groups, requests_check, notes, members)[kind]
+    extra = {'group_id': group_id} if group_id else {}
+    show(c.message, page=page, previous_message=c.message,
+         direction=DIRECTIONS[direction], cursor_id=cursor_id, **extra)
+
+
+@router.action('add_request', 3, int, int)
+def on_add_request(c, group_id, owner_id_t):
+    add_member(c.message, group_id=group_id, owner_id_t=owner_id_t)
+
+
+@router.action('invite', 17, int)
+def on_invite(c, group_id):
+    outbox.send_message(c.message.chat.id,
+                        'Напишите @username или id пользователя')
+    bot.register_next_step_handler(c.message, add_request, group_id)
+
 
-    elif data[0] == 'notes':
-        notes(c.message, previous_message=c.message, group_id=data[1])
+@router.action('notes', 4, int)
+def on_notes(c, group_id):
+    notes(c.message, previous_message=c.message, group_id=group_id)
 
-    elif data[0] == 'rename':
-        bot.send_message(c.message.chat.id,
-                         'Напишите новое название группы или назад')
-        bot.register_next_step_handler(c.message, rename_group, data[1])
 
-    elif data[0] == 'delete':
-        delete(c.message, data[2], data[1])
+@router.action('rename', 5, int)
+def on_rename(c, group_id):
+    outbox.send_message(c.message.chat.id,
+                        'Напишите новое название группы или назад')
+    bot.register_next_step_handler(
+        c.message, rename_group, group_id, c.message.id)
 
-    elif data[0] == 'delete_member':
-        delete_member(c.message, data[1], data[2])
 
-    elif data[0] == 'members':
-        members(c.message, previous_message=c.message, group_id=data[1])
+@router.action('delete_group', 6, int)
+def on_delete_group(c, group_id):
+    delete(c.message, group_id, 'groups')
 
-    elif data[0] == 'member':
-        member_info(c.message, data[1], data[2], previous_message=c.message)
 
-    elif data[0] == 'make_owner':
-        make_owner(c.message, data[1], data[2], data[3],
-                   data[4], previous_message=c.message)
+@router.action('delete_note', 7, int)
+def on_delete_note(c, note_id):
+    delete(c.message, note_id, 'notes')
 
-    elif data[0] == 'change_note':
-        bot.send_message(c.message.chat.id, 'Напишите текст записки или назад')
-        bot.register_next_step_handler(
-            c.message, change_note, data[1], c.message)
 
-    elif data[0] == 'add_note':
-        bot.send_message(c.message.chat.id, 'Напишите текст записки')
-        bot.register_next_step_handler(
-            c.message, add_notes, data[1], c.message)
+@router.action('delete_member', 8, int, int)
+def on_delete_member(c, group_id, user_id_t):
+    delete_member(c.message, group_id, user_id_t or 'me')
 
 
+@router.action('members', 9, int)
+def on_members(c, group_id):
+    members(c.message, previous_message=c.message, group_id=group_id)
+
+
+@router.action('member', 10, int, int)
+def on_member(c, group_id, user_id_t):
+    member_info(c.message, c.message, group_id, user_id_t)
+
+
+@router.action('make_owner', 11, int, int)
+def on_make_owner(c, group_id, user_id_t):
+    make_owner(c.message, group_id, user_id_t, previous_message=c.message)
+
+
+@router.action('change_note', 12, int)
+def on_change_note(c, note_id):
+    outbox.send_message(c.message.chat.id,
+                        'Напишите текст записки или назад. '
+                        'Время в начале, например «18:30 текст», '
+                        'включит напоминание, а «без напоминания текст» '
+                        'снимет его')
+    bot.register_next_step_handler(
+        c.message, change_note, note_id, c.message.id)
+
+
+@router.action('add_note', 13, int)
+def on_add_note(c, group_id):
+    outbox.send_message(c.message.chat.id,
+                        'Напишите текст записки. Время в начале, '
+                        'например «18:30 текст», включит напоминание')
+    bot.register_next_step_handler(
+        c.message, add_notes, group_id or 'me')
+
+
+@router.action('notify', 15, int, int, int)
+def on_notify(c, group_id, page, enabled):
+    user = get_current_user(c.message.chat.id)
+    repo.set_notify(group_id, user.id, enabled)
+    # Курсор на единицу меньше id группы снова покажет эту же группу.
+    groups(c.message, page=page, previous_message=c.message,
+           cursor_id=group_id - 1)
+
+
+@router.action('search', 16, str, int, int, str, int)
+def on_search(c, text, page, direction, rank, note_id):
+    show_search(c.message.chat, text, page, c.message.id,
+                DIRECTIONS[direction], (float(rank), note_id))
+
+
+@conversations.step
 def add_group_name(message):  # check
     chat = message.chat
     group_name = message.text
-    user = get_current_user(chat.id)
+    user = get_current_user(chat.id, chat)
     logger.debug(user)
-    group = {'name': group_name, 'owner': user}
     try:
-        db_tables('groups', **group)
+        repo.create_group(user.id, group_name)
     except AlreadyExistsError:
-        bot.send_message(chat.id, 'Такая группа уже существует.')
+        outbox.send_message(chat.id, 'Такая группа уже существует.')
     except Exception as error:
-        logger.error('Ошибка при добавлении группы', error)
+        logger.error(f'Ошибка при добавлении группы: {error}')
     else:
-        bot.send_message(chat.id, 'Группа добавлена!')
+        outbox.send_message(chat.id, 'Группа добавлена!')
 
 
-def change_note(message, note_id, previous_message):
+@conversations.step
+def change_note(message, note_id, previous_id):
     chat = message.chat
     new_name = message.text
     if new_name.lower() == 'назад':
         pass
     else:
         try:
-            cursor.execute(
-                'UPDATE notes SET text = ? WHERE id = ?',
-                (new_name, note_id)
-            )
+            cancel, new_name = parse_no_reminder(new_name)
+            remind_at, previous = None, None
+            if cancel:
+                repo.update_note_no_reminder(note_id, new_name)
+            else:
+                remind_at, new_name = parse_reminder(new_name)
+                previous = repo.update_note(note_id, new_name, remind_at)
+            fanout.notify(int(note_id), get_current_user(chat.id).id,
+                          edited=True)
         except Exception as error:
-            logger.error('Ошибка при изменении записки', error)
-            bot.send_message(chat.id, 'Ой, ошибка, попробуйте ещё раз.')
+            logger.error(f'Ошибка при изменении записки: {error}')
+            outbox.send_message(chat.id, 'Ой, ошибка, попробуйте ещё раз.')
         else:
-            bot.send_message(chat.id, 'Записка изменена!')
-    notes(message, previous_message=previous_message)
-
-
-def rename_group(message, group_id, previous_message):
+            text = 'Записка изменена!'
+            if cancel:
+                text += ' Напоминание снято.'
+            elif remind_at is not None:
+                if remind_at != previous:
+                    reminders.schedule(int(note_id), remind_at)
+                text += f' {reminder_text(remind_at)}'
+            outbox.send_message(chat.id, text)
+    notes(message, previous_message=previous_id)
+
+
+@conversations.step
+def rename_group(message, group_id, previous_id):
     chat = message.chat
     new_name = message.text
     if new_name.lower() == 'назад':
         pass
     else:
         try:
-            cursor.execute(
-                'UPDATE groups SET name = ? WHERE id = ?',
-                (new_name, group_id)
-            )
+            repo.rename_group(group_id, new_name)
         except Exception as error:
             logger.error('Ошибка при переименовании группы', error)
-            bot.send_message(chat.id, 'Ой, ошибка, попробуйте ещё раз.')
+            outbox.send_message(chat.id, 'Ой, ошибка, попробуйте ещё раз.')
         else:
-            bot.send_message(chat.id, 'Группа переименована!')
-    groups(message, previous_message=previous_message)
+            outbox.send_message(chat.id, 'Группа переименована!')
+    groups(message, previous_message=previous_id)
 
 
 def delete(message, id, table):
     chat = message.chat
     try:
-        cursor.execute(
-            f'DELETE FROM {table} WHERE id = ?',
-            (id,)
-        )
+        if table == 'notes':
+            repo.delete_note(id)
+        else:
+            repo.delete_group(id)
     except Exception as error:
-        logger.error('Ошибка при удалении группы', error)
-        bot.send_message(chat.id, 'Ой, ошибка, попробуйте ещё раз.')
+        logger.error(f'Ошибка при удалении: {error}')
+        outbox.send_message(chat.id, 'Ой, ошибка, попробуйте ещё раз.')
+        return
+    if table == 'notes':
+        outbox.send_message(chat.id, 'Записка удалена!')
+        notes(message, previous_message=message)
     else:
-        conn.commit()
-        bot.send_message(chat.id, 'Группа удалена!')
-    groups(message, previous_message=message)
+        outbox.send_message(chat.id, 'Группа удалена!')
+        groups(message, previous_message=message)
 
 
 def delete_member(message, group_id, user_id_t):
     chat = message.chat
     if user_id_t == 'me':
         user_id_t = chat.id
-    user_id = get_current_user(user_id_t)['id']
-    cursor.execute(
-        'SELECT name, owner_id FROM groups WHERE id = ?',
-        (group_id,)
-    )
-    group = cursor.fetchone()
+    user_id = get_current_user(user_id_t).id
+    group = repo.get_group(group_id)
     if group[1] == user_id:
-        bot.send_message(chat.id, 'Нельзя удалять владельца группы!')
+        outbox.send_message(chat.id, 'Нельзя удалять владельца группы!')
         return
     try:
-        cursor.execute(
-            'DELETE FROM users_groups WHERE group_id = ? AND user_id = ?',
-            (group_id, user_id)
-        )
+        repo.remove_member(group_id, user_id)
     except Exception as error:
         logger.error('Ошибка при удалении участника', error)
-        bot.send_message(chat.id, 'Ой, ошибка, попробуйте ещё раз.')
+        outbox.send_message(chat.id, 'Ой, ошибка, попробуйте ещё раз.')
     else:
-        bot.send_message(chat.id, 'Участник удален!')
-        bot.send_message(user_id_t, 'Вас удалили из группы ' + group[0])
+        outbox.send_message(chat.id, 'Участник удален!')
+        digest.notify(user_id_t, 'Вас удалили из группы ' + group[0])
 
     groups(message, previous_message=message)
 
 
-def make_owner(message, group_id, user_id_t,
-               group_name, owner_id_t,
-               previous_message=None):
+def make_owner(message, group_id, user_id_t, previous_message=None):
     chat = message.chat
     user = get_current_user(user_id_t)
-    cursor.execute(
-        'UPDATE groups SET owner_id = ? WHERE group_id = ?',
-        (user['id'], group_id)
-    )
-    bot.send_message(chat.id, 'Вы стали владельцем группы ' + group_name)
-    bot.send_message(owner_id_t, 'Вы перестали владельца группы ' + group_name)
+    group_name = repo.get_group(group_id)[0]
+    repo.change_owner(group_id, user.id)
+    outbox.send_message(chat.id,
+                        'Вы перестали быть владельцем группы ' + group_name)
+    digest.notify(user_id_t, 'Вы стали владельцем группы ' + group_name)
     groups(message, previous_message=previous_message)
 
 
 def member_info(message, previous_message, group_id, user_id_t):
     chat = message.chat
     try:
-        cursor.execute(
-            'SELECT users_groups.group_id, groups.name,'
-            ' users.user_name, users.user_id_t '
-            'FROM users_groups '
-            'INNER JOIN groups ON users_groups.group_id = groups.id '
-            'INNER JOIN users ON users_groups.user_id = users.id '
-            'WHERE users_groups.group_id = ?, users.user_id_t = ?',
-            (group_id, user_id_t))
-        rows = cursor.fetchall()[0]
+        rows = repo.get_member(group_id, user_id_t)
     except Exception as error:
         logger.error('Ошибка при поиске участника', error)
-        bot.send_message(message.chat.id, 'Ой, ошибка, попробуйте ещё раз.')
+        outbox.send_message(chat.id, 'Ой, ошибка, попробуйте ещё раз.')
         return
 
     text = f'Группа: {rows[1]}\n Участник: {rows[2]}'
     buttons = types.InlineKeyboardMarkup()
     delete_button = types.InlineKeyboardButton(
-        'Удалить', callback_data=f'delete_member {group_id} {user_id_t}'
+        'Удалить',
+        callback_data=router.data('delete_member', group_id, user_id_t)
     )
     make_owner = types.InlineKeyboardButton(
         'Сделать владельцем группы',
-        callback_data=f'make_owner {group_id} {user_id_t} {rows[1]} {chat.id}'
+        callback_data=router.data('make_owner', group_id, user_id_t)
     )
     buttons.add(delete_button, make_owner)
-    bot.send_message(message.chat.id, text, reply_markup=buttons)
-    try:
-        bot.delete_message(message.chat.id, previous_message.id)
-    except AttributeError:
-        logger.error('Не удалось удалить предыдущее сообщение')
+    outbox.send_message(
+        chat.id, text, reply_markup=buttons,
+        replaces=None if shedder.degraded else previous_message.id)
 
 
+@conversations.step
 def add_request(message, group_id):
     chat = message.chat
     member = message.text
-    user_slug = 'id_t'
-    user_def = int(member)
-
-    if member.startswith('@'):
-        user_slug = 'name'
-        user_def = member[1:]
     try:
-        cursor.execute(
-            ('SELECT id, user_id_t, user_name'
-             f'FROM users WHERE user_{user_slug} = ?'),
-            (user_def,)
-        )
+        if member.startswith('@'):
+            user = repo.find_user(user_name=member[1:])
+        else:
+            user = repo.find_user(user_id_t=int(member))
     except Exception as error:
         logger.error('Ошибка при  поиске участника', error)
-        bot.send_message(chat.id, 'Ой, такого пользователя нет.')
+        outbox.send_message(chat.id, 'Ой, такого пользователя нет.')
         return
 
-    user = cursor.fetchone()
-
+    if user is None:
+        outbox.send_message(chat.id, 'Ой, такого пользователя нет.')
+        return
     try:
-        cursor.execute(
-            'SELECT name FROM groups WHERE id = ?',
-            (group_id,)
-        )
+        group_name = repo.get_group(group_id)[0]
     except Exception as error:
         logger.error('Ошибка при поиске группы', error)
-        bot.send_message(chat.id, 'Ой, ошибка, попробуйте ещё раз.')
+        outbox.send_message(chat.id, 'Ой, ошибка, попробуйте ещё раз.')
         return
-    add_request = {'group_id': group_id, 'user_id': user[0]}
-    db_tables('add_request', **add_request)
-    group_name = cursor.fetchone()[0]
-    bot.send_message(chat.id, 'Участнику отправлено приглашение!')
-    groups(message)
-    bot.send_message(
-        user[1],
-        f'@{chat.username}, Вас добавил в группу {group_name}!'
-        'Перейдите в /home, чтобы присоединиться .')
-
-
-def add_member(message, groups_id, owner_id_t):
+
+    def saved(future):
+        if future.exception() is not None:
+            logger.error(f'Ошибка при добавлении запроса: '
+                         f'{future.exception()}')
+            outbox.send_message(chat.id, 'Ой, ошибка, попробуйте ещё раз.')
+            return
+        outbox.send_message(chat.id, 'Участнику отправлено приглашение!')
+        groups(message)
+        digest.notify(
+            user[1],
+            f'@{chat.username}, Вас добавил в группу {group_name}!'
+            'Перейдите в /group_requests, чтобы присоединиться .')
+
+    repo.add_request(user[0], group_id).add_done_callback(
+        in_chat(chat.id, saved))
+
+
+def add_member(message, group_id, owner_id_t):
     chat = message.chat
-    user = get_current_user(chat.id)
-    add_member = {'group_id': groups_id, 'user_id': user['id']}
-    db_tables('add_member', **add_member)
-    bot.send_message(chat.id, 'Вы добавлены в группу!')
-    bot.send_message(owner_id_t, f'@{chat.username} приняЛ приглашение!')
+    user = get_current_user(chat.id, chat)
+
+    def saved(future):
+        if future.exception() is not None:
+            logger.error(f'Ошибка при вступлении в группу: '
+                         f'{future.exception()}')
+            outbox.send_message(chat.id, 'Ой, ошибка, попробуйте ещё раз.')
+            return
+        outbox.send_message(chat.id, 'Вы добавлены в группу!')
+        digest.notify(owner_id_t, f'@{chat.username} приняЛ приглашение!')
 
+    repo.add_member(user.id, group_id).add_done_callback(
+        in_chat(chat.id, saved))
 
+
+@conversations.step
 def add_notes(message, group_id):
     chat = message.chat
-    user = get_current_user(chat.id)
-    add_note = {'user_id': user['id'], 'text': message.text}
-    if isinstance(group_id, int):
-        add_note['group_id'] = group_id
-
-    db_tables('add_note', **add_note)
-    bot.send_message(chat.id, 'Записка добавлена!')
+    user = get_current_user(chat.id, chat)
+    if group_id == 'me':
+        group_id = None
+    remind_at, note = parse_reminder(message.text)
+
+    def saved(future):
+        if future.exception() is not None:
+            logger.error(f'Ошибка при добавлении записки: '
+                         f'{future.exception()}')
+            outbox.send_message(chat.id, 'Ой, ошибка, попробуйте ещё раз.')
+            return
+        note_id = future.result()
+        if group_id is not None:
+            fanout.notify(note_id, user.id)
+        text = 'Записка добавлена!'
+        if remind_at is not None:
+            reminders.schedule(note_id, remind_at)
+            text += f' {reminder_text(remind_at)}'
+        outbox.send_message(chat.id, text)
+
+    repo.add_note(
+        user.id, note, group_id, remind_at
+    ).add_done_callback(in_chat(chat.id, saved))
+
+
+def expire_requests():
+    before = int(time.time()) - REQUEST_TTL
+    deleted = 0
+    while True:
+        # Короткие транзакции не задерживают запись из обработчиков.
+        count = repo.delete_expired_requests(before, EXPIRE_CHUNK)
+        deleted += count
+        if count < EXPIRE_CHUNK:
+            break
+        time.sleep(EXPIRE_PAUSE)
+    logger.info(f'Удалено просроченных запросов: {deleted}')
+
+
+def purge_conversations():
+    deleted = conversations.purge(EXPIRE_CHUNK)
+    logger.info(f'Удалено устаревших разговоров: {deleted}')
+
+
+def incremental_vacuum():
+    free = db.incremental_vacuum(VACUUM_PAGES)
+    if free is not None:
+        logger.info(f'Свободных страниц после очистки: {free}')
+
+
+def start_background():
+    registry.instrument_bot(bot)
+    if metrics_server is not None:
+        metrics_server.start()
+    image_pool.start()
+    if writes is not None:
+        writes.start()
+    outbox.start()
+    fanout.start()
+    reminders.start()
+    jobs.add('expire_requests', expire_requests, EXPIRE_INTERVAL,
+             jitter=JOB_JITTER, run_now=True)
+    jobs.add('purge_conversations', purge_conversations, EXPIRE_INTERVAL,
+             jitter=JOB_JITTER)
+    jobs.add('digest', digest.flush, DIGEST_INTERVAL, offset=DIGEST_OFFSET,
+             jitter=JOB_JITTER)
+    jobs.add('incremental_vacuum', incremental_vacuum, VACUUM_INTERVAL,
+             jitter=JOB_JITTER)
+    jobs.add('metrics_summary', registry.summary, METRICS_INTERVAL)
+    jobs.add('load_shedding', shedder.check, SHED_INTERVAL)
+    for name, job in jobs.jobs.items():
+        registry.gauge(f'job_{name}_runs_total', lambda job=job: job.runs)
+        registry.gauge(f'job_{name}_failures_total',
+                       lambda job=job: job.failures)
+        registry.gauge(f'job_{name}_skipped_total',
+                       lambda job=job: job.skipped)
+        registry.gauge(f'job_{name}_seconds_total',
+                       lambda job=job: round(job.total_duration, 3))
+        registry.gauge(f'job_{name}_last_seconds',
+                       lambda job=job: job.last_duration or 0)
+    jobs.start()
+    dispatcher.start()
+
+
+def stop_background():
+    # Сначала дорабатывают обработчики, затем уходят отложенные записи и
+    # сообщения, которые они поставили в очередь.
+    profiler.stop()
+    dispatcher.stop()
+    if writes is not None:
+        writes.stop()
+    jobs.stop()
+    reminders.stop()
+    fanout.stop()
+    outbox.stop(timeout=10)
+    image_pool.stop()
+    if metrics_server is not None:
+        metrics_server.stop()
 
 
 def chat_polling():
+    start_background()
+    bot.remove_webhook()
+    offset = None
+    try:
+        while True:
+            try:
+                updates = bot.get_updates(
+                    offset=offset, timeout=POLLING_TIMEOUT,
+                    long_polling_timeout=POLLING_TIMEOUT)
+            except Exception as error:
+                logger.error(f'Ошибка при получении обновлений: {error}')
+                time.sleep(1)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                dispatcher.submit(update)
+    finally:
+        stop_background()
 
-    now = int(time.time())
-    if now % 86400 in [0, 43200]:
-        logger.debug('Удаляем старые запросы')
-        cursor.execute(
-            'DELETE FROM requests WHERE date < ?',
-            (now - 86400,)
-        )
 
+def chat_webhook():
+    if not WEBHOOK_URL:
+        logger.error('Для режима webhook нужен WEBHOOK_URL')
+        return
+    start_background()
+    server = WebhookServer(dispatcher.submit)
+    server.start()
+    bot.set_webhook(url=WEBHOOK_URL, secret_token=server.secret)
     try:
-        bot.polling()
-    except Exception as error:
-        logger.error(error)
+        while True:
+            time.sleep(3600)
+    finally:
+        server.stop()
+        stop_background()
 
 
 if __name__ == '__main__':
     logger.info('Бот запущен.')
-    chat_polling()
+    if UPDATE_MODE == 'webhook':
+        chat_webhook()
+    else:
+        chat_polling()
@@ -0,0 +1,160 @@
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+from collections import Counter
+
+from constants import (PROFILE_DIR, PROFILE_INTERVAL, PROFILE_MAX_SECONDS,
+                       PROFILE_TOP)
+
+logger = logging.getLogger(__name__)
+
+
+def frame_name(code):
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+class Session:
+
+    def __init__(self, updates, seconds, done):
+        self.updates = updates
+        self.deadline = time.monotonic() + seconds
+        self.done = done
+        self.seen = 0
+        self.profiled = 0
+        self.profile = cProfile.Profile()
+        self.stacks = Counter()
+        self.finished = threading.Event()
+
+
+class UpdateProfiler:
+
+    def __init__(self, dispatcher, directory=PROFILE_DIR,
+                 interval=PROFILE_INTERVAL, top=PROFILE_TOP,
+                 max_seconds=PROFILE_MAX_SECONDS):
+        self.dispatcher = dispatcher
+        self.directory = directory
+        self.interval = interval
+        self.top = top
+        self.max_seconds = max_seconds
+        self.session = None
+        self._lock = threading.Lock()
+        # cProfile не умеет профилировать несколько потоков сразу, поэтому
+        # детально замеряем одно обновление за раз, остальные — только
+        # по выборке стеков.
+        self._busy = threading.Lock()
+        self._handling = {}
+        self._handle = None
+
+    @property
+    def active(self):
+        return self.session is not None
+
+    def start(self, done, updates=None, seconds=None):
+        seconds = min(seconds or self.max_seconds, self.max_seconds)
+        with self._lock:
+            if self.session is not None:
+                return False
+            self.session = session = Session(updates, seconds, done)
+            self._handle = self.dispatcher.handle
+            # Пока профайлер выключен, диспетчер вызывает обработчик
+            # напрямую и не платит ни за одну проверку.
+            self.dispatcher.handle = self._profiled
+        threading.Thread(target=self._sample, args=(session,),
+                         name='profiler', daemon=True).start()
+        logger.info('Профилирование обновлений включено')
+        return True
+
+    def stop(self):
+        session = self.session
+        if session is not None:
+            session.finished.set()
+
+    def _profiled(self, update):
+        session = self.session
+        if session is None:
+            return self._handle(update)
+        thread_id = threading.get_ident()
+        self._handling[thread_id] = session
+        exclusive = self._busy.acquire(blocking=False)
+        try:
+            if exclusive:
+                session.profile.enable()
+            self._handle(update)
+        finally:
+            if exclusive:
+                session.profile.disable()
+                session.profiled += 1
+                self._busy.release()
+            self._handling.pop(thread_id, None)
+            session.seen += 1
+            if session.updates and session.seen >= session.updates:
+                session.finished.set()
+
+    def _sample(self, session):
+        handle_code = self._profiled.__code__
+        while not session.finished.wait(self.interval):
+            if time.monotonic() >= session.deadline:
+                break
+            frames = sys._current_frames()
+            for thread_id in list(self._handling):
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None and frame.f_code is not handle_code:
+                    stack.append(frame_name(frame.f_code))
+                    frame = frame.f_back
+                if stack:
+                    session.stacks[';'.join(reversed(stack))] += 1
+        self._finish(session)
+
+    def _finish(self, session):
+        with self._lock:
+            self.dispatcher.handle = self._handle
+            self.session = None
+        # Дожидаемся обновления, которое ещё профилируется.
+        with self._busy:
+            pass
+        try:
+            text = self._save(session)
+        except Exception as error:
+            logger.exception(f'Не удалось сохранить профиль: {error}')
+            text = f'Не удалось сохранить профиль: {error}'
+        logger.info('Профилирование обновлений завершено')
+        session.done(text)
+
+    def _save(self, session):
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(
+            self.directory, time.strftime('profile-%Y%m%d-%H%M%S'))
+        lines = [f'Обновлений: {session.seen}, '
+                 f'подробно профилировано: {session.profiled}, '
+                 f'выборок стека: {sum(session.stacks.values())}']
+        if session.stacks:
+            with open(f'{base}.collapsed', 'w') as output:
+                for stack, count in session.stacks.most_common():
+                    output.write(f'{stack} {count}\n')
+            lines.append(f'Стеки: {base}.collapsed')
+        if session.profiled:
+            session.profile.dump_stats(f'{base}.pstats')
+            lines.append(f'pstats: {base}.pstats')
+            lines.append('')
+            lines.extend(self._summary(session.profile))
+        return '\n'.join(lines)
+
+    def _summary(self, profile):
+        stats = pstats.Stats(profile).stats
+        rows = sorted(stats.items(), key=lambda item: item[1][3],
+                      reverse=True)
+        lines = ['всего мс / своё мс / вызовов — функция']
+        for (filename, line, name), (_, calls, own, total, _) in rows:
+            if name == '_profiled' or '_lsprof' in name:
+                continue
+            lines.append(f'{total * 1000:.1f} / {own * 1000:.1f} / {calls} — '
+                         f'{os.path.basename(filename)}:{line}:{name}')
+            if len(lines) > self.top:
+                break
+        return lines
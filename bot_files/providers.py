@@ -0,0 +1,174 @@
+import logging
+import threading
+import time
+
+from collections import deque
+from random import choices
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from constants import (ANIMAL_URLS, PROVIDER_BREAKER_COOLDOWN,
+                       PROVIDER_BREAKER_FAILURES, PROVIDER_CONNECT_TIMEOUT,
+                       PROVIDER_READ_TIMEOUT, PROVIDER_WINDOW)
+from exceptions import ProviderUnavailableError
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.gif', '.png', '.jpeg')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def parse_image_url(response):
+    if isinstance(response, list):
+        response = response[0]
+    for value in response.values():
+        if isinstance(value, str) and value.lower().endswith(IMAGE_EXTENSIONS):
+            return value
+
+
+class Provider:
+
+    def __init__(self, name, url, window=PROVIDER_WINDOW):
+        self.name = name
+        self.url = url
+        self.host = urlsplit(url).netloc
+        self.results = deque(maxlen=window)
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    @property
+    def success_rate(self):
+        if not self.results:
+            return 1.0
+        return sum(ok for ok, _ in self.results) / len(self.results)
+
+    @property
+    def latency(self):
+        if not self.results:
+            # Новый провайдер считаем быстрым, чтобы он получил запросы.
+            return PROVIDER_CONNECT_TIMEOUT / 20
+        latencies = [latency for ok, latency in self.results if ok]
+        if not latencies:
+            return PROVIDER_READ_TIMEOUT
+        return sum(latencies) / len(latencies)
+
+    @property
+    def weight(self):
+        return max(self.success_rate, 0.05) / max(self.latency, 0.01)
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'success_rate': round(self.success_rate, 2),
+            'latency': round(self.latency, 3),
+            'samples': len(self.results),
+        }
+
+
+class ProviderManager:
+
+    def __init__(self, urls=ANIMAL_URLS,
+                 timeout=(PROVIDER_CONNECT_TIMEOUT, PROVIDER_READ_TIMEOUT),
+                 max_failures=PROVIDER_BREAKER_FAILURES,
+                 cooldown=PROVIDER_BREAKER_COOLDOWN):
+        self.providers = [Provider(name, url) for name, url in urls.items()]
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session(self, host):
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._sessions[host] = session
+            return session
+
+    def available(self):
+        now = time.monotonic()
+        result = []
+        with self._lock:
+            for provider in self.providers:
+                if provider.state == OPEN:
+                    if now - provider.opened_at < self.cooldown:
+                        continue
+                    provider.state = HALF_OPEN
+                if provider.state == HALF_OPEN:
+                    if provider.probing:
+                        continue
+                    provider.probing = True
+                result.append(provider)
+        return result
+
+    def record(self, provider, ok, latency):
+        registry.histogram('provider', provider.name).observe(latency, not ok)
+        with self._lock:
+            provider.results.append((ok, latency))
+            provider.probing = False
+            if ok:
+                provider.failures = 0
+                if provider.state != CLOSED:
+                    logger.info(f'API {provider.name} снова доступно')
+                provider.state = CLOSED
+                return
+            provider.failures += 1
+            if (provider.state == HALF_OPEN
+                    or provider.failures >= self.max_failures
+                    or (len(provider.results) >= provider.results.maxlen // 2
+                        and provider.success_rate < 0.5)):
+                if provider.state != OPEN:
+                    logger.warning(f'API {provider.name} отключено на '
+                                   f'{self.cooldown} с после ошибок')
+                provider.state = OPEN
+                provider.opened_at = time.monotonic()
+
+    def request(self, provider):
+        start = time.monotonic()
+        try:
+            response = self.session(provider.host).get(
+                provider.url, timeout=self.timeout)
+            response.raise_for_status()
+            image = parse_image_url(response.json())
+            if image is None:
+                raise ValueError('в ответе нет ссылки на картинку')
+        except Exception as error:
+            self.record(provider, False, time.monotonic() - start)
+            logger.error(f'При доступе к API {provider.name} '
+                         f'возникла ошибка: {error}')
+            return None
+        self.record(provider, True, time.monotonic() - start)
+        return image
+
+    def fetch_image(self):
+        candidates = self.available()
+        while candidates:
+            provider = choices(
+                candidates, weights=[p.weight for p in candidates])[0]
+            candidates.remove(provider)
+            image = self.request(provider)
+            if image is not None:
+                self.release(candidates)
+                return image
+        raise ProviderUnavailableError('Все API картинок недоступны')
+
+    def release(self, providers):
+        with self._lock:
+            for provider in providers:
+                provider.probing = False
+
+    def stats(self):
+        with self._lock:
+            return {p.name: p.stats() for p in self.providers}
@@ -0,0 +1,357 @@
+SELECT_USER_ID = 'SELECT id FROM users WHERE user_id_t = ?'
+
+SELECT_USER = (
+    'SELECT id, user_id_t, user_name, f_name, l_name, digest '
+    'FROM users WHERE user_id_t = ?'
+)
+
+SELECT_USER_BY_NAME = (
+    'SELECT id, user_id_t, user_name FROM users WHERE user_name = ?'
+)
+
+SELECT_USER_BY_ID_T = (
+    'SELECT id, user_id_t, user_name FROM users WHERE user_id_t = ?'
+)
+
+INSERT_USER = (
+    'INSERT INTO users (user_id_t, user_name, f_name, l_name) '
+    'VALUES (?, ?, ?, ?)'
+)
+
+UPDATE_USER = (
+    'UPDATE users SET user_name = ?, f_name = ?, l_name = ? '
+    'WHERE user_id_t = ?'
+)
+
+UPDATE_USER_DIGEST = 'UPDATE users SET digest = ? WHERE user_id_t = ?'
+
+INSERT_EVENT = (
+    'INSERT INTO events (user_id, text, created_at) VALUES (?, ?, ?)'
+)
+
+UPSERT_DIGEST = (
+    'INSERT INTO digests (user_id, events, first_at) VALUES (?, 1, ?) '
+    'ON CONFLICT (user_id) DO UPDATE SET events = events + 1'
+)
+
+PAGE_DIGESTS = (
+    'SELECT digests.user_id, users.user_id_t FROM digests '
+    'INNER JOIN users ON digests.user_id = users.id '
+    'WHERE digests.user_id > ? ORDER BY digests.user_id LIMIT ?'
+)
+
+SELECT_DIGEST = 'SELECT events FROM digests WHERE user_id = ?'
+
+SELECT_EVENTS = (
+    'SELECT text FROM events WHERE user_id = ? ORDER BY id LIMIT ?'
+)
+
+DELETE_EVENTS = 'DELETE FROM events WHERE user_id = ?'
+
+DELETE_DIGEST = 'DELETE FROM digests WHERE user_id = ?'
+
+SELECT_GROUP_BY_NAME = (
+    'SELECT 1 FROM users_groups '
+    'INNER JOIN groups ON users_groups.group_id = groups.id '
+    'WHERE users_groups.user_id = ? AND groups.name = ?'
+)
+
+SELECT_GROUP = 'SELECT name, owner_id FROM groups WHERE id = ?'
+
+INSERT_GROUP = 'INSERT INTO groups (name, owner_id) VALUES (?, ?)'
+
+RENAME_GROUP = 'UPDATE groups SET name = ? WHERE id = ?'
+
+UPDATE_GROUP_OWNER = 'UPDATE groups SET owner_id = ? WHERE id = ?'
+
+DELETE_GROUP = 'DELETE FROM groups WHERE id = ?'
+
+INSERT_OWNER_MEMBER = (
+    'INSERT INTO users_groups (user_id, group_id, add_note) VALUES (?, ?, 1)'
+)
+
+INSERT_MEMBER = 'INSERT INTO users_groups (user_id, group_id) VALUES (?, ?)'
+
+DELETE_MEMBER = 'DELETE FROM users_groups WHERE group_id = ? AND user_id = ?'
+
+SELECT_ADD_NOTE = (
+    'SELECT add_note FROM users_groups WHERE group_id = ? AND user_id = ?'
+)
+
+COUNT_GROUPS = 'SELECT COUNT(*) FROM users_groups WHERE user_id = ?'
+
+PAGE_GROUPS = (
+    'SELECT groups.id, groups.name, groups.owner_id, '
+    'owners.user_name, users_groups.add_note, users_groups.notify '
+    'FROM users_groups '
+    'INNER JOIN groups ON users_groups.group_id = groups.id '
+    'INNER JOIN users AS owners ON groups.owner_id = owners.id '
+    'WHERE users_groups.user_id = ? AND users_groups.group_id {op} ? '
+    'ORDER BY users_groups.group_id {order} LIMIT ?'
+)
+
+COUNT_REQUESTS = 'SELECT COUNT(*) FROM requests WHERE user_id = ?'
+
+PAGE_REQUESTS = (
+    'SELECT requests.id, groups.id, groups.name, '
+    'users.user_name, users.user_id_t '
+    'FROM requests '
+    'INNER JOIN groups ON requests.group_id = groups.id '
+    'INNER JOIN users ON groups.owner_id = users.id '
+    'WHERE requests.user_id = ? AND requests.id {op} ? '
+    'ORDER BY requests.id {order} LIMIT ?'
+)
+
+INSERT_REQUEST = (
+    'INSERT INTO requests (user_id, group_id, date) VALUES (?, ?, ?)'
+)
+
+DELETE_REQUEST = 'DELETE FROM requests WHERE user_id = ? AND group_id = ?'
+
+DELETE_EXPIRED_REQUESTS = (
+    'DELETE FROM requests WHERE id IN ('
+    'SELECT id FROM requests WHERE date < ? LIMIT ?)'
+)
+
+COUNT_GROUP_NOTES = (
+    'SELECT COUNT(*) FROM users_groups '
+    'INNER JOIN notes ON notes.group_id = users_groups.group_id '
+    'WHERE users_groups.user_id = ? AND users_groups.group_id = ?'
+)
+
+PAGE_GROUP_NOTES = (
+    'SELECT notes.id, notes.note, groups.name,'
+    ' groups.id, users_groups.add_note, notes.user_id '
+    'FROM users_groups '
+    'INNER JOIN groups ON users_groups.group_id = groups.id '
+    'INNER JOIN notes ON notes.group_id = users_groups.group_id '
+    'WHERE users_groups.user_id = ? '
+    'AND users_groups.group_id = ? AND notes.id {op} ? '
+    'ORDER BY notes.id {order} LIMIT ?'
+)
+
+COUNT_NOTES = (
+    'SELECT (SELECT COUNT(*) FROM notes '
+    'WHERE user_id = ? AND group_id IS NULL) + '
+    '(SELECT COUNT(*) FROM users_groups '
+    'INNER JOIN notes ON notes.group_id = users_groups.group_id '
+    'WHERE users_groups.user_id = ?)'
+)
+
+# Из каждой группы берём не больше LIMIT записок, чтобы сортировать только
+# их, а не все записки всех групп пользователя.
+PAGE_NOTES = (
+    'SELECT notes.id, notes.note, NULL, NULL, 1, notes.user_id '
+    'FROM notes '
+    'WHERE notes.user_id = ? AND notes.group_id IS NULL '
+    'AND notes.id {op} ? '
+    'UNION ALL '
+    'SELECT notes.id, notes.note, groups.name,'
+    ' groups.id, users_groups.add_note, notes.user_id '
+    'FROM users_groups '
+    'INNER JOIN groups ON users_groups.group_id = groups.id '
+    'INNER JOIN notes ON notes.id IN ('
+    'SELECT id FROM notes AS own WHERE own.group_id = users_groups.group_id '
+    'AND own.id {op} ? ORDER BY own.id {order} LIMIT ?) '
+    'WHERE users_groups.user_id = ? '
+    'ORDER BY 1 {order} LIMIT ?'
+)
+
+SELECT_USER_GROUP_IDS = (
+    'SELECT group_id FROM users_groups WHERE user_id = ?'
+)
+
+# Доступ проверяет колонка scope в MATCH, курсор — пара (rank, id).
+SEARCH_NOTES = (
+    'SELECT notes.id, '
+    "snippet(notes_fts, 0, '«', '»', '…', 12), groups.name, notes.note, "
+    'notes_fts.rank '
+    'FROM notes_fts '
+    'INNER JOIN notes ON notes.id = notes_fts.rowid '
+    'LEFT JOIN groups ON notes.group_id = groups.id '
+    'WHERE notes_fts MATCH ? '
+    'AND (notes_fts.rank, notes_fts.rowid) {op} (?, ?) '
+    'ORDER BY notes_fts.rank {order}, notes_fts.rowid {order} LIMIT ?'
+)
+
+# Inline-режим показывает совпадения от новых к старым: порядок не зависит
+# от запроса, и кэш может отфильтровать строки «мол» для запроса «моло».
+INLINE_SEARCH_NOTES = (
+    'SELECT notes.id, notes.note, groups.name '
+    'FROM notes_fts '
+    'INNER JOIN notes ON notes.id = notes_fts.rowid '
+    'LEFT JOIN groups ON notes.group_id = groups.id '
+    'WHERE notes_fts MATCH ? AND notes_fts.rowid < ? '
+    'ORDER BY notes_fts.rowid DESC LIMIT ?'
+)
+
+INLINE_NOTES = (
+    'SELECT notes.id, notes.note, NULL FROM notes '
+    'WHERE notes.user_id = ? AND notes.group_id IS NULL AND notes.id < ? '
+    'UNION ALL '
+    'SELECT notes.id, notes.note, groups.name '
+    'FROM users_groups '
+    'INNER JOIN groups ON users_groups.group_id = groups.id '
+    'INNER JOIN notes ON notes.id IN ('
+    'SELECT id FROM notes AS own WHERE own.group_id = users_groups.group_id '
+    'AND own.id < ? ORDER BY own.id DESC LIMIT ?) '
+    'WHERE users_groups.user_id = ? '
+    'ORDER BY 1 DESC LIMIT ?'
+)
+
+SELECT_FANOUT_NOTE = (
+    'SELECT notes.note, notes.group_id, groups.name FROM notes '
+    'LEFT JOIN groups ON notes.group_id = groups.id '
+    'WHERE notes.id = ?'
+)
+
+PAGE_NOTIFY_MEMBERS = (
+    'SELECT users_groups.user_id, users.user_id_t, users.digest '
+    'FROM users_groups '
+    'INNER JOIN users ON users_groups.user_id = users.id '
+    'WHERE users_groups.group_id = ? AND users_groups.notify = 1 '
+    'AND users_groups.user_id > ? '
+    'ORDER BY users_groups.user_id LIMIT ?'
+)
+
+UPDATE_MEMBER_NOTIFY = (
+    'UPDATE users_groups SET notify = ? WHERE group_id = ? AND user_id = ?'
+)
+
+SELECT_NOTE_OWNER = 'SELECT user_id, group_id FROM notes WHERE id = ?'
+
+SELECT_GROUP_MEMBER_IDS = (
+    'SELECT user_id FROM users_groups WHERE group_id = ?'
+)
+
+INSERT_NOTE = (
+    'INSERT INTO notes (user_id, group_id, note, remind_at) '
+    'VALUES (?, ?, ?, ?)'
+)
+
+# Без нового времени напоминание остаётся прежним.
+UPDATE_NOTE = (
+    'UPDATE notes SET note = ?, remind_at = COALESCE(?, remind_at) '
+    'WHERE id = ?'
+)
+
+UPDATE_NOTE_NO_REMINDER = (
+    'UPDATE notes SET note = ?, remind_at = NULL WHERE id = ?'
+)
+
+SELECT_NOTE_REMINDER = 'SELECT remind_at FROM notes WHERE id = ?'
+
+PENDING_REMINDERS = (
+    'SELECT remind_at, id FROM notes '
+    'WHERE remind_at IS NOT NULL AND (remind_at, id) > (?, ?) '
+    'AND remind_at <= ? '
+    'ORDER BY remind_at, id LIMIT ?'
+)
+
+SELECT_DUE_REMINDERS = (
+    'SELECT notes.id, notes.note, NULL, users.user_id_t '
+    'FROM json_each(?) AS due '
+    'CROSS JOIN notes ON notes.id = due.value '
+    'INNER JOIN users ON notes.user_id = users.id '
+    'WHERE notes.group_id IS NULL AND notes.remind_at <= ? '
+    'UNION ALL '
+    'SELECT notes.id, notes.note, groups.name, users.user_id_t '
+    'FROM json_each(?) AS due '
+    'CROSS JOIN notes ON notes.id = due.value '
+    'INNER JOIN groups ON notes.group_id = groups.id '
+    'INNER JOIN users_groups ON users_groups.group_id = notes.group_id '
+    'INNER JOIN users ON users_groups.user_id = users.id '
+    'WHERE notes.remind_at <= ?'
+)
+
+CLEAR_REMINDERS = (
+    'UPDATE notes SET remind_at = NULL '
+    'WHERE id IN (SELECT value FROM json_each(?)) AND remind_at <= ?'
+)
+
+DELETE_NOTE = 'DELETE FROM notes WHERE id = ?'
+
+SELECT_GROUP_MEMBERS_COUNT = (
+    'SELECT name, (SELECT COUNT(*) FROM users_groups '
+    'WHERE group_id = groups.id) FROM groups WHERE id = ?'
+)
+
+PAGE_MEMBERS = (
+    'SELECT users_groups.user_id, users.user_name, users.user_id_t '
+    'FROM users_groups '
+    'INNER JOIN users ON users_groups.user_id = users.id '
+    'WHERE users_groups.group_id = ? '
+    'AND users_groups.user_id {op} ? '
+    'ORDER BY users_groups.user_id {order} LIMIT ?'
+)
+
+SELECT_MEMBER = (
+    'SELECT users_groups.group_id, groups.name,'
+    ' users.user_name, users.user_id_t '
+    'FROM users '
+    'INNER JOIN users_groups ON users_groups.user_id = users.id '
+    'INNER JOIN groups ON users_groups.group_id = groups.id '
+    'WHERE users.user_id_t = ? AND users_groups.group_id = ?'
+)
+
+SELECT_PHOTO = 'SELECT file_id FROM photos WHERE source = ?'
+
+COUNT_PHOTOS = 'SELECT COUNT(*) FROM photos'
+
+RECENT_PHOTOS = (
+    'SELECT file_id FROM photos ORDER BY used_at DESC LIMIT ?'
+)
+
+TOUCH_PHOTO = 'UPDATE photos SET used_at = ? WHERE source = ?'
+
+UPDATE_PHOTO = 'UPDATE photos SET file_id = ?, used_at = ? WHERE source = ?'
+
+INSERT_PHOTO = 'INSERT INTO photos (source, file_id, used_at) VALUES (?, ?, ?)'
+
+EVICT_PHOTOS = (
+    'DELETE FROM photos WHERE source IN ('
+    'SELECT source FROM photos ORDER BY used_at LIMIT ?)'
+)
+
+DELETE_PHOTO = 'DELETE FROM photos WHERE source = ?'
+
+UPSERT_CONVERSATION = (
+    'INSERT INTO conversations (chat_id, step, args, expires_at) '
+    'VALUES (?, ?, ?, ?) '
+    'ON CONFLICT (chat_id) DO UPDATE SET step = excluded.step, '
+    'args = excluded.args, expires_at = excluded.expires_at'
+)
+
+SELECT_CONVERSATION = (
+    'SELECT expires_at, step, args FROM conversations WHERE chat_id = ?'
+)
+
+DELETE_CONVERSATION = 'DELETE FROM conversations WHERE chat_id = ?'
+
+COUNT_CONVERSATIONS = 'SELECT COUNT(*) FROM conversations'
+
+RECENT_CONVERSATIONS = (
+    'SELECT chat_id, expires_at, step, args FROM conversations '
+    'WHERE expires_at >= ? ORDER BY expires_at DESC LIMIT ?'
+)
+
+DELETE_EXPIRED_CONVERSATIONS = (
+    'DELETE FROM conversations WHERE chat_id IN ('
+    'SELECT chat_id FROM conversations WHERE expires_at < ? LIMIT ?)'
+)
+
+
+def page(sql, direction):
+    if direction == 'prev':
+        return sql.format(op='<', order='DESC')
+    return sql.format(op='>', order='ASC')
+
+
+def statements():
+    for name, sql in globals().items():
+        if name.isupper() and isinstance(sql, str):
+            if '{op}' in sql:
+                yield f'{name}:next', page(sql, 'next')
+                yield f'{name}:prev', page(sql, 'prev')
+            else:
+                yield name, sql
@@ -0,0 +1,150 @@
+import heapq
+import logging
+import re
+import threading
+import time
+
+from datetime import datetime, timedelta
+
+from constants import LAST_CURSOR, REMINDER_BATCH, REMINDER_WINDOW
+
+logger = logging.getLogger(__name__)
+
+REMINDER_PATTERN = re.compile(
+    r'^\s*(?:(\d{1,2})\.(\d{1,2})(?:\.(\d{4}))?\s+)?(\d{1,2}):(\d{2})\s+(.+)$',
+    re.DOTALL)
+# Начало правки записки, которое снимает напоминание.
+NO_REMINDER = re.compile(r'^\s*без напоминания\s+(.+)$',
+                         re.DOTALL | re.IGNORECASE)
+
+
+def parse_reminder(text, now=None):
+    match = REMINDER_PATTERN.match(text)
+    if match is None:
+        return None, text
+    day, month, year, hour, minute, note = match.groups()
+    now = now or datetime.now()
+    try:
+        moment = now.replace(
+            day=int(day) if day else now.day,
+            month=int(month) if month else now.month,
+            year=int(year) if year else now.year,
+            hour=int(hour), minute=int(minute), second=0, microsecond=0)
+    except ValueError:
+        return None, text
+    if moment <= now:
+        if not day:
+            moment += timedelta(days=1)
+        elif not year:
+            moment = moment.replace(year=moment.year + 1)
+    return int(moment.timestamp()), note.strip()
+
+
+def parse_no_reminder(text):
+    match = NO_REMINDER.match(text)
+    if match is None:
+        return False, text
+    return True, match.group(1).strip()
+
+
+class ReminderScheduler:
+
+    def __init__(self, repo, deliver, window=REMINDER_WINDOW,
+                 batch=REMINDER_BATCH):
+        self.repo = repo
+        self.deliver = deliver
+        self.window = window
+        self.batch = batch
+        self.delivered = 0
+        self._heap = []
+        # Все напоминания с ключом (remind_at, id) <= _loaded уже в куче.
+        self._loaded = (0, 0)
+        # Пока идёт загрузка, новые напоминания до этой границы кладём в
+        # кучу сразу: повтор безопасен, потеря — нет.
+        self._loading = (0, 0)
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap)
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='reminders', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def schedule(self, note_id, remind_at):
+        with self._cond:
+            if (remind_at, note_id) <= max(self._loaded, self._loading):
+                heapq.heappush(self._heap, (remind_at, note_id))
+                self._cond.notify()
+
+    def _load(self, now):
+        until = int(now) + self.window
+        with self._cond:
+            self._loading = (until, LAST_CURSOR)
+        try:
+            rows = self.repo.pending_reminders(
+                self._loaded, until, self.batch)
+        finally:
+            with self._cond:
+                self._loading = (0, 0)
+        with self._cond:
+            for row in rows:
+                heapq.heappush(self._heap, row)
+            if len(rows) == self.batch:
+                self._loaded = max(self._loaded, rows[-1])
+            else:
+                self._loaded = max(self._loaded, (until, LAST_CURSOR))
+        logger.debug(f'Загружено напоминаний: {len(rows)}')
+
+    def _pop_due(self, now):
+        due = {}
+        with self._cond:
+            while (self._heap and self._heap[0][0] <= now
+                   and len(due) < self.batch):
+                due[heapq.heappop(self._heap)[1]] = None
+        return list(due)
+
+    def _wait(self, now):
+        with self._cond:
+            if self._stopped:
+                return
+            timeout = None
+            if len(self._heap) < self.batch // 2:
+                timeout = self._loaded[0] - self.window // 2 - now
+            if self._heap:
+                head = self._heap[0][0] - now
+                timeout = head if timeout is None else min(timeout, head)
+            self._cond.wait(None if timeout is None else max(timeout, 0.1))
+
+    def _run(self):
+        while not self._stopped:
+            now = time.time()
+            try:
+                with self._cond:
+                    need_load = (
+                        self._loaded[0] <= now + self.window // 2
+                        and len(self._heap) < self.batch // 2)
+                if need_load:
+                    self._load(now)
+                due = self._pop_due(now)
+                if due:
+                    rows = self.repo.take_due_reminders(due, int(now))
+                    self.deliver(rows)
+                    self.delivered += len(due)
+                    continue
+            except Exception as error:
+                logger.error(f'Ошибка при отправке напоминаний: {error}')
+                time.sleep(1)
+                continue
+            self._wait(now)
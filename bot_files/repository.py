@@ -0,0 +1,326 @@
+import json
+import re
+import time
+
+from concurrent.futures import Future
+
+import queries
+from exceptions import AlreadyExistsError
+from note_counts import NoteCounts
+from users import UserCache, UserRecord
+
+# Больше любого id записки: с него начинается список от новых к старым.
+NO_CURSOR = 2 ** 63 - 1
+
+
+class Repository:
+
+    def __init__(self, db, users=None, writes=None, note_counts=None):
+        self.db = db
+        # Буфер отложенной записи; без него вставки фиксируются сразу.
+        self.writes = writes
+        self.users = users or UserCache()
+        self.note_counts = note_counts or NoteCounts()
+        # Вызываются с id пользователей, чей список записок изменился.
+        self.notes_listeners = []
+
+    def page(self, sql, params, cursor_id, direction, limit=1):
+        rows = self.db.fetchall(
+            queries.page(sql, direction), (*params, cursor_id, limit))
+        if direction == 'prev':
+            rows.reverse()
+        return rows
+
+    def execute(self, statements, rowid=False, after=None):
+        if self.writes is not None:
+            return self.writes.execute(statements, rowid, after)
+        future = Future()
+        try:
+            with self.db.transaction() as conn:
+                cursors = [conn.execute(sql, params)
+                           for sql, params in statements]
+            result = cursors[0].lastrowid if rowid else None
+            if after is not None:
+                after(result)
+        except Exception as error:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+        return future
+
+    def notes_changed(self, user_ids):
+        self.note_counts.invalidate(user_ids)
+        for listener in self.notes_listeners:
+            listener(user_ids)
+
+    def note_readers(self, conn, user_id, group_id):
+        if group_id is None:
+            return [user_id]
+        return [row[0] for row in conn.execute(
+            queries.SELECT_GROUP_MEMBER_IDS, (group_id,))]
+
+    def get_user(self, user_id_t):
+        user = self.users.get(user_id_t)
+        if user is None:
+            user = UserRecord.from_row(
+                self.db.fetchone(queries.SELECT_USER, (user_id_t,)))
+            if user is not None:
+                self.users.put(user)
+        return user
+
+    def find_user(self, user_name=None, user_id_t=None):
+        if user_name is not None:
+            return self.db.fetchone(queries.SELECT_USER_BY_NAME, (user_name,))
+        return self.db.fetchone(queries.SELECT_USER_BY_ID_T, (user_id_t,))
+
+    def add_user(self, user_id_t, user_name, f_name, l_name):
+        with self.db.transaction() as conn:
+            if conn.execute(queries.SELECT_USER_ID, (user_id_t,)).fetchone():
+                raise AlreadyExistsError
+            conn.execute(
+                queries.INSERT_USER, (user_id_t, user_name, f_name, l_name))
+        self.users.invalidate(user_id_t)
+
+    def update_user(self, user_id_t, user_name, f_name, l_name):
+        with self.db.transaction() as conn:
+            conn.execute(
+                queries.UPDATE_USER, (user_name, f_name, l_name, user_id_t))
+        self.users.invalidate(user_id_t)
+
+    def set_digest(self, user_id_t, enabled):
+        with self.db.transaction() as conn:
+            conn.execute(queries.UPDATE_USER_DIGEST, (int(enabled), user_id_t))
+        self.users.invalidate(user_id_t)
+
+    def add_events(self, events):
+        if not events:
+            return
+        now = int(time.time())
+        with self.db.transaction() as conn:
+            for user_id, text in events:
+                conn.execute(queries.INSERT_EVENT, (user_id, text, now))
+                conn.execute(queries.UPSERT_DIGEST, (user_id, now))
+
+    def digests_page(self, after_user_id, limit):
+        return self.db.fetchall(
+            queries.PAGE_DIGESTS, (after_user_id, limit))
+
+    def take_digest(self, user_id, limit):
+        with self.db.transaction() as conn:
+            row = conn.execute(queries.SELECT_DIGEST, (user_id,)).fetchone()
+            if row is None:
+                return 0, []
+            lines = [line for line, in conn.execute(
+                queries.SELECT_EVENTS, (user_id, limit))]
+            conn.execute(queries.DELETE_EVENTS, (user_id,))
+            conn.execute(queries.DELETE_DIGEST, (user_id,))
+        return row[0], lines
+
+    def create_group(self, owner_id, name):
+        with self.db.transaction() as conn:
+            if conn.execute(
+                    queries.SELECT_GROUP_BY_NAME, (owner_id, name)).fetchone():
+                raise AlreadyExistsError
+            group_id = conn.execute(
+                queries.INSERT_GROUP, (name, owner_id)).lastrowid
+            conn.execute(queries.INSERT_OWNER_MEMBER, (owner_id, group_id))
+        return group_id
+
+    def get_group(self, group_id):
+        return self.db.fetchone(queries.SELECT_GROUP, (group_id,))
+
+    def rename_group(self, group_id, name):
+        with self.db.transaction() as conn:
+            conn.execute(queries.RENAME_GROUP, (name, group_id))
+            readers = self.note_readers(conn, None, group_id)
+        # Название группы показывается рядом с её записками.
+        self.notes_changed(readers)
+
+    def change_owner(self, group_id, user_id):
+        with self.db.transaction() as conn:
+            conn.execute(queries.UPDATE_GROUP_OWNER, (user_id, group_id))
+
+    def delete_group(self, group_id):
+        with self.db.transaction() as conn:
+            readers = self.note_readers(conn, None, group_id)
+            conn.execute(queries.DELETE_GROUP, (group_id,))
+        self.notes_changed(readers)
+
+    def count_groups(self, user_id):
+        return self.db.fetchone(queries.COUNT_GROUPS, (user_id,))[0]
+
+    def groups_page(self, user_id, cursor_id=0, direction='next', limit=1):
+        rows = self.page(
+            queries.PAGE_GROUPS, (user_id,), cursor_id, direction, limit)
+        return [
+            {
+                'id': row[0],
+                'name': row[1],
+                'owner_id': row[2],
+                'owner_user_name': row[3],
+                'add_note': row[4],
+                'notify': row[5]
+            } for row in rows]
+
+    def add_request(self, user_id, group_id):
+        return self.execute(
+            [(queries.INSERT_REQUEST, (user_id, group_id, int(time.time())))],
+            rowid=True)
+
+    def count_requests(self, user_id):
+        return self.db.fetchone(queries.COUNT_REQUESTS, (user_id,))[0]
+
+    def requests_page(self, user_id, cursor_id=0, direction='next'):
+        return self.page(
+            queries.PAGE_REQUESTS, (user_id,), cursor_id, direction)
+
+    def delete_expired_requests(self, before, limit):
+        with self.db.transaction() as conn:
+            return conn.execute(
+                queries.DELETE_EXPIRED_REQUESTS, (before, limit)).rowcount
+
+    def add_member(self, user_id, group_id):
+        return self.execute(
+            [(queries.INSERT_MEMBER, (user_id, group_id)),
+             (queries.DELETE_REQUEST, (user_id, group_id))],
+            after=lambda _: self.notes_changed([user_id]))
+
+    def remove_member(self, group_id, user_id):
+        with self.db.transaction() as conn:
+            conn.execute(queries.DELETE_MEMBER, (group_id, user_id))
+        self.notes_changed([user_id])
+
+    def can_add_note(self, group_id, user_id):
+        row = self.db.fetchone(queries.SELECT_ADD_NOTE, (group_id, user_id))
+        return bool(row and row[0] == 1)
+
+    def set_notify(self, group_id, user_id, enabled):
+        with self.db.transaction() as conn:
+            conn.execute(queries.UPDATE_MEMBER_NOTIFY,
+                         (int(enabled), group_id, user_id))
+
+    def notify_members(self, group_id, after_user_id, limit):
+        return self.db.fetchall(
+            queries.PAGE_NOTIFY_MEMBERS, (group_id, after_user_id, limit))
+
+    def get_fanout_note(self, note_id):
+        return self.db.fetchone(queries.SELECT_FANOUT_NOTE, (note_id,))
+
+    def group_members_count(self, group_id):
+        return self.db.fetchone(
+            queries.SELECT_GROUP_MEMBERS_COUNT, (group_id,))
+
+    def members_page(self, group_id, cursor_id=0, direction='next',
+                     limit=1):
+        return self.page(
+            queries.PAGE_MEMBERS, (group_id,), cursor_id, direction, limit)
+
+    def get_member(self, group_id, user_id_t):
+        return self.db.fetchone(queries.SELECT_MEMBER, (user_id_t, group_id))
+
+    def add_note(self, user_id, note, group_id=None, remind_at=None):
+        # Читателей ищем после фиксации: так в них попадут и те, кто
+        # вступил в группу, пока записка ждала в буфере.
+        return self.execute(
+            [(queries.INSERT_NOTE, (user_id, group_id, note, remind_at))],
+            rowid=True, after=lambda _: self.notes_changed(
+                self.note_readers(self.db, user_id, group_id)))
+
+    def update_note(self, note_id, note, remind_at=None):
+        previous = self.db.fetchone(queries.SELECT_NOTE_REMINDER, (note_id,))
+        self.change_note(queries.UPDATE_NOTE, note_id, (note, remind_at))
+        return previous[0] if previous else None
+
+    def update_note_no_reminder(self, note_id, note):
+        self.change_note(queries.UPDATE_NOTE_NO_REMINDER, note_id, (note,))
+
+    def change_note(self, sql, note_id, params=()):
+        with self.db.transaction() as conn:
+            owner = conn.execute(
+                queries.SELECT_NOTE_OWNER, (note_id,)).fetchone()
+            conn.execute(sql, (*params, note_id))
+            readers = self.note_readers(conn, *owner) if owner else []
+        self.notes_changed(readers)
+
+    def inline_notes(self, user_id, text, before=None, limit=50):
+        # before — id последней показанной записки.
+        before = NO_CURSOR if before is None else before
+        if text:
+            query = self.note_match(user_id, text)
+            if query is None:
+                return []
+            return self.db.fetchall(
+                queries.INLINE_SEARCH_NOTES, (query, before, limit))
+        return self.db.fetchall(
+            queries.INLINE_NOTES,
+            (user_id, before, before, limit, user_id, limit))
+
+    def search_notes(self, user_id, text, after=None, direction='next',
+                     limit=10):
+        query = self.note_match(user_id, text)
+        if query is None:
+            return []
+        rank, note_id = (float('-inf'), 0) if after is None else after
+        rows = self.db.fetchall(
+            queries.page(queries.SEARCH_NOTES, direction),
+            (query, rank, note_id, limit))
+        if direction == 'prev':
+            rows.reverse()
+        return rows
+
+    def note_match(self, user_id, text):
+        # Каждое слово ищем как префикс, спецсимволы FTS5 не пропускаем.
+        words = re.findall(r'\w+', text)
+        if not words:
+            return None
+        scopes = [f'u{user_id}'] + [
+            f'g{group_id}' for group_id, in self.db.fetchall(
+                queries.SELECT_USER_GROUP_IDS, (user_id,))]
+        query = ' '.join(f'"{word}"*' for word in words)
+        return f'note : ({query}) AND scope : ({" OR ".join(scopes)})'
+
+    def pending_reminders(self, after, until, limit):
+        rows = self.db.fetchall(
+            queries.PENDING_REMINDERS, (*after, until, limit))
+        return [tuple(row) for row in rows]
+
+    def take_due_reminders(self, note_ids, now):
+        due = json.dumps(note_ids)
+        with self.db.transaction() as conn:
+            rows = conn.execute(
+                queries.SELECT_DUE_REMINDERS, (due, now, due, now)).fetchall()
+            conn.execute(queries.CLEAR_REMINDERS, (due, now))
+        return rows
+
+    def delete_note(self, note_id):
+        self.change_note(queries.DELETE_NOTE, note_id)
+
+    def count_notes(self, user_id, group_id=None):
+        # Точный подсчёт перебирает все записки пользователя, а нужен на
+        # каждом листании, поэтому держим его до изменения записок.
+        group_id = group_id or None
+        count = self.note_counts.get(user_id, group_id)
+        if count is not None:
+            return count
+        generation = self.note_counts.generation(user_id)
+        if group_id:
+            count = self.db.fetchone(
+                queries.COUNT_GROUP_NOTES, (user_id, group_id))[0]
+        else:
+            count = self.db.fetchone(
+                queries.COUNT_NOTES, (user_id, user_id))[0]
+        self.note_counts.put(user_id, group_id, count, generation)
+        return count
+
+    def notes_page(self, user_id, cursor_id=0, direction='next',
+                   group_id=None):
+        if group_id:
+            return self.page(
+                queries.PAGE_GROUP_NOTES, (user_id, group_id),
+                cursor_id, direction)
+        rows = self.db.fetchall(
+            queries.page(queries.PAGE_NOTES, direction),
+            (user_id, cursor_id, cursor_id, 1, user_id, 1))
+        if direction == 'prev':
+            rows.reverse()
+        return rows
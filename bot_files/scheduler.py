@@ -0,0 +1,149 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+
+    __slots__ = ('name', 'func', 'interval', 'offset', 'jitter', 'running',
+                 'runs', 'failures', 'skipped', 'last_run', 'last_duration',
+                 'total_duration', 'next_run')
+
+    def __init__(self, name, func, interval, offset, jitter):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.offset = offset
+        self.jitter = jitter
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_run = None
+        self.last_duration = None
+        self.total_duration = 0.0
+        self.next_run = None
+
+    def schedule(self, now):
+        # Запуски выровнены по сетке interval + offset, как в cron, а
+        # случайный сдвиг не даёт нескольким процессам стартовать разом.
+        slot = (now - self.offset) // self.interval + 1
+        self.next_run = (
+            slot * self.interval + self.offset
+            + random.uniform(0, self.jitter))
+        return self.next_run
+
+
+class JobScheduler:
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self.jobs = {}
+        self._heap = []
+        self._pending = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._threads = []
+
+    def add(self, name, func, interval, offset=0, jitter=0, run_now=False):
+        job = Job(name, func, interval, offset, jitter)
+        now = time.time()
+        with self._cond:
+            self.jobs[name] = job
+            when = now if run_now else job.schedule(now)
+            heapq.heappush(self._heap, (when, next(self._seq), job))
+            self._cond.notify_all()
+        return job
+
+    def run(self, name):
+        job = self.jobs[name]
+        with self._cond:
+            return self._enqueue(job)
+
+    def start(self):
+        threads = [('jobs-timer', self._timer)] + [
+            (f'jobs-{index}', self._worker) for index in range(self.workers)]
+        for name, target in threads:
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads.clear()
+
+    def stats(self):
+        with self._cond:
+            return {
+                name: {
+                    'runs': job.runs,
+                    'failures': job.failures,
+                    'skipped': job.skipped,
+                    'running': job.running,
+                    'last_run': job.last_run,
+                    'last_duration': job.last_duration,
+                    'total_duration': round(job.total_duration, 3),
+                    'next_run': job.next_run,
+                } for name, job in self.jobs.items()}
+
+    def _enqueue(self, job):
+        if job.running:
+            # Предыдущий запуск ещё не закончился — второй не начинаем.
+            job.skipped += 1
+            logger.warning(f'Задача {job.name} ещё выполняется, пропускаем')
+            return False
+        job.running = True
+        self._pending.append(job)
+        self._cond.notify_all()
+        return True
+
+    def _timer(self):
+        with self._cond:
+            while not self._stopped:
+                now = time.time()
+                while self._heap and self._heap[0][0] <= now:
+                    _, _, job = heapq.heappop(self._heap)
+                    self._enqueue(job)
+                    heapq.heappush(
+                        self._heap,
+                        (job.schedule(now), next(self._seq), job))
+                timeout = self._heap[0][0] - now if self._heap else None
+                self._cond.wait(timeout)
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                job = self._pending.pop(0)
+            self._execute(job)
+
+    def _execute(self, job):
+        start = time.monotonic()
+        failed = False
+        try:
+            job.func()
+        except Exception as error:
+            failed = True
+            logger.exception(f'Ошибка в задаче {job.name}: {error}')
+        duration = time.monotonic() - start
+        with self._cond:
+            job.running = False
+            job.runs += 1
+            job.failures += failed
+            job.last_run = time.time()
+            job.last_duration = round(duration, 3)
+            job.total_duration += duration
+        logger.debug(f'Задача {job.name} заняла {duration:.3f} с')
@@ -0,0 +1,282 @@
+import logging
+import sqlite3
+import sys
+
+import queries
+from constants import DB_CACHE_SIZE, DB_MMAP_SIZE, DB_PATH
+
+logger = logging.getLogger(__name__)
+
+NOTE_SCOPE = (
+    "CASE WHEN {row}.group_id IS NULL THEN 'u' || {row}.user_id "
+    "ELSE 'g' || {row}.group_id END"
+)
+
+MIGRATIONS = [
+    (1, [
+        'CREATE TABLE IF NOT EXISTS users ('
+        'id INTEGER PRIMARY KEY, '
+        'user_id_t INTEGER NOT NULL UNIQUE, '
+        'user_name TEXT, '
+        'f_name TEXT, '
+        'l_name TEXT)',
+        'CREATE TABLE IF NOT EXISTS groups ('
+        'id INTEGER PRIMARY KEY, '
+        'name TEXT NOT NULL, '
+        'owner_id INTEGER NOT NULL REFERENCES users (id))',
+        'CREATE TABLE IF NOT EXISTS users_groups ('
+        'user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE, '
+        'group_id INTEGER NOT NULL '
+        'REFERENCES groups (id) ON DELETE CASCADE, '
+        'add_note INTEGER NOT NULL DEFAULT 0, '
+        'PRIMARY KEY (user_id, group_id)) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS notes ('
+        'id INTEGER PRIMARY KEY, '
+        'user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE, '
+        'group_id INTEGER REFERENCES groups (id) ON DELETE CASCADE, '
+        'note TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS requests ('
+        'id INTEGER PRIMARY KEY, '
+        'user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE, '
+        'group_id INTEGER NOT NULL '
+        'REFERENCES groups (id) ON DELETE CASCADE, '
+        'date INTEGER NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS photos ('
+        'source TEXT PRIMARY KEY, '
+        'file_id TEXT NOT NULL, '
+        'used_at INTEGER NOT NULL)',
+        # users.user_id_t и photos.source проиндексированы через UNIQUE/PK.
+        'CREATE INDEX IF NOT EXISTS users_user_name ON users (user_name)',
+        'CREATE INDEX IF NOT EXISTS groups_owner_id ON groups (owner_id)',
+        'CREATE INDEX IF NOT EXISTS users_groups_group_id '
+        'ON users_groups (group_id, user_id, add_note)',
+        'CREATE INDEX IF NOT EXISTS notes_user_id '
+        'ON notes (user_id, group_id)',
+        'CREATE INDEX IF NOT EXISTS notes_group_id ON notes (group_id)',
+        'CREATE INDEX IF NOT EXISTS requests_user_id '
+        'ON requests (user_id, date)',
+        'CREATE INDEX IF NOT EXISTS requests_date ON requests (date)',
+        'CREATE INDEX IF NOT EXISTS requests_group_id '
+        'ON requests (group_id)',
+        'CREATE INDEX IF NOT EXISTS photos_used_at ON photos (used_at)',
+    ]),
+    (2, [
+        'ALTER TABLE notes ADD COLUMN remind_at INTEGER',
+        'CREATE INDEX IF NOT EXISTS notes_remind_at '
+        'ON notes (remind_at, id) WHERE remind_at IS NOT NULL',
+    ]),
+    (3, [
+        'CREATE TABLE IF NOT EXISTS conversations ('
+        'chat_id INTEGER PRIMARY KEY, '
+        'step TEXT NOT NULL, '
+        'args TEXT NOT NULL, '
+        'expires_at INTEGER NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS conversations_expires_at '
+        'ON conversations (expires_at)',
+    ]),
+    (4, [
+        'CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5('
+        'note, content=notes, content_rowid=id, '
+        "tokenize='unicode61 remove_diacritics 2')",
+        'CREATE TRIGGER IF NOT EXISTS notes_fts_insert '
+        'AFTER INSERT ON notes BEGIN '
+        'INSERT INTO notes_fts (rowid, note) VALUES (new.id, new.note); '
+        'END',
+        'CREATE TRIGGER IF NOT EXISTS notes_fts_delete '
+        'AFTER DELETE ON notes BEGIN '
+        'INSERT INTO notes_fts (notes_fts, rowid, note) '
+        "VALUES ('delete', old.id, old.note); "
+        'END',
+        'CREATE TRIGGER IF NOT EXISTS notes_fts_update '
+        'AFTER UPDATE OF note ON notes BEGIN '
+        'INSERT INTO notes_fts (notes_fts, rowid, note) '
+        "VALUES ('delete', old.id, old.note); "
+        'INSERT INTO notes_fts (rowid, note) VALUES (new.id, new.note); '
+        'END',
+        "INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')",
+    ]),
+    (5, [
+        'ALTER TABLE users_groups '
+        'ADD COLUMN notify INTEGER NOT NULL DEFAULT 0',
+        'CREATE INDEX IF NOT EXISTS users_groups_notify '
+        'ON users_groups (group_id, user_id) WHERE notify = 1',
+    ]),
+    (6, [
+        'ALTER TABLE users ADD COLUMN digest INTEGER NOT NULL DEFAULT 0',
+        'CREATE TABLE IF NOT EXISTS events ('
+        'id INTEGER PRIMARY KEY, '
+        'user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE, '
+        'text TEXT NOT NULL, '
+        'created_at INTEGER NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS events_user_id ON events (user_id, id)',
+        # Счётчик на пользователя обновляется при каждом событии, поэтому
+        # рассылка сводок не перебирает events целиком.
+        'CREATE TABLE IF NOT EXISTS digests ('
+        'user_id INTEGER PRIMARY KEY '
+        'REFERENCES users (id) ON DELETE CASCADE, '
+        'events INTEGER NOT NULL, '
+        'first_at INTEGER NOT NULL)',
+    ]),
+    # Запросы листаются по id, а индекс по (user_id, date) заставлял
+    # сортировать их во временном B-дереве.
+    (7, [
+        'DROP INDEX IF EXISTS requests_user_id',
+        'CREATE INDEX IF NOT EXISTS requests_user_id_id '
+        'ON requests (user_id, id)',
+    ]),
+    # Колонка scope («u<user_id>» для личной записки, «g<group_id>» для
+    # записки группы) ограничивает MATCH записками пользователя, и
+    # ранжируются только они, а не все совпадения в базе.
+    (8, [
+        'DROP TRIGGER IF EXISTS notes_fts_insert',
+        'DROP TRIGGER IF EXISTS notes_fts_delete',
+        'DROP TRIGGER IF EXISTS notes_fts_update',
+        'DROP TABLE IF EXISTS notes_fts',
+        'CREATE VIEW IF NOT EXISTS notes_scoped AS '
+        f'SELECT id, note, {NOTE_SCOPE.format(row="notes")} AS scope '
+        'FROM notes',
+        'CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5('
+        'note, scope, content=notes_scoped, content_rowid=id, '
+        "tokenize='unicode61 remove_diacritics 2')",
+        # Совпадение в scope не должно влиять на bm25.
+        'INSERT INTO notes_fts (notes_fts, rank) '
+        "VALUES ('rank', 'bm25(1, 0)')",
+        'CREATE TRIGGER IF NOT EXISTS notes_fts_insert '
+        'AFTER INSERT ON notes BEGIN '
+        'INSERT INTO notes_fts (rowid, note, scope) '
+        f'VALUES (new.id, new.note, {NOTE_SCOPE.format(row="new")}); '
+        'END',
+        'CREATE TRIGGER IF NOT EXISTS notes_fts_delete '
+        'AFTER DELETE ON notes BEGIN '
+        'INSERT INTO notes_fts (notes_fts, rowid, note, scope) '
+        "VALUES ('delete', old.id, old.note, "
+        f'{NOTE_SCOPE.format(row="old")}); '
+        'END',
+        'CREATE TRIGGER IF NOT EXISTS notes_fts_update '
+        'AFTER UPDATE OF note, user_id, group_id ON notes BEGIN '
+        'INSERT INTO notes_fts (notes_fts, rowid, note, scope) '
+        "VALUES ('delete', old.id, old.note, "
+        f'{NOTE_SCOPE.format(row="old")}); '
+        'INSERT INTO notes_fts (rowid, note, scope) '
+        f'VALUES (new.id, new.note, {NOTE_SCOPE.format(row="new")}); '
+        'END',
+        "INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')",
+    ]),
+]
+
+# COUNT_PHOTOS выполняется один раз при старте, EVICT_PHOTOS идёт по индексу
+# used_at от самых старых записей и останавливается на LIMIT, RECENT_PHOTOS —
+# так же от самых новых, один раз при старте.
+# COUNT_CONVERSATIONS нужен только при старте и после очистки.
+FULL_SCAN_ALLOWED = {'COUNT_PHOTOS', 'EVICT_PHOTOS', 'RECENT_PHOTOS',
+                     'COUNT_CONVERSATIONS'}
+
+# PAGE_NOTES и INLINE_NOTES сливают личные записки с записками групп и
+# сортируют не больше LIMIT строк из каждой группы пользователя.
+# SEARCH_NOTES ранжирует совпадения только среди записок пользователя.
+TEMP_SORT_ALLOWED = {'PAGE_NOTES', 'INLINE_NOTES', 'SEARCH_NOTES'}
+
+
+def configure(conn):
+    # Действует только для новой базы, до создания первой таблицы.
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA mmap_size = {int(DB_MMAP_SIZE)}')
+    conn.execute(f'PRAGMA cache_size = {int(DB_CACHE_SIZE)}')
+    conn.execute('PRAGMA busy_timeout = 5000')
+
+
+def migrate(conn):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for target, statements in MIGRATIONS:
+        if target <= version:
+            continue
+        logger.info(f'Обновляем схему базы данных до версии {target}')
+        try:
+            conn.execute('BEGIN')
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {target}')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        version = target
+    return version
+
+
+def database_size(conn):
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    return page_count * page_size
+
+
+def incremental_vacuum_enabled(conn):
+    return conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+
+
+def enable_incremental_vacuum(conn):
+    # VACUUM переписывает весь файл и держит блокировку записи до конца,
+    # поэтому запускается только вручную: python schema.py vacuum.
+    if incremental_vacuum_enabled(conn):
+        return
+    size = database_size(conn) / 2 ** 20
+    logger.info(f'Переводим базу данных в режим incremental_vacuum, '
+                f'VACUUM перепишет {size:.1f} МБ')
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+
+
+def connect(path=DB_PATH, **kwargs):
+    conn = sqlite3.connect(path, isolation_level=None, **kwargs)
+    configure(conn)
+    migrate(conn)
+    conn.isolation_level = ''
+    return conn
+
+
+def full_scans(conn, statements=None):
+    if statements is None:
+        statements = queries.statements()
+    result = []
+    for name, sql in statements:
+        if name.split(':')[0] in FULL_SCAN_ALLOWED:
+            continue
+        plan = conn.execute(
+            'EXPLAIN QUERY PLAN ' + sql, [None] * sql.count('?')
+        ).fetchall()
+        outer = {}
+        for row in plan:
+            parent, detail = row[1], row[-1]
+            if detail.startswith(('SCAN ', 'SEARCH ')):
+                outer.setdefault(parent, detail)
+            if (detail.startswith('USE TEMP B-TREE')
+                    and name.split(':')[0] not in TEMP_SORT_ALLOWED):
+                result.append((name, detail))
+                continue
+            if not detail.startswith('SCAN '):
+                continue
+            if 'VIRTUAL TABLE' in detail:
+                # json_each перебирает переданный список, а FTS5 — свой
+                # индекс, но только если они ведут запрос. Внутри цикла по
+                # другой таблице их перебирают заново на каждую её строку.
+                if outer[parent] != detail:
+                    result.append((name, f'{outer[parent]} -> {detail}'))
+                continue
+            if 'CONSTANT ROW' in detail:
+                continue
+            result.append((name, detail))
+    return result
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['vacuum']:
+        logging.basicConfig(level=logging.INFO)
+        enable_incremental_vacuum(connect())
+        sys.exit(0)
+    scans = full_scans(connect(':memory:'))
+    for name, detail in scans:
+        print(f'{name}: {detail}')
+    sys.exit(1 if scans else 0)
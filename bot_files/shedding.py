@@ -0,0 +1,63 @@
+import logging
+import time
+
+from constants import (SHED_DEPTH, SHED_HOLD, SHED_P99, SHED_RECOVER_DEPTH,
+                       SHED_RECOVER_P99)
+from metrics import percentile
+
+logger = logging.getLogger(__name__)
+
+
+class LoadShedder:
+
+    def __init__(self, depth, histogram, max_depth=SHED_DEPTH,
+                 max_p99=SHED_P99, recover_depth=SHED_RECOVER_DEPTH,
+                 recover_p99=SHED_RECOVER_P99, hold=SHED_HOLD):
+        self.depth = depth
+        self.histogram = histogram
+        self.max_depth = max_depth
+        self.max_p99 = max_p99
+        self.recover_depth = recover_depth
+        self.recover_p99 = recover_p99
+        self.hold = hold
+        self.degraded = False
+        self.transitions = 0
+        self.last_depth = 0
+        self.last_p99 = 0.0
+        self._calm_since = None
+        self._counts = histogram.snapshot()[0]
+
+    def check(self):
+        # p99 считаем только по обновлениям, обработанным с прошлой проверки.
+        counts = self.histogram.snapshot()[0]
+        recent = [new - old for new, old in zip(counts, self._counts)]
+        self._counts = counts
+        depth = self.depth()
+        p99 = percentile(recent, 0.99)
+        self.last_depth, self.last_p99 = depth, p99
+        if not self.degraded:
+            if depth >= self.max_depth or p99 >= self.max_p99:
+                self._switch(True)
+            return self.degraded
+        # Возвращаемся, только когда нагрузка упала заметно ниже порогов
+        # и продержалась так не меньше hold секунд.
+        if depth > self.recover_depth or p99 > self.recover_p99:
+            self._calm_since = None
+        elif self._calm_since is None:
+            self._calm_since = time.monotonic()
+        elif time.monotonic() - self._calm_since >= self.hold:
+            self._switch(False)
+        return self.degraded
+
+    def _switch(self, degraded):
+        self.degraded = degraded
+        self._calm_since = None
+        self.transitions += 1
+        if degraded:
+            logger.warning(
+                f'Перегрузка: очередь {self.last_depth}, p99 '
+                f'{self.last_p99 * 1000:.0f} мс — отвечаем без новых фото')
+        else:
+            logger.info(
+                f'Нагрузка спала: очередь {self.last_depth}, p99 '
+                f'{self.last_p99 * 1000:.0f} мс — обычный режим')
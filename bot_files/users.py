@@ -0,0 +1,64 @@
+import threading
+
+from collections import OrderedDict
+
+from constants import USER_CACHE_SIZE
+
+
+class UserRecord:
+
+    __slots__ = ('id', 'user_id_t', 'user_name', 'f_name', 'l_name', 'digest')
+
+    def __init__(self, id, user_id_t, user_name, f_name, l_name, digest=0):
+        self.id = id
+        self.user_id_t = user_id_t
+        self.user_name = user_name
+        self.f_name = f_name
+        self.l_name = l_name
+        self.digest = digest
+
+    @classmethod
+    def from_row(cls, row):
+        if row is None:
+            return None
+        return cls(*row)
+
+    def same_chat(self, chat):
+        return (self.user_name, self.f_name, self.l_name) == (
+            chat.username, chat.first_name, chat.last_name)
+
+
+class UserCache:
+
+    def __init__(self, max_size=USER_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, user_id_t):
+        with self._lock:
+            user = self._users.get(user_id_t)
+            if user is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._users.move_to_end(user_id_t)
+            return user
+
+    def put(self, user):
+        with self._lock:
+            self._users[user.user_id_t] = user
+            self._users.move_to_end(user.user_id_t)
+            while len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+
+    def invalidate(self, user_id_t):
+        with self._lock:
+            self._users.pop(user_id_t, None)
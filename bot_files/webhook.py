@@ -0,0 +1,109 @@
+import hmac
+import logging
+import queue
+import secrets
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot import types
+
+from constants import (WEBHOOK_HOST, WEBHOOK_MAX_BODY, WEBHOOK_PATH,
+                       WEBHOOK_PORT, WEBHOOK_QUEUE_SIZE, WEBHOOK_SECRET)
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+STOP = object()
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        webhook = self.server.webhook
+        if self.path != webhook.path:
+            self.send_response(404)
+            self.end_headers()
+            return
+        secret = self.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(secret, webhook.secret):
+            logger.warning('Запрос к вебхуку с неверным секретом')
+            self.send_response(403)
+            self.end_headers()
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if not 0 <= length <= webhook.max_body:
+            # Тело не читаем: соединение закроется вместе с ответом.
+            logger.warning(f'Запрос к вебхуку с телом {length} байт')
+            self.send_response(400 if length < 0 else 413)
+            self.end_headers()
+            return
+        body = self.rfile.read(length)
+        try:
+            webhook.updates.put_nowait(body)
+        except queue.Full:
+            # Telegram повторит доставку, если ответ не 2xx.
+            logger.warning('Очередь вебхука переполнена')
+            self.send_response(503)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class WebhookServer:
+
+    def __init__(self, handle, host=WEBHOOK_HOST, port=WEBHOOK_PORT,
+                 path=WEBHOOK_PATH, secret=WEBHOOK_SECRET,
+                 queue_size=WEBHOOK_QUEUE_SIZE, max_body=WEBHOOK_MAX_BODY):
+        self.handle = handle
+        self.path = path
+        if not secret:
+            # Без секрета обновления мог бы подделать кто угодно.
+            secret = secrets.token_urlsafe(32)
+            logger.info('WEBHOOK_SECRET не задан, используем случайный')
+        self.secret = secret
+        self.max_body = max_body
+        self.updates = queue.Queue(maxsize=queue_size)
+        self.server = ThreadingHTTPServer((host, port), WebhookHandler)
+        self.server.daemon_threads = True
+        self.server.webhook = self
+        self._threads = []
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def start(self):
+        for target, name in ((self.server.serve_forever, 'webhook-http'),
+                             (self._consume, 'webhook-queue')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f'Вебхук слушает {self.address[0]}:{self.address[1]}')
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.updates.put(STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+
+    def _consume(self):
+        while True:
+            body = self.updates.get()
+            if body is STOP:
+                break
+            try:
+                update = types.Update.de_json(body.decode('utf-8'))
+            except Exception as error:
+                logger.error(f'Не удалось разобрать обновление: {error}')
+                continue
+            self.handle(update)
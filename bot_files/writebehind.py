@@ -0,0 +1,166 @@
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+from concurrent.futures import Future
+
+from constants import WRITE_BUFFER_INTERVAL, WRITE_BUFFER_ROWS
+
+logger = logging.getLogger(__name__)
+
+INSERT_TABLE = re.compile(r'INSERT INTO (\w+)')
+
+
+class Write:
+
+    __slots__ = ('statements', 'rowid', 'after', 'future')
+
+    def __init__(self, statements, rowid=False, after=None):
+        # statements — пары (sql, params); результат записи — id строки,
+        # вставленной первой из них, если rowid.
+        self.statements = statements
+        self.rowid = rowid
+        self.after = after
+        self.future = Future()
+
+    @property
+    def key(self):
+        return self.rowid, tuple(sql for sql, _ in self.statements)
+
+
+class WriteBuffer:
+
+    def __init__(self, db, interval=WRITE_BUFFER_INTERVAL,
+                 rows=WRITE_BUFFER_ROWS):
+        self.db = db
+        self.interval = interval
+        self.rows = rows
+        self.flushes = 0
+        self.written = 0
+        self._writes = []
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        # Всё, что успели поставить в буфер, записываем до выхода.
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self._flush(self._take())
+
+    def depth(self):
+        with self._cond:
+            return len(self._writes)
+
+    def execute(self, statements, rowid=False, after=None):
+        return self._submit(Write(statements, rowid, after))
+
+    def _submit(self, write):
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError('Буфер записи остановлен')
+            self._writes.append(write)
+            # Первая запись запускает отсчёт интервала, M-я — сброс сразу.
+            if len(self._writes) in (1, self.rows):
+                self._cond.notify()
+        return write.future
+
+    def _take(self):
+        with self._cond:
+            writes, self._writes = self._writes, []
+        return writes
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and not self._writes:
+                    self._cond.wait()
+                deadline = time.monotonic() + self.interval
+                while not self._stopped and len(self._writes) < self.rows:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+            self._flush(self._take())
+
+    def _flush(self, writes):
+        if not writes:
+            return
+        try:
+            with self.db.transaction() as conn:
+                results = self._apply(conn, writes)
+        except Exception as error:
+            logger.warning(f'Пакетная запись не удалась, пишем по одной: '
+                           f'{error}')
+            for write in writes:
+                self._flush_one(write)
+            return
+        self.flushes += 1
+        self.written += len(writes)
+        for write, result in zip(writes, results):
+            self._resolve(write, result)
+
+    def _apply(self, conn, writes):
+        results = []
+        start = 0
+        while start < len(writes):
+            # Подряд идущие записи из одних и тех же запросов уходят
+            # одним executemany на каждый запрос.
+            key = writes[start].key
+            end = start + 1
+            while end < len(writes) and writes[end].key == key:
+                end += 1
+            run = writes[start:end]
+            for index, (sql, _) in enumerate(run[0].statements):
+                conn.executemany(
+                    sql, [write.statements[index][1] for write in run])
+                if index == 0:
+                    results.extend(self._rowids(conn, run, sql))
+            start = end
+        return results
+
+    def _rowids(self, conn, run, sql):
+        match = INSERT_TABLE.match(sql)
+        if not run[0].rowid or match is None:
+            return [None] * len(run)
+        # executemany не отдаёт id строк. Без явного id SQLite выдаёт
+        # следующий за наибольшим, поэтому под блокировкой записи id пачки
+        # идут подряд; если это не так, пачка повторится по одной записи.
+        last = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+        first = last - len(run) + 1
+        found = conn.execute(
+            f'SELECT COUNT(*) FROM {match[1]} WHERE rowid BETWEEN ? AND ?',
+            (first, last)).fetchone()[0]
+        if found != len(run):
+            raise sqlite3.DatabaseError('id вставленных строк идут не подряд')
+        return list(range(first, last + 1))
+
+    def _flush_one(self, write):
+        try:
+            with self.db.transaction() as conn:
+                result, = self._apply(conn, [write])
+        except Exception as error:
+            write.future.set_exception(error)
+            return
+        self.written += 1
+        self._resolve(write, result)
+
+    def _resolve(self, write, result):
+        if write.after is not None:
+            try:
+                write.after(result)
+            except Exception as error:
+                logger.error(f'Ошибка после записи: {error}')
+        write.future.set_result(result)